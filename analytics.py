@@ -0,0 +1,150 @@
+import math
+import re
+
+
+# Score histogram over the 0-30 scale.
+SCORE_MAX = 30.0
+HIST_BINS = 10
+
+# Answers that read as a single option letter ("b", "B)", "(c)", "d. lw $t0") are
+# counted per question for distractor analysis; free-text answers are not.
+_CHOICE = re.compile(r"^\(?([a-hA-H])(?:[).:]|\s|$)")
+
+
+def choice_of(answer):
+    """The option letter a transcription picks, "" for a blank answer, or None for free text."""
+    text = (answer or "").strip()
+    if not text:
+        return ""
+    match = _CHOICE.match(text)
+    return match.group(1).lower() if match else None
+
+
+def empty_stats():
+    return {"n": 0, "score_sum": 0.0, "score_sumsq": 0.0, "hist": [0] * HIST_BINS, "questions": {}}
+
+
+def accumulate(students):
+    """
+    Additive sums of a batch of graded students, vectorized over a students x questions
+    matrix. students is a list of (score, {question_key: (earned, possible, answer)});
+    question keys are "page:question_id". Per question the fraction earned x is summed
+    with the student's score t as n, x, xx, xt, t and tt, which is everything the
+    difficulty and point-biserial need, so batches can be added and subtracted later.
+    """
+    import numpy as np
+    stats = empty_stats()
+    scores = np.array([np.nan if score is None else float(score) for score, _ in students], dtype=float)
+    scored = ~np.isnan(scores)
+    stats["n"] = int(scored.sum())
+    stats["score_sum"] = float(scores[scored].sum())
+    stats["score_sumsq"] = float((scores[scored] ** 2).sum())
+    stats["hist"] = np.histogram(np.clip(scores[scored], 0, SCORE_MAX), bins=HIST_BINS,
+                                 range=(0, SCORE_MAX))[0].tolist()
+
+    keys = sorted({key for _, questions in students for key in questions})
+    if not keys:
+        return stats
+    column = {key: idx for idx, key in enumerate(keys)}
+    matrix = np.full((len(students), len(keys)), np.nan)
+    possible = np.zeros((len(students), len(keys)))
+    for row, (_, questions) in enumerate(students):
+        for key, (earned, points, _) in questions.items():
+            if points and points > 0:
+                matrix[row, column[key]] = float(earned or 0) / float(points)
+                possible[row, column[key]] = float(points)
+
+    present = ~np.isnan(matrix) & scored[:, None]
+    x = np.where(present, matrix, 0.0)
+    t = np.where(present, np.nan_to_num(scores)[:, None], 0.0)
+    sums = {
+        "n": present.sum(axis=0), "x": x.sum(axis=0), "xx": (x * x).sum(axis=0),
+        "xt": (x * t).sum(axis=0), "t": t.sum(axis=0), "tt": (t * t).sum(axis=0),
+        "possible": np.where(present, possible, 0.0).sum(axis=0)
+    }
+    for idx, key in enumerate(keys):
+        question = {name: float(values[idx]) for name, values in sums.items()}
+        question["n"] = int(question["n"])
+        question["answers"] = {}
+        stats["questions"][key] = question
+
+    for row, (_, questions) in enumerate(students):
+        if not scored[row]:
+            continue
+        for key, (_, points, answer) in questions.items():
+            choice = choice_of(answer)
+            if points and points > 0 and choice is not None:
+                answers = stats["questions"][key]["answers"]
+                answers[choice or "(blank)"] = answers.get(choice or "(blank)", 0) + 1
+    return stats
+
+
+def merge(stats, delta, sign=1):
+    """Adds (sign=1) or removes (sign=-1) a batch's sums from an exam's cached sums, in place."""
+    stats["n"] += sign * delta["n"]
+    stats["score_sum"] += sign * delta["score_sum"]
+    stats["score_sumsq"] += sign * delta["score_sumsq"]
+    stats["hist"] = [a + sign * b for a, b in zip(stats["hist"], delta["hist"])]
+    for key, question in delta["questions"].items():
+        target = stats["questions"].setdefault(key, {
+            "n": 0, "x": 0.0, "xx": 0.0, "xt": 0.0, "t": 0.0, "tt": 0.0, "possible": 0.0, "answers": {}
+        })
+        for name in ("n", "x", "xx", "xt", "t", "tt", "possible"):
+            target[name] += sign * question[name]
+        for answer, count in question["answers"].items():
+            target["answers"][answer] = target["answers"].get(answer, 0) + sign * count
+            if not target["answers"][answer]:
+                del target["answers"][answer]
+        if target["n"] <= 0:
+            del stats["questions"][key]
+    return stats
+
+
+def _correlation(n, x, xx, xt, t, tt):
+    denominator = (n * xx - x * x) * (n * tt - t * t)
+    if n < 2 or denominator <= 1e-12:
+        return None
+    return (n * xt - x * t) / math.sqrt(denominator)
+
+
+def summarize(stats):
+    """
+    The analytics view of cached sums: score mean, standard deviation and histogram,
+    and per question the difficulty (mean fraction earned, the p-value), the point-
+    biserial discrimination against the score (uncorrected: the item is part of the
+    score) and the option counts, ordered by page and question.
+    """
+    n = stats["n"]
+    mean = stats["score_sum"] / n if n else None
+    deviation = math.sqrt(max(stats["score_sumsq"] / n - mean * mean, 0.0)) if n else None
+    width = SCORE_MAX / HIST_BINS
+
+    def order(key):
+        page, _, qid = key.partition(":")
+        return int(page) if page.isdigit() else 0, [int(part) if part.isdigit() else part
+                                                    for part in re.split(r"(\d+)", qid)]
+
+    questions = []
+    for key in sorted(stats["questions"], key=order):
+        q = stats["questions"][key]
+        page, _, qid = key.partition(":")
+        difficulty = q["x"] / q["n"] if q["n"] else None
+        discrimination = _correlation(q["n"], q["x"], q["xx"], q["xt"], q["t"], q["tt"])
+        questions.append({
+            "page": int(page) if page.isdigit() else None,
+            "question_id": qid,
+            "responses": q["n"],
+            "points_possible": round(q["possible"] / q["n"], 2) if q["n"] else None,
+            "difficulty": None if difficulty is None else round(difficulty, 3),
+            "discrimination": None if discrimination is None else round(discrimination, 3),
+            "answers": dict(sorted(q["answers"].items(), key=lambda item: -item[1]))
+        })
+
+    return {
+        "students": n,
+        "mean": None if mean is None else round(mean, 2),
+        "std_dev": None if deviation is None else round(deviation, 2),
+        "histogram": [{"from": round(idx * width, 1), "to": round((idx + 1) * width, 1), "count": count}
+                      for idx, count in enumerate(stats["hist"])],
+        "questions": questions
+    }
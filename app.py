@@ -1,19 +1,33 @@
-from flask import Flask, request, render_template, redirect, url_for, session
+from flask import Flask, request, render_template, redirect, url_for, session, jsonify
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage
+import click
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 import urllib
+import io
 import os
 import base64
-from demo_ai import grade_batch_exams, extract_student_info
+import hashlib
+# render, omr and page_screen (PyMuPDF, NumPy) are imported inside the grading paths
+# that use them, so a web worker doesn't load them at boot.
+from demo_ai import grade_batch_exams, extract_student_info, transcribe_answer_key, EndpointUnavailable
+from export import csv_stream, xlsx_stream, XLSX_MIMETYPE
+import analytics
+import upload_store
+import metrics
 import uuid
-from datetime import datetime
+import socket
+from datetime import datetime, timedelta
 import re
-import fitz
 import json
 from flask import Response, stream_with_context
 import threading
 import time as time_module
 import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
   
 app = Flask(__name__)
 
@@ -36,6 +50,15 @@ if os.environ.get('TESTING') == 'True':
     print("Using in-memory SQLite for testing...")
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = f"mssql+pyodbc:///?odbc_connect={params}"
+    # The pool serves request threads, the grading workers and their page threads'
+    # progress updates; fast_executemany sends bulk inserts as one pyodbc batch.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": int(os.environ.get('DB_POOL_SIZE', 10)),
+        "max_overflow": int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+        "fast_executemany": True
+    }
     print("Using SQL Server...")
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -51,7 +74,7 @@ class User(db.Model):
 class Student(db.Model):
     __tablename__ = 'students'
     StudentId   = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    FullName    = db.Column(db.String(100), nullable=False)
+    FullName    = db.Column(db.String(100), nullable=False, index=True)
     StudentCode = db.Column(db.String(50), nullable=False, unique=True)
     Class       = db.Column(db.String(50))
 
@@ -62,18 +85,150 @@ class Exam(db.Model):
     Subject   = db.Column(db.String(100), nullable=False)
     Title     = db.Column(db.String(200), nullable=False)
     ExamDate  = db.Column(db.Date, default=datetime.utcnow)
+    OmrTemplate = db.Column(db.Text)
+    RenderProfile = db.Column(db.Text)
 
 class Result(db.Model):
     __tablename__ = 'results'
+    # Serves the newest-first keyset pagination on /results.
+    __table_args__ = (db.Index('ix_results_GradedAt_ResultId', 'GradedAt', 'ResultId'),)
     ResultId   = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    ExamId     = db.Column(db.Integer, db.ForeignKey('exams.ExamId'), nullable=False)
-    StudentId  = db.Column(db.Integer, db.ForeignKey('students.StudentId'), nullable=False)
+    ExamId     = db.Column(db.Integer, db.ForeignKey('exams.ExamId'), nullable=False, index=True)
+    StudentId  = db.Column(db.Integer, db.ForeignKey('students.StudentId'), nullable=False, index=True)
     Score      = db.Column(db.Float)
     AIFeedback = db.Column(db.Text)
     GradedAt   = db.Column(db.DateTime, default=datetime.utcnow)
+    KeyId      = db.Column(db.Integer, db.ForeignKey('exam_keys.KeyId'))
+    items      = db.relationship('ResultItem', order_by='ResultItem.ResultItemId',
+                                 cascade='all, delete-orphan')
 
-with app.app_context():
-    db.create_all() 
+class ResultItem(db.Model):
+    __tablename__ = 'result_items'
+    ResultItemId         = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    ResultId             = db.Column(db.Integer, db.ForeignKey('results.ResultId'), nullable=False, index=True)
+    PageNumber           = db.Column(db.Integer, nullable=False)
+    QuestionId           = db.Column(db.String(50))
+    Verdict              = db.Column(db.String(20))
+    PointsEarned         = db.Column(db.Float, nullable=False, default=0.0)
+    PointsPossible       = db.Column(db.Float, nullable=False, default=0.0)
+    KeyTranscription     = db.Column(db.Text)
+    StudentTranscription = db.Column(db.Text)
+    Analysis             = db.Column(db.Text)
+
+class ExamAnalytics(db.Model):
+    """
+    Cached analytics sums of an exam's latest result per student (see analytics.py),
+    built on first view and then adjusted by persist_results as students are graded.
+    """
+    __tablename__ = 'exam_analytics'
+    ExamId    = db.Column(db.Integer, db.ForeignKey('exams.ExamId'), primary_key=True)
+    Stats     = db.Column(db.Text, nullable=False)
+    Version   = db.Column(db.Integer, nullable=False, default=0)
+    UpdatedAt = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ExamKey(db.Model):
+    __tablename__ = 'exam_keys'
+    KeyId      = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    ExamId     = db.Column(db.Integer, db.ForeignKey('exams.ExamId'), nullable=False, index=True)
+    KeyHash    = db.Column(db.String(64), nullable=False)
+    PageCount  = db.Column(db.Integer, nullable=False)
+    CreatedAt  = db.Column(db.DateTime, default=datetime.utcnow)
+    LastUsedAt = db.Column(db.DateTime, default=datetime.utcnow)
+    pages      = db.relationship('ExamKeyPage', order_by='ExamKeyPage.PageNumber',
+                                 cascade='all, delete-orphan')
+
+class ExamKeyPage(db.Model):
+    __tablename__ = 'exam_key_pages'
+    KeyPageId  = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    KeyId      = db.Column(db.Integer, db.ForeignKey('exam_keys.KeyId'), nullable=False, index=True)
+    PageNumber    = db.Column(db.Integer, nullable=False)
+    ImageData     = db.Column(db.Text, nullable=False)
+    PageHash      = db.Column(db.String(64))
+    Transcription = db.Column(db.Text)
+
+class GradingJob(db.Model):
+    __tablename__ = 'grading_jobs'
+    JobId       = db.Column(db.String(64), primary_key=True)
+    ExamId      = db.Column(db.Integer, db.ForeignKey('exams.ExamId'), nullable=False)
+    KeyId       = db.Column(db.Integer, db.ForeignKey('exam_keys.KeyId'), nullable=False)
+    UserId      = db.Column(db.Integer, db.ForeignKey('users.UserId'))
+    Status      = db.Column(db.String(20), nullable=False, default='queued')
+    Total       = db.Column(db.Integer, nullable=False)
+    CacheHits   = db.Column(db.Integer, nullable=False, default=0)
+    CacheMisses = db.Column(db.Integer, nullable=False, default=0)
+    ImageBytes  = db.Column(db.BigInteger, nullable=False, default=0)
+    ImageTokens = db.Column(db.BigInteger, nullable=False, default=0)
+    PagesDone   = db.Column(db.Integer, nullable=False, default=0)
+    PagesTotal  = db.Column(db.Integer, nullable=False, default=0)
+    Version     = db.Column(db.Integer, nullable=False, default=0)
+    # 'web' jobs are claimed by any grading worker; 'cli' jobs only by the grade-dir run.
+    Source      = db.Column(db.String(10), nullable=False, default='web')
+    CreatedAt   = db.Column(db.DateTime, default=datetime.utcnow)
+    StartedAt   = db.Column(db.DateTime)
+    UpdatedAt   = db.Column(db.DateTime, default=datetime.utcnow)
+
+class JobMetric(db.Model):
+    """Per-job totals of the pipeline's counters and stage timings (see metrics.py)."""
+    __tablename__ = 'grading_job_metrics'
+    JobId = db.Column(db.String(64), db.ForeignKey('grading_jobs.JobId'), primary_key=True)
+    Name  = db.Column(db.String(50), primary_key=True)
+    Value = db.Column(db.Float, nullable=False, default=0.0)
+
+class GradingTask(db.Model):
+    __tablename__ = 'grading_tasks'
+    TaskId     = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    JobId      = db.Column(db.String(64), db.ForeignKey('grading_jobs.JobId'), nullable=False, index=True)
+    Position   = db.Column(db.Integer, nullable=False)
+    Filename   = db.Column(db.String(255), nullable=False)
+    FilePath   = db.Column(db.String(500), nullable=False)
+    Status     = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    Attempts   = db.Column(db.Integer, nullable=False, default=0)
+    Error      = db.Column(db.Text)
+    ResultId   = db.Column(db.Integer, db.ForeignKey('results.ResultId'))
+    # Set on re-grade tasks: the Result updated in place and the pages graded again.
+    RegradeResultId = db.Column(db.Integer, db.ForeignKey('results.ResultId'))
+    RegradePages    = db.Column(db.String(500))
+    ClaimedBy  = db.Column(db.String(120))
+    ClaimedAt  = db.Column(db.DateTime)
+    FinishedAt = db.Column(db.DateTime)
+
+def upgrade_schema(engine):
+    """
+    Adds model columns missing from tables that already exist: create_all skips
+    those tables, so columns added to them later (Exam.OmrTemplate, Result.KeyId...)
+    are created here. A NOT NULL column needs a scalar default to fill the existing
+    rows; one without is reported and left for a manual migration.
+    """
+    inspector = db.inspect(engine)
+    existing = set(inspector.get_table_names())
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            present = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                ddl = f"{quote(column.name)} {column.type.compile(engine.dialect)}"
+                if not column.nullable:
+                    if column.default is None or not column.default.is_scalar:
+                        print(f"Cannot add NOT NULL column {table.name}.{column.name} without a default.")
+                        continue
+                    ddl += f" DEFAULT {column.default.arg!r} NOT NULL"
+                conn.execute(db.text(f"ALTER TABLE {quote(table.name)} ADD {ddl}"))
+                print(f"Added column {table.name}.{column.name}.")
+
+
+def init_db():
+    """Creates missing tables, columns and indexes and the admin account; safe to run again."""
+    db.create_all()
+    upgrade_schema(db.engine)
+    # create_all skips tables that already exist, so indexes added to them later
+    # are created here.
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
     admin_user = User.query.filter_by(Username='admin').first()
     if not admin_user:
         admin_pw = os.environ.get('ADMIN_PASSWORD', 'SecureDefault123!')
@@ -82,8 +237,72 @@ with app.app_context():
         db.session.commit()
         print("Successfully created the users table and added the admin account!")
 
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the database schema and the admin account (run once per database)."""
+    init_db()
+
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Uploaded PDFs are stored by SHA-256 under UPLOAD_STORE. Files not uploaded again for
+# UPLOAD_RETENTION_DAYS are removed (at most every UPLOAD_GC_INTERVAL seconds) unless
+# a queued or running task still needs them. Graded scans expire too; re-grading a
+# result whose scan is gone asks for it to be uploaded again.
+UPLOAD_STORE = os.path.join(UPLOAD_FOLDER, "store")
+UPLOAD_RETENTION_DAYS = float(os.environ.get('UPLOAD_RETENTION_DAYS', 30))
+UPLOAD_GC_INTERVAL = float(os.environ.get('UPLOAD_GC_INTERVAL', 3600))
+
+# Student PDFs are rasterized in a process pool, RASTER_QUEUE_DEPTH submissions ahead
+# of the grader. 0 workers renders on a single thread instead (used by the tests,
+# which patch pdf_to_base64_images and can't send the mock to another process).
+RASTER_WORKERS = int(os.environ.get('RASTER_WORKERS', 0 if os.environ.get('TESTING') == 'True' else os.cpu_count() or 1))
+RASTER_QUEUE_DEPTH = int(os.environ.get('RASTER_QUEUE_DEPTH', 4))
+
+# Grading runs on a pool of worker threads per process that claim queued tasks
+# (one per student PDF) from the database, so jobs survive restarts and any
+# gunicorn worker can report progress. Tests drive the queue synchronously.
+GRADING_WORKERS = int(os.environ.get('GRADING_WORKERS', 0 if os.environ.get('TESTING') == 'True' else 2))
+GRADING_CLAIM_SIZE = int(os.environ.get('GRADING_CLAIM_SIZE', RASTER_QUEUE_DEPTH))
+GRADING_TASK_LEASE = int(os.environ.get('GRADING_TASK_LEASE', 600))
+GRADING_MAX_ATTEMPTS = int(os.environ.get('GRADING_MAX_ATTEMPTS', 3))
+GRADING_POLL_INTERVAL = float(os.environ.get('GRADING_POLL_INTERVAL', 5))
+RESULT_INSERT_CHUNK = int(os.environ.get('RESULT_INSERT_CHUNK', 100))
+# Workers pick the next job by weighted fair queuing: each user gets an equal share of
+# claims, split across their jobs, and jobs of at most SMALL_JOB_TASKS students count
+# SMALL_JOB_WEIGHT times, so a quiz isn't stuck behind a whole year group. While several
+# jobs are waiting, batches shrink to one task so the jobs interleave student by student.
+SMALL_JOB_TASKS = int(os.environ.get('SMALL_JOB_TASKS', 10))
+SMALL_JOB_WEIGHT = float(os.environ.get('SMALL_JOB_WEIGHT', 4))
+# Window of finished tasks used to estimate a job's time to completion before it has its own.
+ETA_WINDOW = int(os.environ.get('ETA_WINDOW', 900))
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+# Transcribe each answer key to structured text once and grade students against that text.
+KEY_TRANSCRIPTION = os.environ.get('KEY_TRANSCRIPTION', 'True') == 'True'
+
+# How the student's ID and name are read: "fused" asks for them in the page-1 grading
+# request (falling back to the header crop if that page doesn't return them),
+# "header" sends only the cropped header region, "page" sends the whole first page.
+IDENTITY_MODE = os.environ.get('IDENTITY_MODE', 'fused')
+work_available = threading.Event()
+
+# Progress streams block until their job publishes a change. Jobs graded by another
+# process are noticed by re-reading the job's Version column every PROGRESS_DB_POLL s;
+# jobs graded in this process are never polled.
+PROGRESS_KEEPALIVE = float(os.environ.get('PROGRESS_KEEPALIVE', 15))
+PROGRESS_DB_POLL = float(os.environ.get('PROGRESS_DB_POLL', 3))
+# Each open stream holds a server thread until its page closes. Past
+# PROGRESS_MAX_STREAMS per process a stream is refused (503) and the loading page
+# polls /grading/progress/<id>/poll instead, leaving threads for other requests.
+PROGRESS_MAX_STREAMS = int(os.environ.get('PROGRESS_MAX_STREAMS', 24))
+progress_streams = threading.BoundedSemaphore(PROGRESS_MAX_STREAMS)
+
+# /results and /students render one keyset page and fetch the rest from their /api routes.
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = 500
+# Exports read results (and their items) in keyset chunks of this many rows.
+EXPORT_CHUNK = int(os.environ.get('EXPORT_CHUNK', 1000))
 
 def encode_image_to_base64(image_path):
     with open(image_path, "rb") as image_file:
@@ -118,11 +337,84 @@ def delete_exam(exam_id):
         return redirect(url_for('login'))
     exam = Exam.query.get(exam_id)
     if exam:
+        for exam_key in ExamKey.query.filter_by(ExamId=exam_id).all():
+            db.session.delete(exam_key)
+        ExamAnalytics.query.filter_by(ExamId=exam_id).delete()
         db.session.delete(exam)
         db.session.commit()
     return redirect(url_for('exams'))
 
 
+@app.route("/exams/<int:exam_id>/settings", methods=["GET", "POST"])
+def exam_settings(exam_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+
+    exam = Exam.query.get(exam_id)
+    if not exam:
+        return redirect(url_for('exams'))
+
+    error = None
+    omr_template = exam.OmrTemplate or ""
+    render_profile = exam.RenderProfile or ""
+    if request.method == "POST":
+        omr_template = request.form.get("omr_template", "").strip()
+        render_profile = request.form.get("render_profile", "").strip()
+        try:
+            if omr_template:
+                parsed = json.loads(omr_template)
+                if not isinstance(parsed.get("pages"), dict):
+                    raise ValueError('the template needs a "pages" object')
+                for page_template in parsed["pages"].values():
+                    if not page_template.get("choices") or not page_template.get("rows"):
+                        raise ValueError('every page needs "rows" and "choices"')
+        except (ValueError, AttributeError) as e:
+            error = f"Invalid OMR template: {e}"
+        try:
+            if render_profile:
+                from render import validate_profile
+                validate_profile(json.loads(render_profile))
+        except ValueError as e:
+            error = error or f"Invalid rendering profile: {e}"
+        if not error:
+            exam.OmrTemplate = omr_template or None
+            exam.RenderProfile = render_profile or None
+            db.session.commit()
+            return redirect(url_for('exams'))
+
+    return render_template("exam_settings.html", exam=exam, omr_template=omr_template,
+                           render_profile=render_profile, error=error)
+
+
+@app.route("/exams/<int:exam_id>/regrade", methods=["GET", "POST"])
+def regrade_exam(exam_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+
+    exam = Exam.query.get(exam_id)
+    if not exam:
+        return redirect(url_for('exams'))
+
+    message = None
+    if request.method == "POST":
+        question_ids = [qid.strip() for qid in re.split(r'[,\s]+', request.form.get("questions", "")) if qid.strip()]
+        exam_key = get_exam_key(exam_id, request.files.get("key"))
+        if not exam_key:
+            message = "Upload the corrected answer key; this exam has none yet."
+        else:
+            job_id = str(uuid.uuid4())
+            queued, missing = enqueue_regrade_job(job_id, exam_id, exam_key, question_ids, session.get('user_id'))
+            notice = None
+            if missing:
+                notice = (f"{len(missing)} scan(s) past the upload retention were skipped; "
+                          f"re-upload {', '.join(missing)} to re-grade them.")
+            if queued:
+                return render_template("loading.html", session_id=job_id, exam_id=exam_id, notice=notice)
+            message = notice or "Nothing to re-grade: no graded page uses a changed key page or a listed question."
+
+    return render_template("regrade.html", exam=exam, message=message)
+
+
 @app.route("/", methods=["GET", "POST"])
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -142,91 +434,1302 @@ def login():
 
     return render_template("login.html", error=error)
 
-def pdf_to_base64_images(pdf_path):
-    doc = fitz.open(pdf_path)
-    images = []
-    for page in doc:
-        pix = page.get_pixmap(dpi=200)
-        img_bytes = pix.tobytes("jpeg")
-        img_b64 = base64.b64encode(img_bytes).decode('utf-8')
-        images.append(img_b64)
-    doc.close()
-    return images
+def iter_pdf_pages(pdf_path, profile=None, pages=None):
+    """
+    Yields the pages of a PDF one at a time as base64 JPEGs, rendered with the exam's
+    rendering profile (200 DPI colour when it has none). With `pages` (page numbers)
+    only those are rendered and the others yield None.
+    """
+    from render import iter_rendered_pages
+    return iter_rendered_pages(pdf_path, profile, pages)
 
 
-grading_progress = {}
+def pdf_to_base64_images(pdf_path, profile=None, pages=None):
+    return list(iter_pdf_pages(pdf_path, profile, pages))
 
-@app.route("/grading/progress/<session_id>")
-def grading_progress_stream(session_id):
-    def generate():
-        while True:
-            progress = grading_progress.get(session_id, {})
-            data = json.dumps(progress)
-            yield f"data: {data}\n\n"
-            
-            if progress.get("done"):
-                break
-            time.sleep(0.5)
-    
-    return Response(stream_with_context(generate()),
-                    mimetype="text/event-stream",
-                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-def background_grading_task(student_files_data, key_images, exam_id, session_id, total):
-    with app.app_context(): 
-        results_list = []
-        
-        for idx, (student_filename, student_path) in enumerate(student_files_data):
-            grading_progress[session_id] = {
-                "current": idx + 1,
-                "total": total,
-                "filename": student_filename,
-                "done": False
-            }
+def exam_render_profile(exam_id):
+    """The exam's rendering profile merged over the defaults."""
+    from render import load_profile
+    return load_profile(db.session.query(Exam.RenderProfile).filter_by(ExamId=exam_id).scalar())
 
+
+_raster_pool = None
+_raster_pool_lock = threading.Lock()
+
+def get_raster_pool():
+    global _raster_pool
+    with _raster_pool_lock:
+        if _raster_pool is None:
+            if RASTER_WORKERS > 0:
+                _raster_pool = ProcessPoolExecutor(max_workers=RASTER_WORKERS)
+            else:
+                _raster_pool = ThreadPoolExecutor(max_workers=1)
+        return _raster_pool
+
+
+def rasterize_submissions(student_files_data, depth=None, profile=None, pages=None):
+    """
+    Producer side of the grading pipeline.
+    Yields (filename, path, images, error) in upload order while the process pool
+    renders up to `depth` later submissions in the background, so CPU rendering
+    overlaps the grader's network wait and at most `depth` rendered PDFs are held
+    in memory regardless of class size. `pages` optionally limits each file to a
+    set of page numbers (a list parallel to the files, None meaning every page).
+    """
+    depth = depth or RASTER_QUEUE_DEPTH
+    pool = get_raster_pool()
+    files = iter(zip(student_files_data, pages or [None] * len(student_files_data)))
+    pending = deque()
+
+    def submit_next():
+        item, file_pages = next(files, (None, None))
+        if item is not None:
+            if file_pages is None:
+                future = pool.submit(pdf_to_base64_images, item[1], profile)
+            else:
+                future = pool.submit(pdf_to_base64_images, item[1], profile, file_pages)
+            pending.append((item, future))
+
+    for _ in range(depth):
+        submit_next()
+
+    try:
+        while pending:
+            (student_filename, student_path), future = pending.popleft()
+            submit_next()
             try:
-                student_images = pdf_to_base64_images(student_path)
-                student_code, student_name = extract_student_info(student_images[0])
-                student_submissions = {student_filename: student_images}
-                result_text = grade_batch_exams(student_submissions, key_images)
-
-                score = None
-                match = re.search(r'FINAL SCALED SCORE:\s*([\d.]+)\s*/\s*30', result_text)
-                if match:
-                    score = float(match.group(1))
-
-                if student_code:
-                    student = Student.query.filter_by(StudentCode=str(student_code)).first()
-                    if not student:
-                        student = Student(
-                            FullName=student_name or "Unknown",
-                            StudentCode=str(student_code),
-                            Class="Unknown"
-                        )
-                        db.session.add(student)
-                        db.session.flush()
-
-                    grade_result = Result(
-                        ExamId=int(exam_id),
-                        StudentId=student.StudentId,
-                        Score=score,
-                        AIFeedback=result_text,
-                        GradedAt=datetime.utcnow()
-                    )
-                    db.session.add(grade_result)
-                    db.session.commit()
+                # Time the grader spends blocked on rendering, i.e. what the lookahead didn't hide.
+                with metrics.timed("render_wait"):
+                    images = future.result()
+            except Exception as e:
+                yield student_filename, student_path, None, e
+            else:
+                metrics.count("grading_pages_rendered_total", sum(1 for image in images if image is not None))
+                yield student_filename, student_path, images, None
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def get_exam_key(exam_id, key_file=None):
+    """
+    Returns the ExamKey holding the rendered answer-key pages for an exam.
+    A key PDF is only rasterized the first time its content is seen for that exam
+    (and rendering profile); with no key file the exam's most recently used key is
+    returned (None if it has none).
+    """
+    from render import load_profile
+    if key_file and key_file.filename:
+        key_bytes = key_file.read()
+        render_profile = db.session.query(Exam.RenderProfile).filter_by(ExamId=exam_id).scalar()
+        key_hash = hashlib.sha256(key_bytes + (render_profile or "").encode()).hexdigest()
+        exam_key = ExamKey.query.filter_by(ExamId=exam_id, KeyHash=key_hash).first()
+
+        if not exam_key:
+            _, key_path, _ = upload_store.store_stream(io.BytesIO(key_bytes), UPLOAD_STORE)
+            key_images = pdf_to_base64_images(key_path, load_profile(render_profile))
+
+            exam_key = ExamKey(ExamId=exam_id, KeyHash=key_hash, PageCount=len(key_images))
+            for page_idx, img_b64 in enumerate(key_images):
+                exam_key.pages.append(ExamKeyPage(PageNumber=page_idx + 1, ImageData=img_b64,
+                                                  PageHash=page_hash(img_b64)))
+            db.session.add(exam_key)
+    else:
+        exam_key = ExamKey.query.filter_by(ExamId=exam_id)\
+            .order_by(ExamKey.LastUsedAt.desc(), ExamKey.KeyId.desc()).first()
+        if not exam_key:
+            return None
+
+    exam_key.LastUsedAt = datetime.utcnow()
+    db.session.commit()
+    return exam_key
+
+
+def page_hash(img_b64):
+    return hashlib.sha256(img_b64.encode()).hexdigest()
+
+
+def key_page_hashes(key_id):
+    """
+    {page_num: content hash} of a key's rendered pages. Only pages not hashed yet have
+    their image loaded, hashed and the hash stored.
+    """
+    hashes = dict(db.session.query(ExamKeyPage.PageNumber, ExamKeyPage.PageHash)
+                  .filter(ExamKeyPage.KeyId == key_id))
+    missing = [page_num for page_num, digest in hashes.items() if digest is None]
+    if missing:
+        for page in ExamKeyPage.query.filter(ExamKeyPage.KeyId == key_id, ExamKeyPage.PageNumber.in_(missing)):
+            page.PageHash = hashes[page.PageNumber] = page_hash(page.ImageData)
+        db.session.flush()
+    return hashes
+
+
+def changed_key_pages(old_key_id, new_key_id, key_hashes=None):
+    """
+    Page numbers whose rendered key page differs between two keys, or exists in only one.
+    key_hashes ({key_id: key_page_hashes}) is filled and reused across calls.
+    """
+    if old_key_id == new_key_id:
+        return set()
+    key_hashes = {} if key_hashes is None else key_hashes
+    for key_id in (old_key_id, new_key_id):
+        if key_id not in key_hashes:
+            key_hashes[key_id] = key_page_hashes(key_id) if key_id else {}
+    old, new = key_hashes[old_key_id], key_hashes[new_key_id]
+    return {page_num for page_num in set(old) | set(new) if old.get(page_num) != new.get(page_num)}
+
+
+def report_pages(report):
+    """{page_num: text} of the per-page sections of a stored grading report."""
+    parts = re.split(r'--- PAGE (\d+) ---\n', report or "")
+    return {int(parts[idx]): parts[idx + 1] for idx in range(1, len(parts) - 1, 2)}
+
+
+def stored_pages(result, page_count, skip=()):
+    """
+    A Result's stored per-page grading in grade_batch_exams' pregraded schema, for the
+    pages 1..page_count not in `skip`.
+    """
+    pages = {page_num: {"questions": []} for page_num in range(1, page_count + 1) if page_num not in skip}
+    for item in result.items:
+        if item.PageNumber in pages:
+            pages[item.PageNumber]["questions"].append({
+                "question_id": item.QuestionId,
+                "key_literal_transcription": item.KeyTranscription,
+                "student_literal_transcription": item.StudentTranscription,
+                "step_by_step_analysis": item.Analysis,
+                "verdict": item.Verdict,
+                "points_possible": item.PointsPossible,
+                "points_earned": item.PointsEarned
+            })
+    return pages
+
+
+def regrade_pages(result, old_key_id, new_key_id, question_ids=(), key_hashes=None):
+    """
+    Pages of a Result that need grading again under the new key: pages whose key page
+    changed, pages holding one of the disputed question_ids, and pages that failed
+    (no stored questions and an error in their report section).
+    """
+    pages = changed_key_pages(old_key_id, new_key_id, key_hashes)
+    pages |= {item.PageNumber for item in result.items if item.QuestionId in question_ids}
+    graded_pages = {item.PageNumber for item in result.items}
+    pages |= {page_num for page_num, text in report_pages(result.AIFeedback).items()
+              if page_num not in graded_pages and "ERROR" in text}
+    return pages
+
+
+def enqueue_regrade_job(job_id, exam_id, exam_key, question_ids=(), user_id=None):
+    """
+    Queues a re-grade of an exam's results against exam_key. Each student's latest
+    Result is diffed against the key it was graded with, and only the changed or
+    disputed pages go back to the model; the Result is then updated in place.
+    Returns (number of results queued, filenames of results whose scan is no longer
+    stored); no job is created when nothing is queued.
+    """
+    question_ids = set(question_ids)
+    latest = {}
+    for result in Result.query.filter_by(ExamId=exam_id).options(db.selectinload(Result.items))\
+            .order_by(Result.GradedAt.desc(), Result.ResultId.desc()).all():
+        latest.setdefault(result.StudentId, result)
+
+    # The newest task that graded (or re-graded) each result holds its uploaded PDF.
+    sources = {}
+    result_ids = [result.ResultId for result in latest.values()]
+    for start in range(0, len(result_ids), RESULT_INSERT_CHUNK):
+        chunk = set(result_ids[start:start + RESULT_INSERT_CHUNK])
+        for task in GradingTask.query.filter(db.or_(GradingTask.ResultId.in_(chunk),
+                                                    GradingTask.RegradeResultId.in_(chunk)))\
+                .order_by(GradingTask.TaskId):
+            for result_id in (task.ResultId, task.RegradeResultId):
+                if result_id in chunk:
+                    sources[result_id] = task
+    job_keys = dict(db.session.query(GradingJob.JobId, GradingJob.KeyId)
+                    .filter(GradingJob.JobId.in_({task.JobId for task in sources.values()})))
+
+    tasks = []
+    missing = []
+    key_hashes = {}
+    for result in latest.values():
+        source = sources.get(result.ResultId)
+        if not source or not os.path.exists(source.FilePath):
+            print(f"Skipping re-grade of result {result.ResultId}: its uploaded PDF is gone.")
+            if source:
+                missing.append(source.Filename)
+            continue
+        old_key_id = result.KeyId or job_keys.get(source.JobId)
+        pages = sorted(regrade_pages(result, old_key_id, exam_key.KeyId, question_ids, key_hashes))
+        if not pages:
+            # Nothing it was graded on changed; it now counts as graded with this key.
+            result.KeyId = exam_key.KeyId
+            continue
+        tasks.append(GradingTask(
+            JobId=job_id,
+            Position=len(tasks),
+            Filename=source.Filename,
+            FilePath=source.FilePath,
+            RegradeResultId=result.ResultId,
+            RegradePages=",".join(str(page_num) for page_num in pages)
+        ))
+
+    if tasks:
+        db.session.add(GradingJob(JobId=job_id, ExamId=exam_id, KeyId=exam_key.KeyId, UserId=user_id,
+                                  Total=len(tasks)))
+        db.session.add_all(tasks)
+    db.session.commit()
+    if tasks:
+        work_available.set()
+    return len(tasks), missing
+
+
+def new_submissions(exam_id, stored):
+    """
+    Drops duplicate scans from (filename, sha256, path) uploads: repeats within the
+    batch and files already queued or graded into a Result for this exam. A scan whose
+    grading failed or found no student ID can be uploaded again to retry it. Returns
+    the (filename, path) pairs to grade and the number skipped.
+    """
+    unique, seen, total = [], set(), 0
+    for filename, sha, path in stored:
+        total += 1
+        if sha not in seen:
+            seen.add(sha)
+            unique.append((filename, path))
+    known = set()
+    paths = [path for _, path in unique]
+    for start in range(0, len(paths), RESULT_INSERT_CHUNK):
+        known.update(path for (path,) in db.session.query(GradingTask.FilePath)
+                     .join(GradingJob, GradingTask.JobId == GradingJob.JobId)
+                     .filter(GradingJob.ExamId == exam_id,
+                             db.or_(GradingTask.Status.in_(['queued', 'running']),
+                                    db.and_(GradingTask.Status == 'done', GradingTask.ResultId.isnot(None))),
+                             GradingTask.FilePath.in_(paths[start:start + RESULT_INSERT_CHUNK])))
+    fresh = [(filename, path) for filename, path in unique if path not in known]
+    return fresh, total - len(fresh)
+
+
+_last_upload_gc = 0.0
+
+def collect_uploads(force=False):
+    """Applies the upload retention policy, at most once per UPLOAD_GC_INTERVAL unless forced."""
+    global _last_upload_gc
+    if not force and time.monotonic() - _last_upload_gc < UPLOAD_GC_INTERVAL:
+        return 0
+    _last_upload_gc = time.monotonic()
+    in_use = [path for (path,) in db.session.query(GradingTask.FilePath).distinct()
+              .filter(GradingTask.Status.in_(['queued', 'running']))]
+    removed = upload_store.collect(UPLOAD_STORE, UPLOAD_RETENTION_DAYS * 86400, in_use)
+    if removed:
+        print(f"Removed {removed} upload(s) past the {UPLOAD_RETENTION_DAYS:g} day retention.")
+    return removed
+
+
+def enqueue_grading_job(job_id, exam_id, exam_key, student_files_data, user_id=None, source='web'):
+    """Records a grading job with one queued task per student PDF and wakes the workers."""
+    job = GradingJob(JobId=job_id, ExamId=exam_id, KeyId=exam_key.KeyId, UserId=user_id,
+                     Total=len(student_files_data), Source=source)
+    db.session.add(job)
+    for position, (student_filename, student_path) in enumerate(student_files_data):
+        db.session.add(GradingTask(
+            JobId=job_id,
+            Position=position,
+            Filename=student_filename,
+            FilePath=student_path
+        ))
+    db.session.commit()
+    work_available.set()
+    return job
+
+
+def next_fair_job():
+    """
+    Weighted fair queuing over the jobs with queued tasks. A job's virtual time is the
+    tasks it has been served, times the number of waiting jobs its user has, over its
+    weight; the job furthest behind goes next (the oldest on ties). Jobs of the grade-dir
+    command are drained by that command alone, which keeps its checkpoint complete.
+    Returns (job_id, number of waiting jobs), or (None, 0).
+    """
+    queued = db.func.sum(db.case((GradingTask.Status == 'queued', 1), else_=0))
+    rows = db.session.query(GradingJob.JobId, GradingJob.UserId, GradingJob.Total, GradingJob.CreatedAt,
+                            queued, db.func.count(GradingTask.TaskId))\
+        .join(GradingTask, GradingTask.JobId == GradingJob.JobId)\
+        .filter(GradingJob.Status != 'done', GradingJob.Source == 'web')\
+        .group_by(GradingJob.JobId, GradingJob.UserId, GradingJob.Total, GradingJob.CreatedAt).all()
+    waiting = [row for row in rows if row[4]]
+    if not waiting:
+        return None, 0
+
+    jobs_per_user = {}
+    for row in waiting:
+        jobs_per_user[row.UserId] = jobs_per_user.get(row.UserId, 0) + 1
+
+    def virtual_time(row):
+        served = row[5] - row[4]
+        weight = SMALL_JOB_WEIGHT if row.Total <= SMALL_JOB_TASKS else 1.0
+        return served * jobs_per_user[row.UserId] / weight, row.CreatedAt
+
+    return min(waiting, key=virtual_time).JobId, len(waiting)
+
+
+def claim_tasks(worker_id, limit=None, job_id=None):
+    """
+    Atomically moves up to `limit` queued tasks of one job to 'running' for this
+    worker: the given job, or the one next_fair_job picks. The conditional UPDATE
+    makes the claim safe across threads and gunicorn processes sharing the database.
+    """
+    limit = limit or GRADING_CLAIM_SIZE
+    if not job_id:
+        job_id, waiting_jobs = next_fair_job()
+        if not job_id:
+            db.session.rollback()
+            return []
+        if waiting_jobs > 1:
+            limit = 1
+    candidates = db.session.query(GradingTask.TaskId)\
+        .filter(GradingTask.JobId == job_id, GradingTask.Status == 'queued')\
+        .order_by(GradingTask.Position).limit(limit).all()
+    if not candidates:
+        db.session.rollback()
+        return []
+
+    task_ids = [c.TaskId for c in candidates]
+    claim_token = f"{worker_id}:{uuid.uuid4().hex[:12]}"
+    now = datetime.utcnow()
+
+    GradingTask.query.filter(GradingTask.TaskId.in_(task_ids), GradingTask.Status == 'queued')\
+        .update({
+            GradingTask.Status: 'running',
+            GradingTask.ClaimedBy: claim_token,
+            GradingTask.ClaimedAt: now,
+            GradingTask.Attempts: GradingTask.Attempts + 1
+        }, synchronize_session=False)
+    GradingJob.query.filter_by(JobId=job_id, Status='queued')\
+        .update({GradingJob.Status: 'running', GradingJob.StartedAt: now}, synchronize_session=False)
+    update_job(job_id)
+
+    return GradingTask.query.filter_by(ClaimedBy=claim_token, Status='running')\
+        .order_by(GradingTask.Position).all()
+
+
+def requeue_stale_tasks():
+    """Puts back running tasks whose worker stopped heartbeating (crash or restart)."""
+    cutoff = datetime.utcnow() - timedelta(seconds=GRADING_TASK_LEASE)
+    stale = GradingTask.query.filter(GradingTask.Status == 'running', GradingTask.ClaimedAt < cutoff)
+    requeued = stale.filter(GradingTask.Attempts < GRADING_MAX_ATTEMPTS)\
+        .update({GradingTask.Status: 'queued', GradingTask.ClaimedBy: None}, synchronize_session=False)
+    stale.update({GradingTask.Status: 'failed', GradingTask.Error: 'Worker lease expired too many times',
+                  GradingTask.FinishedAt: datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    if requeued:
+        print(f"Requeued {requeued} unfinished grading task(s).")
+        work_available.set()
+    return requeued
+
+
+def finish_job_if_complete(job_id):
+    unfinished = GradingTask.query.filter(GradingTask.JobId == job_id,
+                                          GradingTask.Status.in_(['queued', 'running'])).count()
+    if not unfinished and GradingJob.query.filter(GradingJob.JobId == job_id, GradingJob.Status != 'done')\
+            .update({GradingJob.Status: 'done'}, synchronize_session=False):
+        update_job(job_id)
+    db.session.commit()
+
+
+def update_job(job_id, **deltas):
+    """
+    Adds the given counter deltas to a job, bumps its event Version, commits and
+    wakes this process's progress listeners.
+    """
+    values = {GradingJob.Version: GradingJob.Version + 1, GradingJob.UpdatedAt: datetime.utcnow()}
+    for name, delta in deltas.items():
+        column = getattr(GradingJob, name)
+        values[column] = column + delta
+    with metrics.timed("db_progress"):
+        GradingJob.query.filter_by(JobId=job_id).update(values, synchronize_session=False)
+        db.session.commit()
+
+    progress = job_progress(job_id)
+    if progress:
+        progress_broker.publish(job_id, progress["version"], progress)
+
+
+def job_stat_deltas(stats):
+    """update_job counter deltas for a grade_batch_exams stats dict."""
+    return {
+        "CacheHits": stats.get("cache_hits", 0),
+        "CacheMisses": stats.get("cache_misses", 0),
+        "ImageBytes": stats.get("image_bytes", 0),
+        "ImageTokens": stats.get("image_tokens", 0)
+    }
+
+
+def record_job_metrics(job_id, stats):
+    """Adds a stats dict's counters and stage seconds to the job's grading_job_metrics rows."""
+    values = {name[:50]: float(value) for name, value in stats.items() if value}
+    if not values:
+        return
+    with metrics.timed("db_metrics"):
+        existing = {name for (name,) in db.session.query(JobMetric.Name)
+                    .filter(JobMetric.JobId == job_id, JobMetric.Name.in_(values.keys()))}
+        for name in existing:
+            JobMetric.query.filter_by(JobId=job_id, Name=name)\
+                .update({JobMetric.Value: JobMetric.Value + values[name]}, synchronize_session=False)
+        missing = [{"JobId": job_id, "Name": name, "Value": value}
+                   for name, value in values.items() if name not in existing]
+        try:
+            if missing:
+                db.session.execute(db.insert(JobMetric), missing)
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created one of the rows first; the next batch adds to it.
+            db.session.rollback()
+
+
+def job_page_callback(job_id):
+    """on_page hook for grade_batch_exams; runs on the page threads, so it opens its own app context."""
+    def on_page(student_name, page_num):
+        with app.app_context():
+            update_job(job_id, PagesDone=1)
+    return on_page
+
+
+def grade_submission(exam_id, student_filename, student_images, key_images, cache_stats, on_page=None,
+                     key_transcriptions=None, regrade=None):
+    """
+    Grades one student's rendered pages without touching the results tables.
+    Returns {"code", "name", "score", "report", "items"}; persist_results stores a batch of them.
+    A re-grade passes regrade={"result_id", "pages"}: the stored grading of the other
+    pages is reused and the student's identity is not read again.
+    """
+    from omr import grade_marked_pages
+    from page_screen import screen_pages
+    from render import load_profile, page_detail, crop_region
+
+    student_submissions = {student_filename: student_images}
+
+    # Blank pages and pages with nothing to grade are settled locally before any request.
+    with metrics.timed("screen", cache_stats):
+        screened, duplicates = screen_pages(key_images, student_images, key_transcriptions)
+    if screened:
+        metrics.count("grading_pages_screened_total", len(screened), cache_stats, "pages_screened")
+    if duplicates:
+        metrics.count("grading_duplicate_pages_total", len(duplicates), cache_stats, "duplicate_pages")
+    pregraded = {student_filename: screened} if screened else None
+
+    # Multiple-choice pages covered by the exam's OMR template are read locally when confident.
+    omr_template, render_profile = db.session.query(Exam.OmrTemplate, Exam.RenderProfile)\
+        .filter_by(ExamId=exam_id).one()
+    omr_template = json.loads(omr_template) if omr_template else None
+    if omr_template:
+        with metrics.timed("omr", cache_stats):
+            marked = grade_marked_pages(omr_template, key_images, student_images)
+        pregraded = {student_filename: {**marked, **screened}}
+    if regrade:
+        result = Result.query.get(regrade["result_id"])
+        pregraded = pregraded or {student_filename: {}}
+        pregraded[student_filename].update(stored_pages(result, len(key_images), regrade["pages"]))
+
+    profile = load_profile(render_profile)
+    page_details = {page_num: page_detail(profile, page_num, omr_template)
+                    for page_num in range(1, len(student_images) + 1)}
+
+    items = []
+    identities = {} if IDENTITY_MODE == 'fused' and not regrade else None
+    with metrics.timed("grading", cache_stats):
+        # A re-graded page would otherwise be answered from the response cache whenever
+        # its key and scan are unchanged (a disputed question), never reaching the model.
+        refresh = {student_filename: set(regrade["pages"])} if regrade else None
+        result_text = grade_batch_exams(student_submissions, key_images, cache_stats, on_page,
+                                        key_transcriptions, pregraded, items, page_details, identities,
+                                        refresh)
+
+    for page_num, earlier_num in sorted(duplicates.items()):
+        result_text += (f"WARNING: {student_filename} page {page_num} looks like a second scan of page "
+                        f"{earlier_num}; check the submission for a missing or repeated sheet.\n")
+
+    score = None
+    match = re.search(r'FINAL SCALED SCORE:\s*([\d.]+)\s*/\s*30', result_text)
+    if match:
+        score = float(match.group(1))
+    if regrade:
+        return {"result_id": regrade["result_id"], "code": None, "name": None, "score": score,
+                "report": result_text, "items": items}
+
+    identity = (identities or {}).get(student_filename, {})
+    student_code, student_name = identity.get("student_id"), identity.get("student_name")
+    if not student_code:
+        first_page = student_images[0]
+        if IDENTITY_MODE != 'page':
+            try:
+                first_page = crop_region(first_page, profile["header_region"])
+            except (RuntimeError, ValueError) as e:
+                # An image the cropper can't decode is sent whole rather than failing the student.
+                print(f"Header crop failed for {student_filename}: {e}")
+        with metrics.timed("identity", cache_stats):
+            student_code, student_name = extract_student_info(first_page, cache_stats)
+
+    return {
+        "code": str(student_code) if student_code else None,
+        "name": student_name,
+        "score": score,
+        "report": result_text,
+        "items": items
+    }
+
+
+def result_item_row(result_id, item):
+    """Column values for one ResultItem from a question object returned by the model."""
+    def text(value):
+        return None if value is None else str(value)
+
+    return {
+        "ResultId": result_id,
+        "PageNumber": int(item["page"]),
+        "QuestionId": (text(item.get("question_id")) or "")[:50],
+        "Verdict": (text(item.get("verdict")) or "")[:20],
+        "PointsEarned": float(item.get("points_earned") or 0),
+        "PointsPossible": float(item.get("points_possible") or 0),
+        "KeyTranscription": text(item.get("key_literal_transcription")),
+        "StudentTranscription": text(item.get("student_literal_transcription")),
+        "Analysis": text(item.get("step_by_step_analysis"))
+    }
+
+
+def rescore_results(result_ids):
+    """
+    Recomputes Score from result_items in the database: earned / possible scaled to 30.
+    Results without any items keep the score parsed from their report.
+    """
+    if not result_ids:
+        return
+    earned = db.select(db.func.sum(ResultItem.PointsEarned))\
+        .where(ResultItem.ResultId == Result.ResultId).scalar_subquery()
+    possible = db.select(db.func.sum(ResultItem.PointsPossible))\
+        .where(ResultItem.ResultId == Result.ResultId).scalar_subquery()
+    has_items = db.select(ResultItem.ResultItemId).where(ResultItem.ResultId == Result.ResultId).exists()
+
+    Result.query.filter(Result.ResultId.in_(result_ids), has_items).update({
+        Result.Score: db.case(
+            (possible > 0, db.func.round(earned * 30.0 / possible, 2)),
+            else_=0.0
+        )
+    }, synchronize_session=False)
+
+
+def persist_results(exam_id, graded, key_id=None):
+    """
+    Stores a batch of graded submissions in a few round-trips: one IN query for the
+    batch's student codes, one executemany for the missing students and chunked
+    Result inserts. Re-graded entries (with a "result_id") update their Result in
+    place and replace its items. Returns the ResultId per entry (None where no ID
+    was read). Does not commit.
+    """
+    result_ids = [None] * len(graded)
+    regraded = [(idx, g) for idx, g in enumerate(graded) if g.get("result_id")]
+    graded_new = [(idx, g) for idx, g in enumerate(graded) if not g.get("result_id")]
+    student_ids = upsert_students([g for _, g in graded_new])
+
+    # The exam's cached analytics swap these students' old latest results for the new ones.
+    cached = db.session.query(ExamAnalytics.ExamId).filter_by(ExamId=int(exam_id)).scalar() is not None
+    if cached:
+        affected = {student_ids[g["code"]] for _, g in graded_new if g["code"]}
+        if regraded:
+            affected |= {student_id for (student_id,) in db.session.query(Result.StudentId)
+                         .filter(Result.ResultId.in_([g["result_id"] for _, g in regraded]))}
+        before = result_vectors(latest_result_ids(exam_id, affected))
+
+    for idx, g in regraded:
+        Result.query.filter_by(ResultId=g["result_id"]).update({
+            Result.Score: g["score"],
+            Result.AIFeedback: g["report"],
+            Result.GradedAt: datetime.utcnow(),
+            Result.KeyId: key_id
+        }, synchronize_session=False)
+        result_ids[idx] = g["result_id"]
+    if regraded:
+        ResultItem.query.filter(ResultItem.ResultId.in_([g["result_id"] for _, g in regraded]))\
+            .delete(synchronize_session=False)
+
+    rows = [(idx, g) for idx, g in graded_new if g["code"]]
+    for start in range(0, len(rows), RESULT_INSERT_CHUNK):
+        chunk = rows[start:start + RESULT_INSERT_CHUNK]
+        results = [Result(
+            ExamId=int(exam_id),
+            StudentId=student_ids[g["code"]],
+            Score=g["score"],
+            AIFeedback=g["report"],
+            GradedAt=datetime.utcnow(),
+            KeyId=key_id
+        ) for _, g in chunk]
+        db.session.add_all(results)
+        db.session.flush()
+        for (idx, _), result in zip(chunk, results):
+            result_ids[idx] = result.ResultId
+
+    item_rows = [result_item_row(result_ids[idx], item)
+                 for idx, g in regraded + rows for item in g.get("items", [])]
+    for start in range(0, len(item_rows), RESULT_INSERT_CHUNK):
+        db.session.execute(db.insert(ResultItem), item_rows[start:start + RESULT_INSERT_CHUNK])
+    rescore_results([result_id for result_id in result_ids if result_id])
+
+    if cached:
+        update_exam_analytics(exam_id, before, result_vectors(latest_result_ids(exam_id, affected)))
+    else:
+        # A view may have built the cache since the check, from committed rows without
+        # this batch; dropping it in the batch's transaction makes the next view rebuild.
+        ExamAnalytics.query.filter_by(ExamId=int(exam_id)).delete(synchronize_session=False)
+    return result_ids
+
+
+def latest_result_filter():
+    """Filter keeping only a student's latest Result per exam (by GradedAt, then ResultId)."""
+    newer = db.aliased(Result)
+    return ~db.select(newer.ResultId).where(
+        newer.ExamId == Result.ExamId,
+        newer.StudentId == Result.StudentId,
+        db.or_(newer.GradedAt > Result.GradedAt,
+               db.and_(newer.GradedAt == Result.GradedAt, newer.ResultId > Result.ResultId))
+    ).exists()
+
+
+def latest_result_ids(exam_id, student_ids):
+    if not student_ids:
+        return []
+    return [result_id for (result_id,) in db.session.query(Result.ResultId)
+            .filter(Result.ExamId == int(exam_id), Result.StudentId.in_(student_ids), latest_result_filter())]
+
+
+def result_vectors(result_ids):
+    """
+    analytics.accumulate input for some results: (score, {"page:question_id":
+    (earned, possible, student answer)}) per result, read with one query each for
+    scores and items.
+    """
+    if not result_ids:
+        return []
+    vectors = {result_id: (score, {}) for result_id, score in db.session.query(Result.ResultId, Result.Score)
+               .filter(Result.ResultId.in_(result_ids))}
+    for result_id, page, qid, earned, possible, answer in db.session.query(
+            ResultItem.ResultId, ResultItem.PageNumber, ResultItem.QuestionId, ResultItem.PointsEarned,
+            ResultItem.PointsPossible, ResultItem.StudentTranscription)\
+            .filter(ResultItem.ResultId.in_(result_ids)):
+        vectors[result_id][1][f"{page}:{qid}"] = (earned, possible, answer)
+    return list(vectors.values())
+
+
+def update_exam_analytics(exam_id, before, after):
+    """
+    Swaps some students' contribution in an exam's cached analytics (no-op without a
+    cache). The write is conditional on the Version read; if another worker got there
+    first the cache is dropped and rebuilt on the next view rather than lost.
+    """
+    cached = db.session.query(ExamAnalytics.Stats, ExamAnalytics.Version).filter_by(ExamId=int(exam_id)).first()
+    if not cached:
+        return
+    stats = analytics.merge(json.loads(cached.Stats), analytics.accumulate(before), -1)
+    analytics.merge(stats, analytics.accumulate(after))
+    updated = ExamAnalytics.query.filter_by(ExamId=int(exam_id), Version=cached.Version).update({
+        ExamAnalytics.Stats: json.dumps(stats),
+        ExamAnalytics.Version: ExamAnalytics.Version + 1,
+        ExamAnalytics.UpdatedAt: datetime.utcnow()
+    }, synchronize_session=False)
+    if not updated:
+        ExamAnalytics.query.filter_by(ExamId=int(exam_id)).delete(synchronize_session=False)
+
+
+def exam_analytics(exam_id):
+    """
+    The exam's analytics sums, from the cache or, the first time, built from every
+    student's latest result (read EXPORT_CHUNK results at a time) and cached.
+    """
+    cached = db.session.query(ExamAnalytics.Stats).filter_by(ExamId=exam_id).scalar()
+    if cached:
+        return json.loads(cached)
 
+    query = db.session.query(Result.ResultId).filter(Result.ExamId == exam_id, latest_result_filter())
+    vectors, last_id = [], 0
+    while True:
+        chunk = [result_id for (result_id,) in query.filter(Result.ResultId > last_id)
+                 .order_by(Result.ResultId).limit(EXPORT_CHUNK)]
+        if not chunk:
+            break
+        last_id = chunk[-1]
+        vectors += result_vectors(chunk)
+    stats = analytics.accumulate(vectors)
+
+    try:
+        db.session.add(ExamAnalytics(ExamId=exam_id, Stats=json.dumps(stats)))
+        db.session.commit()
+    except IntegrityError:
+        # Built concurrently by another request; ours is just as good to return.
+        db.session.rollback()
+    return stats
+
+
+def upsert_students(graded):
+    """
+    {StudentCode: StudentId} for the codes of graded entries, inserting missing
+    students in one executemany.
+    """
+    codes = {g["code"] for g in graded if g["code"]}
+    student_ids = {}
+    if codes:
+        student_ids = dict(db.session.query(Student.StudentCode, Student.StudentId)
+                           .filter(Student.StudentCode.in_(codes)).all())
+        missing = {}
+        for g in graded:
+            if g["code"] and g["code"] not in student_ids:
+                missing.setdefault(g["code"], {
+                    "FullName": g["name"] or "Unknown",
+                    "StudentCode": g["code"],
+                    "Class": "Unknown"
+                })
+        if missing:
+            db.session.execute(db.insert(Student), list(missing.values()))
+            student_ids.update(db.session.query(Student.StudentCode, Student.StudentId)
+                               .filter(Student.StudentCode.in_(missing.keys())).all())
+
+    return student_ids
+
+
+def exam_key_images(key_id):
+    pages = ExamKeyPage.query.filter_by(KeyId=key_id).order_by(ExamKeyPage.PageNumber).all()
+    return [page.ImageData for page in pages]
+
+
+_key_transcription_locks = {}
+_key_transcription_locks_guard = threading.Lock()
+
+def exam_key_transcriptions(key_id, stats=None):
+    """
+    Structured per-page reading of an answer key, transcribed on first use and stored
+    on exam_key_pages so every later student and batch is graded against the same text.
+    """
+    if not KEY_TRANSCRIPTION:
+        return None
+
+    with _key_transcription_locks_guard:
+        lock = _key_transcription_locks.setdefault(key_id, threading.Lock())
+
+    with lock:
+        pages = ExamKeyPage.query.filter_by(KeyId=key_id).order_by(ExamKeyPage.PageNumber).all()
+        missing = [page for page in pages if page.Transcription is None]
+        if missing:
+            transcribed = transcribe_answer_key([page.ImageData for page in missing], stats)
+            for page, data in zip(missing, transcribed):
+                if data is not None:
+                    page.Transcription = json.dumps(data)
+            db.session.commit()
+
+        return [json.loads(page.Transcription) if page.Transcription else None for page in pages]
+
+
+def process_task_batch(tasks, depth=None):
+    """
+    Grades a batch of claimed tasks from one job, rendering up to `depth` submissions
+    ahead through the raster pool (default RASTER_QUEUE_DEPTH), then writes the batch's
+    students and results in one bulk persistence step.
+    """
+    with progress_broker.grading(tasks[0].JobId):
+        _grade_task_batch(tasks, depth)
+
+
+def _grade_task_batch(tasks, depth=None):
+    job = GradingJob.query.get(tasks[0].JobId)
+    task_ids = [task.TaskId for task in tasks]
+    attempts = {task.TaskId: task.Attempts for task in tasks}
+    regrades = {task.TaskId: {"result_id": task.RegradeResultId,
+                              "pages": {int(page) for page in task.RegradePages.split(",")}}
+                for task in tasks if task.RegradeResultId}
+    key_images = exam_key_images(job.KeyId)
+    key_stats = {"cache_hits": 0, "cache_misses": 0}
+    try:
+        with metrics.timed("key_transcription", key_stats):
+            key_transcriptions = exam_key_transcriptions(job.KeyId, key_stats)
+    except EndpointUnavailable as e:
+        db.session.rollback()
+        release_tasks(job.JobId, task_ids, str(e))
+        return
+    if key_stats["cache_hits"] or key_stats["cache_misses"]:
+        update_job(job.JobId, **job_stat_deltas(key_stats))
+    record_job_metrics(job.JobId, key_stats)
+
+    on_page = job_page_callback(job.JobId)
+    graded_tasks = []
+    graded = []
+
+    # A re-grade only renders the pages it sends to the model again.
+    submissions = rasterize_submissions([(task.Filename, task.FilePath) for task in tasks], depth,
+                                        profile=exam_render_profile(job.ExamId),
+                                        pages=[regrades[task.TaskId]["pages"] if task.TaskId in regrades else None
+                                               for task in tasks])
+    for position, (task_id, (student_filename, student_path, student_images, render_error)) in \
+            enumerate(zip(task_ids, submissions)):
+        cache_stats = {"cache_hits": 0, "cache_misses": 0}
+        try:
+            if render_error:
+                raise render_error
+            metrics.add_stat(cache_stats, "pages_rendered", sum(1 for image in student_images if image is not None))
+            update_job(job.JobId, PagesTotal=min(len(student_images), len(key_images)))
+            graded.append(grade_submission(job.ExamId, student_filename, student_images, key_images,
+                                           cache_stats, on_page, key_transcriptions, regrades.get(task_id)))
+            graded_tasks.append(task_id)
+        except EndpointUnavailable as e:
+            # The model endpoint is down, not this submission: hand the rest of the batch
+            # back untouched and keep what was already graded.
+            db.session.rollback()
+            print(f"Pausing job {job.JobId}: {str(e)}")
+            release_tasks(job.JobId, task_ids[position:], str(e))
+            update_job(job.JobId, **job_stat_deltas(cache_stats))
+            record_job_metrics(job.JobId, cache_stats)
+            break
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error grading {student_filename}: {str(e)}")
+            retry_or_fail_tasks(job.JobId, [task_id], attempts, str(e))
+
+        # Heartbeat the rest of the batch so its lease doesn't lapse while we work through it.
+        GradingTask.query.filter(GradingTask.TaskId.in_(task_ids), GradingTask.Status == 'running')\
+            .update({GradingTask.ClaimedAt: datetime.utcnow()}, synchronize_session=False)
+        if cache_stats.get("image_bytes"):
+            print(f"{student_filename}: sent {cache_stats['image_bytes'] / 1024:.0f} KB of page images, "
+                  f"~{cache_stats['image_tokens']} vision tokens")
+        update_job(job.JobId, **job_stat_deltas(cache_stats))
+        record_job_metrics(job.JobId, cache_stats)
+
+    if graded:
+        try:
+            with metrics.timed("db_persist"):
+                try:
+                    result_ids = persist_results(job.ExamId, graded, job.KeyId)
+                except IntegrityError:
+                    # Another worker inserted one of our new students first; its row is there now.
+                    db.session.rollback()
+                    result_ids = persist_results(job.ExamId, graded, job.KeyId)
+            now = datetime.utcnow()
+            db.session.execute(db.update(GradingTask), [{
+                "TaskId": task_id,
+                "Status": 'done',
+                "ResultId": result_id,
+                "Error": None if result_id else "Student ID not detected",
+                "FinishedAt": now
+            } for task_id, result_id in zip(graded_tasks, result_ids)])
+            update_job(job.JobId)
+            metrics.count("grading_tasks_total", len(graded_tasks), status="done")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error saving results for job {job.JobId}: {str(e)}")
+            retry_or_fail_tasks(job.JobId, graded_tasks, attempts, str(e))
+
+    finish_job_if_complete(job.JobId)
+
+
+def retry_or_fail_tasks(job_id, task_ids, attempts, error):
+    """Sends tasks back to the queue, or marks them failed once they've used up their attempts."""
+    now = datetime.utcnow()
+    for task_id in task_ids:
+        metrics.count("grading_tasks_total",
+                      status='retried' if attempts[task_id] < GRADING_MAX_ATTEMPTS else 'failed')
+    db.session.execute(db.update(GradingTask), [{
+        "TaskId": task_id,
+        "Status": 'queued' if attempts[task_id] < GRADING_MAX_ATTEMPTS else 'failed',
+        "ClaimedBy": None,
+        "Error": error,
+        "FinishedAt": None if attempts[task_id] < GRADING_MAX_ATTEMPTS else now
+    } for task_id in task_ids])
+    update_job(job_id)
+
+
+def release_tasks(job_id, task_ids, error):
+    """Returns claimed tasks to the queue without spending one of their attempts."""
+    GradingTask.query.filter(GradingTask.TaskId.in_(task_ids), GradingTask.Status == 'running')\
+        .update({
+            GradingTask.Status: 'queued',
+            GradingTask.ClaimedBy: None,
+            GradingTask.Attempts: GradingTask.Attempts - 1,
+            GradingTask.Error: error
+        }, synchronize_session=False)
+    update_job(job_id)
+
+
+def background_grading_task(job_id, worker_id=None):
+    """Drains one job in the calling thread. Workers use grading_worker_loop instead."""
+    worker_id = worker_id or WORKER_ID
+    while True:
+        tasks = claim_tasks(worker_id, job_id=job_id)
+        if not tasks:
+            break
+        process_task_batch(tasks)
+    finish_job_if_complete(job_id)
+
+
+def grading_worker_loop(worker_id):
+    with app.app_context():
+        while True:
+            try:
+                requeue_stale_tasks()
+                tasks = claim_tasks(worker_id)
+                if tasks:
+                    process_task_batch(tasks)
+                    continue
             except Exception as e:
                 db.session.rollback()
-                print(f"Error grading {student_filename}: {str(e)}")
+                print(f"Grading worker {worker_id} error: {str(e)}")
+            finally:
+                db.session.remove()
+            work_available.wait(GRADING_POLL_INTERVAL)
+            work_available.clear()
 
-        
-        grading_progress[session_id] = {
-            "current": total,
-            "total": total,
-            "filename": "Complete",
-            "done": True
-        }
+
+_workers_started = False
+
+def start_grading_workers():
+    """Starts this process's grading worker pool; unfinished tasks from before a restart are picked up first."""
+    global _workers_started
+    if _workers_started:
+        return
+    _workers_started = True
+    for n in range(GRADING_WORKERS):
+        threading.Thread(
+            target=grading_worker_loop,
+            args=(f"{WORKER_ID}-{n}",),
+            name=f"grading-worker-{n}",
+            daemon=True
+        ).start()
+
+
+def grading_sources(source):
+    """
+    Absolute paths of the PDFs to grade, in a stable order: every PDF under a
+    directory, or the paths listed one per line in a manifest file (relative paths
+    are relative to the manifest; blank lines and # comments are ignored).
+    """
+    source = os.path.abspath(source)
+    if os.path.isdir(source):
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(source)
+                      for name in names if name.lower().endswith(".pdf"))
+    paths = []
+    with open(source, encoding="utf-8") as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                paths.append(os.path.normpath(os.path.join(os.path.dirname(source), line)))
+    return paths
+
+
+def read_checkpoint(path):
+    """A grade-dir checkpoint's graded files as {path: size} and the job ids it started."""
+    graded, job_ids = {}, []
+    if not os.path.exists(path):
+        return graded, job_ids
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            if "job" in entry:
+                job_ids.append(entry["job"])
+            elif "path" in entry:
+                graded[entry["path"]] = entry.get("size")
+    return graded, job_ids
+
+
+def append_checkpoint(path, entries, lock):
+    with lock, open(path, "a", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def graded_entries(condition):
+    """Checkpoint entries for the tasks matching condition that were graded into a Result."""
+    done = db.session.query(GradingTask.FilePath, GradingTask.ResultId)\
+        .filter(condition, GradingTask.Status == 'done', GradingTask.ResultId.isnot(None)).all()
+    return [{"path": path, "size": os.path.getsize(path) if os.path.exists(path) else None,
+             "result_id": result_id} for path, result_id in done]
+
+
+def drain_job_with_checkpoint(job_id, worker_id, claim_size, depth, checkpoint_path, lock):
+    """background_grading_task for the CLI: records every graded file in the checkpoint as it finishes."""
+    with app.app_context():
+        try:
+            while True:
+                tasks = claim_tasks(worker_id, limit=claim_size, job_id=job_id)
+                if not tasks:
+                    break
+                task_ids = [task.TaskId for task in tasks]
+                process_task_batch(tasks, depth)
+                append_checkpoint(checkpoint_path, graded_entries(GradingTask.TaskId.in_(task_ids)), lock)
+        finally:
+            db.session.remove()
+
+
+@app.cli.command("grade-dir")
+@click.argument("source", type=click.Path(exists=True))
+@click.option("--exam-id", type=int, required=True, help="Exam the scans belong to.")
+@click.option("--key", "key_path", type=click.Path(exists=True, dir_okay=False),
+              help="Answer key PDF (default: the exam's last key).")
+@click.option("--checkpoint", "checkpoint_path", help="Progress file (default: grade-dir-exam<ID>.jsonl).")
+@click.option("--workers", default=4, show_default=True, help="Submissions graded at once.")
+@click.option("--claim-size", default=25, show_default=True, help="Submissions per claim and bulk write.")
+def grade_dir_command(source, exam_id, key_path, checkpoint_path, workers, claim_size):
+    """
+    Grade every PDF in SOURCE (a directory, or a manifest listing one PDF per line).
+    Re-running with the same checkpoint skips files graded already, so an interrupted
+    run resumes where it stopped.
+    """
+    if not Exam.query.get(exam_id):
+        raise click.ClickException(f"Exam {exam_id} not found.")
+    if key_path:
+        with open(key_path, "rb") as f:
+            exam_key = get_exam_key(exam_id, FileStorage(f, filename=os.path.basename(key_path)))
+    else:
+        exam_key = get_exam_key(exam_id)
+    if not exam_key:
+        raise click.ClickException(f"Exam {exam_id} has no answer key yet; pass --key.")
+
+    checkpoint_path = checkpoint_path or f"grade-dir-exam{exam_id}.jsonl"
+    lock = threading.Lock()
+    graded, old_jobs = read_checkpoint(checkpoint_path)
+    if old_jobs:
+        # A crash can land between saving a batch and checkpointing it: the task rows are
+        # the record of what was graded, so the checkpoint is completed from them first.
+        recovered = [entry for entry in graded_entries(GradingTask.JobId.in_(old_jobs))
+                     if graded.get(entry["path"]) != entry["size"]]
+        if recovered:
+            append_checkpoint(checkpoint_path, recovered, lock)
+            graded.update((entry["path"], entry["size"]) for entry in recovered)
+            print(f"Recovered {len(recovered)} graded file(s) missing from the checkpoint.")
+        # Tasks an interrupted run left behind are graded again below, not by the web workers.
+        GradingTask.query.filter(GradingTask.JobId.in_(old_jobs), GradingTask.Status.in_(['queued', 'running']))\
+            .update({GradingTask.Status: 'failed', GradingTask.Error: "Superseded by a resumed grade-dir run",
+                     GradingTask.FinishedAt: datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        for old_job in old_jobs:
+            finish_job_if_complete(old_job)
+
+    sources = grading_sources(source)
+    pending = [path for path in sources if graded.get(path) != os.path.getsize(path)]
+    print(f"{len(sources)} PDF(s) found, {len(sources) - len(pending)} already graded, {len(pending)} to grade.")
+    if not pending:
+        return
+
+    job_id = f"cli-{uuid.uuid4()}"
+    append_checkpoint(checkpoint_path, [{"job": job_id}], lock)
+    base = source if os.path.isdir(source) else os.path.dirname(os.path.abspath(source))
+    enqueue_grading_job(job_id, exam_id, exam_key, [(os.path.relpath(path, base)[:255], path) for path in pending],
+                        source='cli')
+
+    # Each worker keeps the raster pool (one process per core) busy ahead of its grading.
+    depth = max(RASTER_QUEUE_DEPTH, -(-RASTER_WORKERS // max(workers, 1)))
+    start = time.monotonic()
+    threads = [threading.Thread(target=drain_job_with_checkpoint, name=f"grade-dir-{n}",
+                                args=(job_id, f"{WORKER_ID}-cli-{n}", claim_size, depth, checkpoint_path, lock))
+               for n in range(max(workers, 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    finish_job_if_complete(job_id)
+
+    counts = dict(db.session.query(GradingTask.Status, db.func.count(GradingTask.TaskId))
+                  .filter(GradingTask.JobId == job_id).group_by(GradingTask.Status).all())
+    print(f"Graded {counts.get('done', 0)} of {len(pending)} in {time.monotonic() - start:.0f}s; "
+          f"{counts.get('failed', 0)} failed (re-run to retry them). Progress: {checkpoint_path}")
+
+
+def job_progress(job_id):
+    """Progress payload for the loading page, read from the shared job tables."""
+    job = GradingJob.query.get(job_id)
+    if not job:
+        return None
+
+    counts = dict(db.session.query(GradingTask.Status, db.func.count(GradingTask.TaskId))
+                  .filter(GradingTask.JobId == job_id).group_by(GradingTask.Status).all())
+    finished = counts.get('done', 0) + counts.get('failed', 0)
+    running = GradingTask.query.filter_by(JobId=job_id, Status='running')\
+        .order_by(GradingTask.Position).first()
+
+    done = job.Status == 'done'
+    queue_depth = GradingTask.query.join(GradingJob, GradingTask.JobId == GradingJob.JobId)\
+        .filter(GradingTask.Status == 'queued', GradingJob.Status != 'done').count()
+    return {
+        "version": job.Version,
+        "current": job.Total if done else min(finished + (1 if running else 0), job.Total),
+        "total": job.Total,
+        "filename": "Complete" if done else (running.Filename if running else "Waiting in queue..."),
+        "done": done,
+        "failed": counts.get('failed', 0),
+        "pages_done": job.PagesDone,
+        "pages_total": job.PagesTotal,
+        "cache": {"cache_hits": job.CacheHits, "cache_misses": job.CacheMisses},
+        "images": {"bytes": job.ImageBytes, "tokens": job.ImageTokens},
+        "queue_depth": queue_depth,
+        "eta_seconds": 0 if done else job_eta(job, finished)
+    }
+
+
+def job_eta(job, finished):
+    """
+    Seconds until the job is likely done: its own throughput once it has finished a
+    task, else the recent throughput of all jobs divided between the running ones.
+    None until there's anything to go on.
+    """
+    remaining = job.Total - finished
+    now = datetime.utcnow()
+    if finished and job.StartedAt:
+        elapsed = max((now - job.StartedAt).total_seconds(), 1.0)
+        return round(remaining * elapsed / finished)
+
+    recent = GradingTask.query.filter(GradingTask.FinishedAt >= now - timedelta(seconds=ETA_WINDOW)).count()
+    if not recent:
+        return None
+    running_jobs = max(GradingJob.query.filter_by(Status='running').count(), 1)
+    return round(remaining * ETA_WINDOW * running_jobs / recent)
+
+
+class ProgressBroker:
+    """
+    In-process pub/sub for grading progress. Each job has a condition on a shared
+    lock; publish() stores the job's latest payload under its DB Version and wakes
+    only that job's listeners, so idle streams cost nothing between changes. Jobs
+    being graded in this process are tracked too: their listeners are woken by every
+    update and never need to read the job row.
+    """
+
+    def __init__(self, retention=600):
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._conditions = {}
+        self._latest = {}
+        self._grading = {}
+
+    @contextmanager
+    def grading(self, job_id):
+        """Marks job_id as being graded by this process for the duration of the block."""
+        with self._lock:
+            self._grading[job_id] = self._grading.get(job_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._grading[job_id] -= 1
+                if not self._grading[job_id]:
+                    del self._grading[job_id]
+
+    def graded_here(self, job_id):
+        with self._lock:
+            return job_id in self._grading
+
+    def publish(self, job_id, version, payload):
+        with self._lock:
+            current = self._latest.get(job_id)
+            if current and current[0] >= version:
+                return
+            self._latest[job_id] = (version, payload, time.monotonic())
+            condition = self._conditions.get(job_id)
+            if condition:
+                condition.notify_all()
+            self._prune()
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.retention
+        for job_id, (_, payload, published_at) in list(self._latest.items()):
+            if payload.get("done") and published_at < cutoff:
+                del self._latest[job_id]
+                self._conditions.pop(job_id, None)
+
+    def latest(self, job_id):
+        with self._lock:
+            event = self._latest.get(job_id)
+            return event[:2] if event else None
+
+    def wait(self, job_id, after_version, timeout):
+        """Blocks until job_id has an event newer than after_version; returns (version, payload) or None."""
+        with self._lock:
+            condition = self._conditions.setdefault(job_id, threading.Condition(self._lock))
+            newer = lambda: job_id in self._latest and self._latest[job_id][0] > after_version
+            if not condition.wait_for(newer, timeout):
+                return None
+            return self._latest[job_id][:2]
+
+
+progress_broker = ProgressBroker()
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape target for this process's grading pipeline metrics."""
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/grading/jobs/<job_id>/metrics")
+def job_metrics(job_id):
+    if not session.get('logged_in'):
+        return jsonify({"error": "login required"}), 401
+
+    values = dict(db.session.query(JobMetric.Name, JobMetric.Value).filter_by(JobId=job_id).all())
+    return jsonify({"job_id": job_id, "metrics": values})
+
+
+@app.route("/grading/progress/<session_id>/poll")
+def grading_progress_poll(session_id):
+    """One progress snapshot, for loading pages refused a stream."""
+    return jsonify(job_progress(session_id) or {"done": True, "error": "Unknown grading job"})
+
+
+@app.route("/grading/progress/<session_id>")
+def grading_progress_stream(session_id):
+    if not progress_streams.acquire(blocking=False):
+        return Response("Too many progress streams, poll instead.\n", status=503, mimetype="text/plain")
+    # EventSource sends Last-Event-ID on reconnect, so a dropped stream resumes without replays.
+    last_event_id = request.headers.get("Last-Event-ID", type=int) or request.args.get("last_event_id", 0, type=int)
+
+    def read_shared_progress(after_version, first):
+        # The job may be graded by another process; its Version on the shared row tells us if anything changed.
+        version = db.session.query(GradingJob.Version).filter_by(JobId=session_id).scalar()
+        event = None
+        if version is None:
+            event = (after_version, {"done": True, "error": "Unknown grading job"})
+        elif version > after_version or first:
+            progress = job_progress(session_id)
+            if version > after_version or progress["done"] or not after_version:
+                event = (progress["version"], progress)
+        # End the transaction so the next read sees the workers' commits.
+        db.session.rollback()
+        return event
+
+    def generate():
+        version = last_event_id
+        last_sent = time.monotonic()
+        event = read_shared_progress(version, first=True)
+        yield "retry: 3000\n\n"
+
+        while True:
+            if event:
+                version, progress = event
+                yield f"id: {version}\ndata: {json.dumps(progress)}\n\n"
+                last_sent = time.monotonic()
+                if progress.get("done"):
+                    break
+            elif time.monotonic() - last_sent >= PROGRESS_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+
+            event = progress_broker.wait(session_id, version, PROGRESS_DB_POLL)
+            # Only a job graded by another process (or not at all right now) needs the DB read.
+            if event is None and not progress_broker.graded_here(session_id):
+                event = read_shared_progress(version, first=False)
+    
+    response = Response(stream_with_context(generate()),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Called when the server closes the response, even if the stream never started.
+    response.call_on_close(progress_streams.release)
+    return response
 
 @app.route("/grading", methods=["GET", "POST"])
 def grading():
@@ -241,37 +1744,32 @@ def grading():
         key_file = request.files.get("key")
         exam_id = request.form.get("exam_id")
         session_id = request.form.get("session_id") or str(uuid.uuid4())
-        total = len(student_files)
-
-        if student_files and key_file and exam_id:
-            
-            key_path = os.path.join(UPLOAD_FOLDER, secure_filename(key_file.filename))
-            key_file.save(key_path)
-            key_images = pdf_to_base64_images(key_path)
-
-            
-            student_files_data = []
-            for student_file in student_files:
-                student_filename = secure_filename(student_file.filename)
-                student_path = os.path.join(UPLOAD_FOLDER, student_filename)
-                student_file.save(student_path)
-                student_files_data.append((student_filename, student_path))
-
-            
-            grading_progress[session_id] = {
-                "current": 0,
-                "total": total,
-                "filename": "Initializing...",
-                "done": False
-            }
-
-            
-            threading.Thread(
-                target=background_grading_task, 
-                args=(student_files_data, key_images, exam_id, session_id, total)
-            ).start()
-
-            # 4. Return immediately! Render a loading template that listens to the progress stream
+        if GradingJob.query.get(session_id):
+            session_id = str(uuid.uuid4())
+
+        exam_key = None
+        if student_files and exam_id:
+            exam_key = get_exam_key(int(exam_id), key_file)
+
+        if student_files and exam_key and exam_id:
+            # Werkzeug has already spooled large uploads to disk; copy them into the store
+            # in chunks instead of reading them whole, one file (or ZIP member) at a time.
+            pages_per_student = request.form.get("pages_per_student", type=int)
+            stored = upload_store.ingest([(f.filename, f.stream) for f in student_files if f.filename],
+                                         UPLOAD_STORE, pages_per_student if pages_per_student and pages_per_student > 0 else None)
+            student_files_data, skipped = new_submissions(int(exam_id), stored)
+            if not student_files_data:
+                message = (f"All {skipped} uploaded file(s) were already graded or queued for this exam."
+                           if skipped else "No PDF files were found in the upload.")
+                return render_template("grading.html", results_list=[], exams=all_exams,
+                                       selected_exam_id=int(exam_id), message=message)
+            if skipped:
+                print(f"Skipped {skipped} duplicate upload(s) for exam {exam_id}.")
+
+            enqueue_grading_job(session_id, int(exam_id), exam_key, student_files_data, session.get('user_id'))
+            collect_uploads()
+
+            # Return immediately! Render a loading template that listens to the progress stream
             return render_template("loading.html", session_id=session_id, exam_id=exam_id)
 
     return render_template("grading.html", results_list=[], exams=all_exams, selected_exam_id=selected_exam_id)
@@ -282,6 +1780,92 @@ def logout():
     return redirect(url_for('login'))
 
 
+def page_size(args):
+    try:
+        return max(1, min(int(args.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE))
+    except ValueError:
+        return PAGE_SIZE
+
+
+def float_arg(args, name):
+    try:
+        return float(args[name]) if args.get(name) else None
+    except ValueError:
+        return None
+
+
+def search_filter(query, args):
+    """
+    Student name/code search and class filter shared by both listings. The search
+    matches the start of the name or code, so it can seek the FullName and StudentCode
+    indexes instead of scanning every student.
+    """
+    if args.get("q"):
+        escaped = re.sub(r'([\\%_\[])', r'\\\1', args['q'].strip())
+        pattern = f"{escaped}%"
+        query = query.filter(db.or_(Student.FullName.like(pattern, escape='\\'),
+                                    Student.StudentCode.like(pattern, escape='\\')))
+    if args.get("class"):
+        query = query.filter(Student.Class == args["class"])
+    return query
+
+
+def results_page(args):
+    """
+    One page of (Result, Student, Exam) rows, newest first, and the cursor of the next page.
+    The cursor is "<GradedAt ISO>_<ResultId>" of the last row; the next page continues
+    strictly after it, so rows aren't skipped or repeated when new results arrive.
+    """
+    limit = page_size(args)
+    query = db.session.query(Result, Student, Exam)\
+        .join(Student, Result.StudentId == Student.StudentId)\
+        .join(Exam, Result.ExamId == Exam.ExamId)
+
+    if args.get("exam", "").isdigit():
+        query = query.filter(Result.ExamId == int(args["exam"]))
+    min_score, max_score = float_arg(args, "min_score"), float_arg(args, "max_score")
+    if min_score is not None:
+        query = query.filter(Result.Score >= min_score)
+    if max_score is not None:
+        query = query.filter(Result.Score <= max_score)
+    query = search_filter(query, args)
+
+    if args.get("after"):
+        try:
+            graded_at, result_id = args["after"].rsplit("_", 1)
+            graded_at, result_id = datetime.fromisoformat(graded_at), int(result_id)
+        except ValueError:
+            graded_at = None
+        if graded_at:
+            query = query.filter(db.or_(
+                Result.GradedAt < graded_at,
+                db.and_(Result.GradedAt == graded_at, Result.ResultId < result_id)
+            ))
+
+    rows = query.order_by(Result.GradedAt.desc(), Result.ResultId.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        next_cursor = f"{last.GradedAt.isoformat()}_{last.ResultId}"
+    return rows, next_cursor
+
+
+def students_page(args):
+    """One page of students in id order, and the id to continue after (or None)."""
+    limit = page_size(args)
+    query = search_filter(Student.query, args)
+    if args.get("after", "").isdigit():
+        query = query.filter(Student.StudentId > int(args["after"]))
+
+    rows = query.order_by(Student.StudentId).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = str(rows[-1].StudentId)
+    return rows, next_cursor
+
+
 @app.route("/students", methods=["GET", "POST"])
 def students():
     if not session.get('logged_in'):
@@ -302,8 +1886,26 @@ def students():
             db.session.add(new_student)
             db.session.commit()
     
-    all_students = Student.query.all()
-    return render_template("students.html", students=all_students)
+    page, next_cursor = students_page(request.args)
+    return render_template("students.html", students=page, next_cursor=next_cursor,
+                           filters=request.args)
+
+
+@app.route("/api/students")
+def students_api():
+    if not session.get('logged_in'):
+        return jsonify({"error": "login required"}), 401
+
+    page, next_cursor = students_page(request.args)
+    return jsonify({
+        "items": [{
+            "id": student.StudentId,
+            "name": student.FullName,
+            "code": student.StudentCode,
+            "class": student.Class
+        } for student in page],
+        "next": next_cursor
+    })
 
 
 @app.route("/students/delete/<student_id>")
@@ -313,6 +1915,8 @@ def delete_student(student_id):
     
     student = Student.query.get(student_id)
     if student:
+        exam_ids = db.session.query(Result.ExamId).filter_by(StudentId=student.StudentId).distinct()
+        ExamAnalytics.query.filter(ExamAnalytics.ExamId.in_(exam_ids)).delete(synchronize_session=False)
         db.session.delete(student)
         db.session.commit()
     return redirect(url_for('students'))
@@ -341,12 +1945,117 @@ def results():
     if not session.get('logged_in'):
         return redirect(url_for('login'))
 
-    all_results = db.session.query(Result, Student, Exam)\
+    page, next_cursor = results_page(request.args)
+    exams = Exam.query.order_by(Exam.ExamDate.desc()).all()
+    return render_template("results.html", results=page, next_cursor=next_cursor, exams=exams,
+                           filters=request.args)
+
+
+@app.route("/api/results")
+def results_api():
+    if not session.get('logged_in'):
+        return jsonify({"error": "login required"}), 401
+
+    page, next_cursor = results_page(request.args)
+    return jsonify({
+        "items": [{
+            "id": result.ResultId,
+            "name": student.FullName,
+            "code": student.StudentCode,
+            "exam": f"{exam.Subject} — {exam.Title}",
+            "score": result.Score,
+            "graded_at": result.GradedAt.strftime('%Y-%m-%d %H:%M')
+        } for result, student, exam in page],
+        "next": next_cursor
+    })
+
+def export_rows(exam_id, per_question=False, all_results=False):
+    """
+    Yields the header and then one row per result of an exam: each student's latest
+    result, or every result with all_results. per_question adds the points earned on
+    every question the exam's items know about. Results are read EXPORT_CHUNK at a time
+    by ResultId, each chunk a short query of its own, so memory stays flat and no
+    cursor is held open while the client reads.
+    """
+    questions = []
+    if per_question:
+        questions = db.session.query(ResultItem.PageNumber, ResultItem.QuestionId)\
+            .join(Result, ResultItem.ResultId == Result.ResultId)\
+            .filter(Result.ExamId == exam_id).distinct()\
+            .order_by(ResultItem.PageNumber, ResultItem.QuestionId).all()
+    repeated = {qid for _, qid in questions if sum(1 for _, other in questions if other == qid) > 1}
+    yield (["Student Code", "Full Name", "Class", "Score", "Graded At", "Result Id"]
+           + [f"{qid} (page {page})" if qid in repeated else qid for page, qid in questions])
+
+    query = db.session.query(Result.ResultId, Result.Score, Result.GradedAt,
+                             Student.StudentCode, Student.FullName, Student.Class)\
         .join(Student, Result.StudentId == Student.StudentId)\
-        .join(Exam, Result.ExamId == Exam.ExamId)\
-        .order_by(Result.GradedAt.desc()).all()
+        .filter(Result.ExamId == exam_id)
+    if not all_results:
+        query = query.filter(latest_result_filter())
+
+    last_id = 0
+    while True:
+        chunk = query.filter(Result.ResultId > last_id).order_by(Result.ResultId).limit(EXPORT_CHUNK).all()
+        if not chunk:
+            break
+        last_id = chunk[-1].ResultId
+
+        points = {}
+        if questions:
+            for result_id, page, qid, earned in db.session.query(
+                    ResultItem.ResultId, ResultItem.PageNumber, ResultItem.QuestionId, ResultItem.PointsEarned)\
+                    .filter(ResultItem.ResultId.in_([row.ResultId for row in chunk])):
+                points[(result_id, page, qid)] = points.get((result_id, page, qid), 0.0) + earned
+
+        for row in chunk:
+            yield ([row.StudentCode, row.FullName, row.Class, row.Score, row.GradedAt, row.ResultId]
+                   + [points.get((row.ResultId, page, qid)) for page, qid in questions])
+
+
+@app.route("/exams/<int:exam_id>/export")
+def export_exam_results(exam_id):
+    """Streams an exam's results as CSV (default) or ?format=xlsx; ?questions=1 adds per-question points."""
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+
+    exam = Exam.query.get(exam_id)
+    if not exam:
+        return jsonify({"error": "Unknown exam"}), 404
+    export_format = request.args.get("format", "csv")
+    if export_format not in ("csv", "xlsx"):
+        return jsonify({"error": "format must be csv or xlsx"}), 400
+
+    rows = export_rows(exam_id, request.args.get("questions") == "1", request.args.get("all") == "1")
+    filename = f"{secure_filename(exam.Title) or 'exam'}_{exam_id}_results.{export_format}"
+    if export_format == "xlsx":
+        body, mimetype = xlsx_stream(rows, exam.Title or "Results"), XLSX_MIMETYPE
+    else:
+        body, mimetype = csv_stream(rows), "text/csv"
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"',
+                             "X-Accel-Buffering": "no"})
+
+
+@app.route("/api/exams/<int:exam_id>/analytics")
+def exam_analytics_api(exam_id):
+    if not session.get('logged_in'):
+        return jsonify({"error": "login required"}), 401
+    if not Exam.query.get(exam_id):
+        return jsonify({"error": "Unknown exam"}), 404
+    return jsonify(analytics.summarize(exam_analytics(exam_id)))
+
+
+@app.route("/exams/<int:exam_id>/analytics")
+def exam_analytics_view(exam_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    exam = Exam.query.get(exam_id)
+    if not exam:
+        return redirect(url_for('exams'))
+    return render_template("analytics.html", exam=exam, summary=analytics.summarize(exam_analytics(exam_id)))
+
 
-    return render_template("results.html", results=all_results)
 @app.route("/results/<int:result_id>")
 def view_result(result_id):
     if not session.get('logged_in'):
@@ -359,6 +2068,18 @@ def view_result(result_id):
     return render_template("view_result.html", result=result, student=student, exam=exam)
 
 
+def create_app():
+    """
+    The server entry point (gunicorn "app:create_app()"): starts this process's
+    grading workers and returns the app. Importing the module touches neither the
+    database nor the model client, so a worker boots even while SQL Server is
+    briefly unreachable; `flask --app app init-db` sets the database up once.
+    """
+    if GRADING_WORKERS > 0:
+        start_grading_workers()
+    return app
+
+
 if __name__ == "__main__":
     is_debug = os.environ.get('FLASK_DEBUG') == 'True'
-    app.run(debug=is_debug)
\ No newline at end of file
+    create_app().run(debug=is_debug)
\ No newline at end of file
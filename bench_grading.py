@@ -0,0 +1,328 @@
+"""
+End-to-end grading benchmark against a local stand-in for the model endpoint.
+
+Generates N synthetic student PDFs of M pages (plus a key) with fitz, serves an
+OpenAI-compatible /chat/completions with configurable latency, 429 injection and
+token accounting, then times either the whole queue (enqueue_grading_job +
+background_grading_task) or grade_batch_exams alone, and reports pages per
+minute, peak RSS, request counts and per-stage time.
+
+    python bench_grading.py --students 30 --pages 4 --latency 0.8 --rate-429 0.05
+    python bench_grading.py --mode grade --json out.json --baseline before.json
+"""
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fitz
+
+
+class FakeModelServer:
+    """
+    OpenAI-compatible chat completions on localhost. Answers grading, key transcription
+    and identity prompts with well-formed JSON after `latency` (+/- `jitter`) seconds,
+    and answers a `rate_429` share of requests with 429 + retry-after-ms.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.2, rate_429=0.0, retry_after_ms=200, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)  # nosec B311 - reproducible simulated latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.images = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def answer(self, content):
+        """The JSON body a well-behaved model would return for this request."""
+        texts = [part["text"] for part in content if part["type"] == "text"]
+        prompt = texts[0] if texts else ""
+        label = next((t for t in reversed(texts) if "(PAGE " in t or "ANSWER KEY" in t), "")
+        match = re.search(r"PAGE (\d+)", label)
+        page_num = int(match.group(1)) if match else 1
+
+        if prompt.startswith("You are transcribing an official exam ANSWER KEY"):
+            return {"requires_key_image": False, "questions": [
+                {"question_id": f"Q{page_num}-{n}", "question_type": "multiple_choice",
+                 "expected_answer": "b", "points_possible": 1.0} for n in range(1, 6)
+            ]}
+        if "PACKED OUTPUT FORMAT" in prompt:
+            pages = []
+            identity = False
+            for text in texts:
+                section = re.match(r"--- (.+) \(PAGE (\d+)\) ---$", text)
+                if section and section.group(1) != "OFFICIAL ANSWER KEY":
+                    pages.append(dict(self.grade_page(int(section.group(2)), identity),
+                                      student=section.group(1), page=int(section.group(2))))
+                    identity = False
+                identity = identity or "student_id" in text
+            return {"pages": pages}
+        if prompt.startswith("Look at this exam paper"):
+            return {"student_id": f"{self.random.randint(10**7, 10**8 - 1)}", "student_name": "Bench Student"}
+
+        return self.grade_page(page_num, any("student_id" in text for text in texts))
+
+    def grade_page(self, page_num, identity):
+        """One page in the {"questions": [...]} schema, with student_id/name when asked."""
+        body = {"questions": [{
+            "question_id": f"Q{page_num}-{n}",
+            "key_literal_transcription": "b",
+            "student_literal_transcription": "b" if n % 3 else "c",
+            "step_by_step_analysis": "Compared the marked letter with the key.",
+            "verdict": "CORRECT" if n % 3 else "INCORRECT",
+            "points_possible": 1.0,
+            "points_earned": 1.0 if n % 3 else 0.0
+        } for n in range(1, 6)]}
+        if identity:
+            with self.lock:
+                body["student_id"] = f"{self.random.randint(10**7, 10**8 - 1)}"
+            body["student_name"] = "Bench Student"
+        return body
+
+    def _handler(self):
+        bench = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                content = request["messages"][0]["content"]
+                with bench.lock:
+                    bench.requests += 1
+                    limited = bench.random.random() < bench.rate_429
+                    delay = max(0.0, bench.latency + bench.random.uniform(-bench.jitter, bench.jitter))
+                if limited:
+                    with bench.lock:
+                        bench.rate_limited += 1
+                    self._send(429, {"error": {"message": "Rate limit exceeded", "code": "429"}},
+                               {"retry-after-ms": str(bench.retry_after_ms)})
+                    return
+
+                time.sleep(delay)
+                answer = json.dumps(bench.answer(content))
+                images = sum(1 for part in content if part["type"] == "image_url")
+                prompt_tokens = sum(len(part.get("text", "")) // 4 for part in content) + 765 * images
+                completion_tokens = len(answer) // 4
+                with bench.lock:
+                    bench.images += images
+                    bench.prompt_tokens += prompt_tokens
+                    bench.completion_tokens += completion_tokens
+                self._send(200, {
+                    "id": f"chatcmpl-bench-{bench.requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "gpt-4o"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": answer}}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                              "total_tokens": prompt_tokens + completion_tokens}
+                })
+
+            def _send(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+def make_exam_pdf(path, pages, seed):
+    """Writes a synthetic exam: a name/ID header, five questions and an answer table per page."""
+    rng = random.Random(seed)  # nosec B311 - reproducible fake answers
+    doc = fitz.open()
+    for page_num in range(1, pages + 1):
+        page = doc.new_page(width=595, height=842)
+        if page_num == 1:
+            page.insert_text((60, 60), f"Name: Student {seed}    ID: {20200000 + seed}", fontsize=14)
+        for n in range(5):
+            y = 140 + n * 110
+            page.insert_text((60, y), f"Q{page_num}-{n + 1}. Which instruction loads a word?", fontsize=12)
+            for c, choice in enumerate("abcd"):
+                page.insert_text((80, y + 20 + c * 18), f"{choice}) option {choice}", fontsize=11)
+            circled = rng.randrange(4)
+            page.draw_circle((84, y + 16 + circled * 18), 8, color=(0, 0, 0.8), width=1.5)
+    doc.save(path)
+    doc.close()
+
+
+def peak_rss_mb():
+    """Peak resident set of this process and its (raster pool) children, in MB."""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round((own + children) / scale, 1)
+
+
+def run(args):
+    """Runs one benchmark and returns its report as a dict."""
+    server = FakeModelServer(args.latency, args.jitter, args.rate_429, args.retry_after_ms, args.seed).start()
+    os.environ["LLM_BASE_URL"] = server.url
+    os.environ.setdefault("GITHUB_TOKEN", "bench-token")
+    os.environ.setdefault("TESTING", "True")
+    os.environ.setdefault("GRADING_WORKERS", "0")
+    if args.raster_workers is not None:
+        os.environ["RASTER_WORKERS"] = str(args.raster_workers)
+
+    import demo_ai
+    import metrics
+
+    workdir = tempfile.mkdtemp(prefix="bench_grading_")
+    demo_ai.llm_gateway = demo_ai.LLMGateway(server.url, demo_ai.LLM_MAX_IN_FLIGHT, demo_ai.LLM_CIRCUIT_FAILURES,
+                                             demo_ai.LLM_CIRCUIT_RESET, demo_ai.LLM_CIRCUIT_MAX_WAIT)
+    demo_ai.rate_limiter = demo_ai.RateLimiter(args.rpm, args.tpm)
+    demo_ai.RATE_LIMIT_BACKOFF = min(demo_ai.RATE_LIMIT_BACKOFF, 1.0)
+    demo_ai.GRADING_PACK_WIDTH = args.pack_width
+    demo_ai.GRADING_PACK_MODE = args.pack_mode
+    # A fresh cache per run, so nothing is replayed from an earlier benchmark.
+    demo_ai.response_cache = demo_ai.ResponseCache(os.path.join(workdir, "llm_cache"), 1 << 30)
+
+    key_path = os.path.join(workdir, "key.pdf")
+    make_exam_pdf(key_path, args.pages, seed=0)
+    student_paths = []
+    for n in range(args.students):
+        path = os.path.join(workdir, f"student_{n:04d}.pdf")
+        make_exam_pdf(path, args.pages, seed=n + 1)
+        student_paths.append(path)
+
+    start = time.perf_counter()
+    if args.mode == "pipeline":
+        from werkzeug.datastructures import FileStorage
+        import app as app_module
+
+        with app_module.app.app_context():
+            app_module.init_db()
+            exam = app_module.Exam(CreatedBy=1, Subject="Bench", Title=f"Bench {time.time():.0f}")
+            app_module.db.session.add(exam)
+            app_module.db.session.commit()
+            with open(key_path, "rb") as f:
+                exam_key = app_module.get_exam_key(exam.ExamId, FileStorage(f, filename="key.pdf"))
+            job_id = f"bench-{os.getpid()}-{int(time.time() * 1000)}"
+            start = time.perf_counter()
+            app_module.enqueue_grading_job(job_id, exam.ExamId, exam_key,
+                                           [(os.path.basename(p), p) for p in student_paths])
+            app_module.background_grading_task(job_id)
+            failed = app_module.GradingTask.query.filter_by(JobId=job_id, Status='failed').count()
+    else:
+        from render import iter_rendered_pages
+
+        key_images = list(iter_rendered_pages(key_path))
+        submissions = {os.path.basename(p): list(iter_rendered_pages(p)) for p in student_paths}
+        demo_ai.grade_batch_exams(submissions, key_images, {})
+        failed = 0
+    elapsed = time.perf_counter() - start
+    server.stop()
+
+    pages = args.students * args.pages
+    stages = {dict(labels).get("stage", "?"): round(total, 3)
+              for labels, (total, _) in metrics.registry.sums("grading_stage_seconds").items()}
+    return {
+        "mode": args.mode,
+        "students": args.students,
+        "pages_per_student": args.pages,
+        "latency": args.latency,
+        "rate_429": args.rate_429,
+        "pack": f"{args.pack_mode} x{args.pack_width}",
+        "seconds": round(elapsed, 2),
+        "pages_per_minute": round(pages * 60 / elapsed, 1),
+        "peak_rss_mb": peak_rss_mb(),
+        "requests": server.requests,
+        "requests_per_student": round(server.requests / max(args.students, 1), 2),
+        "rate_limited": server.rate_limited,
+        "images_sent": server.images,
+        "prompt_tokens": server.prompt_tokens,
+        "completion_tokens": server.completion_tokens,
+        "failed_tasks": failed,
+        "stage_seconds": dict(sorted(stages.items(), key=lambda item: -item[1]))
+    }
+
+
+def print_report(report, baseline=None):
+    print(f"\n=== bench_grading: {report['mode']} — {report['students']} students x "
+          f"{report['pages_per_student']} pages, packing {report['pack']} ===")
+    for name in ("seconds", "pages_per_minute", "peak_rss_mb", "requests", "requests_per_student",
+                 "rate_limited", "images_sent", "prompt_tokens", "completion_tokens", "failed_tasks"):
+        line = f"{name:>22}: {report[name]}"
+        if baseline and isinstance(baseline.get(name), (int, float)) and baseline[name]:
+            change = (report[name] - baseline[name]) * 100.0 / baseline[name]
+            line += f"   ({change:+.1f}% vs baseline {baseline[name]})"
+        print(line)
+    print("          stage seconds:")
+    for stage, seconds in report["stage_seconds"].items():
+        print(f"{stage:>22}: {seconds}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=("pipeline", "grade"), default="pipeline",
+                        help="pipeline: queue + workers + DB; grade: grade_batch_exams only")
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.5, help="fake model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after-ms", type=int, default=200)
+    parser.add_argument("--rpm", type=int, default=100000, help="client-side rate limiter budget")
+    parser.add_argument("--tpm", type=int, default=100000000)
+    parser.add_argument("--pack-width", type=int, default=1, help="pages per model request")
+    parser.add_argument("--pack-mode", choices=("pages", "students"), default="pages")
+    parser.add_argument("--raster-workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="earlier --json report to compare against")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="exit 1 if pages/minute drops more than this percent below the baseline")
+    args = parser.parse_args(argv)
+    if args.pack_mode == "students" and args.mode == "pipeline":
+        # The queue grades one student per grade_batch_exams call, so there is nothing to pack across.
+        parser.error("--pack-mode students needs --mode grade")
+
+    report = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline and args.max_regression is not None:
+        floor = baseline["pages_per_minute"] * (1 - args.max_regression / 100.0)
+        if report["pages_per_minute"] < floor:
+            print(f"REGRESSION: {report['pages_per_minute']} pages/min is below {floor:.1f}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,38 +2,667 @@ import os
 import time
 import json
 import re
-from openai import OpenAI
+import hashlib
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
 
 
-def grade_batch_exams(student_submissions, key_images):
+# Endpoint budget. GitHub Models / Azure inference enforce both a requests-per-minute
+# and a tokens-per-minute limit, so the limiter below tracks both. GRADING_RPM and
+# GRADING_TPM are the budget of the whole deployment: the limiter lives in one process,
+# so each of the GRADING_PROCESSES processes sharing the endpoint (gunicorn's
+# WEB_CONCURRENCY by default) gets an equal share of it.
+GRADING_RPM = int(os.getenv("GRADING_RPM", "10"))
+GRADING_TPM = int(os.getenv("GRADING_TPM", "60000"))
+GRADING_PROCESSES = max(int(os.getenv("GRADING_PROCESSES", os.getenv("WEB_CONCURRENCY", "1"))), 1)
+GRADING_CONCURRENCY = int(os.getenv("GRADING_CONCURRENCY", "4"))
+RATE_LIMIT_BACKOFF = float(os.getenv("RATE_LIMIT_BACKOFF", "10"))
+# OpenAI-compatible endpoint; bench_grading.py points it at a local stand-in.
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://models.inference.ai.azure.com")
+# Requests in flight across every job in the process, and the circuit breaker: after
+# LLM_CIRCUIT_FAILURES consecutive server/connection errors requests wait
+# LLM_CIRCUIT_RESET seconds (doubling while the endpoint stays down) before a probe,
+# and a caller gives up with EndpointUnavailable after LLM_CIRCUIT_MAX_WAIT seconds.
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))
+LLM_CIRCUIT_RESET = float(os.getenv("LLM_CIRCUIT_RESET", "30"))
+LLM_CIRCUIT_MAX_WAIT = float(os.getenv("LLM_CIRCUIT_MAX_WAIT", "300"))
+
+# Fallback for an image whose size can't be read: a 200 DPI A4 page is scaled by the
+# endpoint to 768x1086 -> 6 tiles -> 85 + 170*6 tokens.
+IMAGE_TOKEN_ESTIMATE = 1105
+COMPLETION_TOKEN_ESTIMATE = 1000
+
+# Every call runs at temperature 0, so a response can be replayed for an identical request.
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "llm_cache")
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "200"))
+
+# Request packing: up to GRADING_PACK_WIDTH pages share one request, either a student's
+# consecutive pages ("pages") or several students' copies of the same page ("students").
+# 1 sends one page per request, as before. "students" only packs when one
+# grade_batch_exams call holds several students, which the app never does (it grades
+# one student per call), so it is left to bench_grading.py --mode grade.
+GRADING_PACK_WIDTH = int(os.getenv("GRADING_PACK_WIDTH", "1"))
+GRADING_PACK_MODE = os.getenv("GRADING_PACK_MODE", "pages")
+if GRADING_PACK_MODE != "pages":
+    print(f"GRADING_PACK_MODE={GRADING_PACK_MODE!r} is not supported by the app, packing pages instead.")
+    GRADING_PACK_MODE = "pages"
+
+
+class RateLimiter:
+    """Token bucket over the endpoint's requests-per-minute and tokens-per-minute budget.
+
+    Shared by every grading thread in the process. A 429 pauses the whole bucket so
+    the other threads back off too instead of piling more requests onto the limit.
+    A share of under one request per minute still holds one request, refilled slowly.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = float(rpm)
+        self.tpm = float(tpm)
+        self._burst = max(self.rpm, 1.0)
+        self._requests = self._burst
+        self._tokens = self.tpm
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self._burst, self._requests + elapsed * self.rpm / 60.0)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens):
+        """Blocks until one request and `tokens` tokens are available, then takes them."""
+        tokens = min(tokens, self.tpm)
+        with self._cond:
+            while True:
+                self._refill()
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                else:
+                    wait = max(
+                        (1 - self._requests) * 60.0 / self.rpm,
+                        (tokens - self._tokens) * 60.0 / self.tpm,
+                        0.05,
+                    )
+                self._cond.wait(wait)
+
+    def settle(self, estimated, actual):
+        """Corrects the bucket once the real token usage of a request is known."""
+        with self._cond:
+            self._tokens = min(self.tpm, self._tokens + estimated - actual)
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        """Stops all callers for `seconds`, used when the endpoint answers 429."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._requests = 0.0
+
+
+rate_limiter = RateLimiter(GRADING_RPM / GRADING_PROCESSES, GRADING_TPM / GRADING_PROCESSES)
+
+
+# The openai package takes most of a second to import, which every web worker would pay
+# at boot; it is imported on the first request instead. render (PyMuPDF and NumPy) is
+# likewise imported by the functions that build or measure image parts.
+def _openai():
+    import openai
+    return openai
+
+
+def estimate_tokens(content):
+    """Rough prompt + completion token cost of a chat request, used to draw from the bucket."""
+    from render import image_part_cost
+    tokens = COMPLETION_TOKEN_ESTIMATE
+    for part in content:
+        if part["type"] == "text":
+            tokens += len(part["text"]) // 4
+        else:
+            tokens += image_part_cost(part)[1] or IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of model responses.
+    Entries are keyed by a hash of the model id and the full request content (prompt
+    text and image bytes). File mtimes double as the LRU clock: a hit touches the
+    entry, and when the cache grows past max_bytes the least recently used entries go.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+    def key(self, model_id, content):
+        digest = hashlib.sha256(model_id.encode("utf-8"))
+        for part in content:
+            digest.update(json.dumps(part, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            os.utime(path)
+            return text
+        except OSError:
+            return None
+
+    def put(self, key, text):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(text.encode("utf-8"))
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Trim to 90% so a full cache doesn't rescan the directory on every put.
+        target = self.max_bytes * 0.9
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+
+
+response_cache = ResponseCache(LLM_CACHE_DIR, int(LLM_CACHE_MAX_MB * 1024 * 1024))
+
+
+class EndpointUnavailable(Exception):
+    """Raised when the circuit breaker stays open longer than a caller is willing to wait."""
+
+
+def _parse_duration(value):
+    """Seconds in a rate-limit header value: "20", "1.5", "250ms", "6m0s" or "1h2m3s"."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+
+def _retry_after(headers):
+    """How long the endpoint asked us to wait, from Retry-After or the rate-limit reset headers."""
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        return _parse_duration(headers["retry-after-ms"]) / 1000.0
+    for name in ("retry-after", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        seconds = _parse_duration(headers.get(name))
+        if seconds is not None:
+            return seconds
+    return None
+
+
+class LLMGateway:
+    """
+    The one way requests reach the model endpoint.
+
+    Owns a single OpenAI client, so every thread shares its keep-alive connection
+    pool, and caps requests in flight across the process. Retries are done here
+    instead of in the client: 429s pause the shared rate limiter for as long as the
+    endpoint's Retry-After / rate-limit headers say, and other transient failures
+    back off with jittered exponential delays. After `failure_threshold` consecutive
+    server or connection failures the circuit opens; callers then wait for it to
+    close instead of burning their retries, and a single probe request decides
+    whether the endpoint is back.
+    """
+
+    def __init__(self, base_url, max_in_flight, failure_threshold, reset_timeout, max_wait):
+        self.base_url = base_url
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_wait = max_wait
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._client = None
+        self._client_key = None
+        self._failures = 0
+        self._open_until = 0.0
+        self._open_for = reset_timeout
+        self._probing = False
+        self._cond = threading.Condition()
+
+    def client(self):
+        token = os.getenv("GITHUB_TOKEN")
+        with self._cond:
+            if self._client is not None and self._client_key == token:
+                return self._client
+        # Built outside the lock: the first build imports openai, and threads waiting on
+        # the circuit shouldn't wait for that. A racing thread's spare client is dropped.
+        client = _openai().OpenAI(base_url=self.base_url, api_key=token, max_retries=0)
+        with self._cond:
+            if self._client is None or self._client_key != token:
+                self._client = client
+                self._client_key = token
+            return self._client
+
+    def _wait_for_circuit(self, label):
+        """Blocks while the circuit is open; returns True if this call is the half-open probe."""
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._failures < self.failure_threshold:
+                    return False
+                if now >= self._open_until and not self._probing:
+                    self._probing = True
+                    print(f"Circuit half-open, probing the endpoint with {label}...")
+                    return True
+                if now >= deadline:
+                    raise EndpointUnavailable(
+                        f"Model endpoint unavailable: circuit open after {self._failures} consecutive failures."
+                    )
+                self._cond.wait(min(max(self._open_until - now, 0.05), deadline - now))
+
+    def _record(self, ok, probe):
+        with self._cond:
+            if probe:
+                self._probing = False
+            if ok:
+                if self._failures >= self.failure_threshold:
+                    print("Model endpoint recovered, circuit closed.")
+                self._failures = 0
+                self._open_for = self.reset_timeout
+            else:
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    if probe:
+                        self._open_for = min(self._open_for * 2, self.max_wait)
+                    self._open_until = time.monotonic() + self._open_for
+                    print(f"Model endpoint failing, circuit open for {self._open_for:.0f} seconds.")
+            self._cond.notify_all()
+
+    def request_json(self, model_id, content, label, max_retries, timeout=300.0, stats=None):
+        """
+        Sends one JSON-mode chat request under the shared rate limiter.
+        Returns (json_text, None) on success or (None, error_message); raises
+        EndpointUnavailable if the circuit stays open past max_wait. Waits, latency,
+        retries and token usage are recorded in metrics and in the job's stats.
+        """
+        estimated = estimate_tokens(content)
+        error = "Retries exhausted."
+
+        for attempt in range(max_retries):
+            if attempt:
+                metrics.count("llm_retries_total", stats=stats, stat="retries")
+            with metrics.timed("circuit_wait", stats):
+                probe = self._wait_for_circuit(label)
+            with metrics.timed("rate_limit_wait", stats):
+                rate_limiter.acquire(estimated)
+            print(f"Requesting {label} (Attempt {attempt + 1})...")
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                with self._slots:
+                    raw = self.client().chat.completions.with_raw_response.create(
+                        model=model_id,
+                        response_format={ "type": "json_object" },
+                        temperature=0.0,
+                        messages=[{"role": "user", "content": content}],
+                        timeout=timeout
+                    )
+                response = raw.parse()
+                outcome = "ok"
+            except _openai().RateLimitError as e:
+                outcome = "rate_limited"
+                metrics.count("llm_rate_limited_total", stats=stats, stat="rate_limited")
+                # The endpoint is up, just saturated: not a breaker failure.
+                self._record(True, probe)
+                wait = _retry_after(getattr(e.response, "headers", None))
+                if wait is None:
+                    wait = _jittered_backoff(attempt)
+                print(f"Rate limited on {label}, pausing requests for {wait:.1f} seconds...")
+                rate_limiter.pause(wait)
+                error = str(e)
+                continue
+            except (_openai().APIConnectionError, _openai().InternalServerError) as e:
+                self._record(False, probe)
+                error = str(e)
+                outcome = "failed"
+            except Exception as e:
+                self._record(True, probe)
+                return None, str(e)
+            finally:
+                elapsed = time.perf_counter() - start
+                metrics.registry.observe("llm_request_seconds", elapsed, outcome=outcome)
+                metrics.add_stat(stats, "model_seconds", elapsed)
+
+            if outcome == "failed":
+                if attempt < max_retries - 1:
+                    wait = _jittered_backoff(attempt)
+                    print(f"{label} failed ({error[:80]}), retrying in {wait:.1f} seconds...")
+                    with metrics.timed("retry_backoff", stats):
+                        time.sleep(wait)
+                continue
+
+            self._record(True, probe)
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                rate_limiter.settle(estimated, usage.total_tokens)
+                for kind in ("prompt", "completion"):
+                    tokens = getattr(usage, f"{kind}_tokens", None)
+                    if tokens:
+                        metrics.count("llm_tokens_total", tokens, stats, f"{kind}_tokens", kind=kind)
+            # Stop before the bucket runs dry rather than collecting a 429 for it.
+            headers = raw.headers
+            if "0" in (headers.get("x-ratelimit-remaining-requests"), headers.get("x-ratelimit-remaining-tokens")):
+                wait = _retry_after(headers)
+                if wait:
+                    rate_limiter.pause(wait)
+            return response.choices[0].message.content, None
+
+        return None, error
+
+
+def _jittered_backoff(attempt):
+    """Exponential backoff with jitter, so paused threads don't all retry at once."""
+    base = RATE_LIMIT_BACKOFF * (2 ** attempt)
+    return random.uniform(base / 2, base)  # nosec B311 - jitter, not security-sensitive
+
+
+llm_gateway = LLMGateway(
+    LLM_BASE_URL,
+    max_in_flight=LLM_MAX_IN_FLIGHT,
+    failure_threshold=LLM_CIRCUIT_FAILURES,
+    reset_timeout=LLM_CIRCUIT_RESET,
+    max_wait=LLM_CIRCUIT_MAX_WAIT
+)
+
+
+def cached_request_json(model_id, content, label, max_retries, stats=None, timeout=300.0, valid=None,
+                        refresh=False):
+    """
+    llm_gateway.request_json behind the response cache. Only JSON objects that pass
+    `valid` (a check of the parsed data) are stored, so a malformed answer is asked
+    again on retry instead of being replayed. Returns (data, None) or
+    (None, error_message); unparsable JSON is the error "invalid json" and a
+    response failing `valid` is "invalid response". refresh=True skips the lookup
+    (a re-grade wants a fresh answer to the same request) but stores the new answer.
+    """
+    from render import image_part_cost
+    def usable(data):
+        return isinstance(data, dict) and (valid is None or valid(data))
+
+    cache_key = response_cache.key(model_id, content)
+    json_text = None if refresh else response_cache.get(cache_key)
+    if json_text is not None:
+        try:
+            data = json.loads(json_text)
+        except (json.JSONDecodeError, TypeError):
+            data = None
+        if usable(data):
+            metrics.count("llm_cache_total", stats=stats, stat="cache_hits", result="hit")
+            print(f"{label} served from response cache.")
+            return data, None
+
+    metrics.count("llm_cache_total", stats=stats, stat="cache_misses", result="miss")
+    for part in content:
+        if part["type"] == "image_url":
+            n_bytes, tokens = image_part_cost(part)
+            metrics.count("llm_image_bytes_total", n_bytes, stats, "image_bytes")
+            metrics.add_stat(stats, "image_tokens", tokens or IMAGE_TOKEN_ESTIMATE)
+    json_text, error = llm_gateway.request_json(model_id, content, label, max_retries, timeout, stats)
+    if error:
+        return None, error
+
+    try:
+        data = json.loads(json_text)
+    except (json.JSONDecodeError, TypeError):
+        return None, "invalid json"
+    if not usable(data):
+        return None, "invalid response"
+
+    response_cache.put(cache_key, json_text)
+    return data, None
+
+
+def _grade_page(model_id, content, student_name, page_num, max_retries, stats=None, identity=None,
+                refresh=False):
+    """
+    Sends one key/student page pair to the model.
+    Returns (page_report, raw_earned, raw_possible, graded_questions); when an
+    identity dict is given it receives the "student_id"/"student_name" the model read.
+    """
+    page_data, error = cached_request_json(
+        model_id, content, f"{student_name} Page {page_num}", max_retries, stats, valid=_valid_page,
+        refresh=refresh
+    )
+
+    if error == "invalid json":
+        return "ERROR: AI failed to output valid JSON for this page.\n\n", 0.0, 0.0, []
+    if error == "invalid response":
+        return "ERROR: AI returned questions without usable points for this page.\n\n", 0.0, 0.0, []
+    if error:
+        return f"API ERROR DURING GRADING FOR {student_name} PAGE {page_num}:\n{error}\n\n", 0.0, 0.0, []
+
+    try:
+        page = _format_page(page_data)
+    except (AttributeError, TypeError, ValueError) as e:
+        return f"ERROR: could not read the AI's grading for this page: {e}\n\n", 0.0, 0.0, []
+    print(f"{student_name} - Page {page_num} graded successfully.")
+    if identity is not None:
+        identity["student_id"] = page_data.get("student_id")
+        identity["student_name"] = page_data.get("student_name")
+    return page
+
+
+def _valid_page(data):
+    """True for a single-page {"questions": [...]} answer that _format_page can tally."""
+    questions = data.get("questions", [])
+    return isinstance(questions, list) and _valid_questions(questions)
+
+
+def _valid_questions(questions):
+    """True when every question is an object whose points _format_page can add up."""
+    try:
+        for q in questions:
+            float(q.get('points_earned', 0))
+            float(q.get('points_possible', 0))
+    except (AttributeError, TypeError, ValueError):
+        return False
+    return True
+
+
+def _split_pack(data, pack):
+    """
+    The page entries of a packed {"pages": [...]} response in pack order, or None
+    unless every student/page of the pack is answered exactly once with valid questions.
+    """
+    entries = data.get("pages") if isinstance(data, dict) else None
+    if not isinstance(entries, list):
+        return None
+    by_page = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("questions"), list):
+            return None
+        if not _valid_questions(entry["questions"]):
+            return None
+        key = (str(entry.get("student")), str(entry.get("page")))
+        if key in by_page:
+            return None
+        by_page[key] = entry
+    expected = [(unit["student"], str(unit["page"])) for unit in pack]
+    if set(by_page) != set(expected):
+        return None
+    return [by_page[key] for key in expected]
+
+
+def _pack_units(units, mode, width):
+    """
+    Groups page units into packs of at most `width`: a student's consecutive pages
+    ("pages") or the same page of consecutive students ("students").
+    """
+    groups = {}
+    for unit in units:
+        groups.setdefault(unit["student"] if mode == "pages" else unit["page"], []).append(unit)
+    return [group[start:start + width] for group in groups.values() for start in range(0, len(group), width)]
+
+
+def _grade_pack(model_id, pack, prompt, identity_prompt, max_retries, stats=None):
+    """
+    Sends several key/student page pairs in one request and splits the answer back
+    out. Returns one _grade_page result per unit, in pack order; if the response fails
+    or doesn't validate, the pack's pages are re-sent one per request.
+    """
+    content = [{"type": "text", "text": prompt}]
+    keys_sent = set()
+    for unit in pack:
+        if unit["page"] not in keys_sent:
+            content.extend(unit["key_parts"])
+            keys_sent.add(unit["page"])
+        if unit["identity"] is not None:
+            content.append({"type": "text", "text": identity_prompt.format(student=unit["student"])})
+        content.append({"type": "text", "text": f"--- {unit['student']} (PAGE {unit['page']}) ---"})
+        content.append(unit["student_part"])
+
+    label = "Pack of " + ", ".join(f"{unit['student']} Page {unit['page']}" for unit in pack)
+    data, error = cached_request_json(model_id, content, label, max_retries, stats,
+                                      valid=lambda data: _split_pack(data, pack) is not None,
+                                      refresh=any(unit["refresh"] for unit in pack))
+    pages = None if error else _split_pack(data, pack)
+    if pages is None:
+        metrics.count("llm_pack_fallbacks_total", stats=stats, stat="pack_fallbacks")
+        print(f"{label} failed ({error or 'response did not match the pack'}); grading its pages one by one.")
+        return [_grade_page(model_id, unit["content"], unit["student"], unit["page"], max_retries, stats,
+                            unit["identity"], unit["refresh"])
+                for unit in pack]
+
+    results = []
+    for unit, page_data in zip(pack, pages):
+        print(f"{unit['student']} - Page {unit['page']} graded successfully (packed).")
+        if unit["identity"] is not None:
+            unit["identity"]["student_id"] = page_data.get("student_id")
+            unit["identity"]["student_name"] = page_data.get("student_name")
+        results.append(_format_page(page_data))
+    return results
+
+
+def _settle_pack(done, pack):
+    """Hands a finished pack's results (or its exception) to the futures of its pages."""
+    if done.exception() is not None:
+        for unit in pack:
+            unit["future"].set_exception(done.exception())
+        return
+    results = done.result()
+    if len(pack) == 1:
+        results = [results]
+    for unit, result in zip(pack, results):
+        unit["future"].set_result(result)
+
+
+def _format_page(page_data):
+    """Report text and tallies for one page in the {"questions": [...]} schema."""
+    page_report = ""
+    page_earned = 0.0
+    page_possible = 0.0
+
+    questions = page_data.get("questions", [])
+
+    if not questions:
+        page_report += "No gradable questions found on this page.\n\n"
+
+    for q in questions:
+        page_report += f"* Question: {q.get('question_id')}\n"
+        page_report += f"* Key Shows: {q.get('key_literal_transcription')}\n"
+        page_report += f"* Student Wrote: {q.get('student_literal_transcription')}\n"
+        page_report += f"* Verdict: {q.get('verdict')}\n"
+        page_report += f"* Points: {q.get('points_earned')} / {q.get('points_possible')}\n"
+        page_report += f"* Reasoning: {q.get('step_by_step_analysis')}\n\n"
+
+        page_earned += float(q.get('points_earned', 0))
+        page_possible += float(q.get('points_possible', 0))
+
+    return page_report, page_earned, page_possible, questions
+
+
+def grade_batch_exams(student_submissions, key_images, stats=None, on_page=None, key_transcriptions=None,
+                      pregraded=None, items=None, page_details=None, identities=None, refresh=None):
     """
     Expects:
     - student_submissions: A dictionary {"Student_1.pdf": [img1, img2, img3]}
     - key_images: A list of base64 images for the Answer Key
+    - stats: optional dict that receives the job's cache_hits / cache_misses counters
+    - on_page: optional callback(student_name, page_num), called from the grading
+      thread as soon as each page finishes
+    - key_transcriptions: optional per-page output of transcribe_answer_key; pages
+      with a usable transcription are graded against the key text, not the key image
+    - pregraded: optional {student_name: {page_num: {"questions": [...]}}} of pages
+      already graded locally (e.g. by the OMR engine); these pages skip the model
+    - items: optional list that receives every graded question as the model's JSON
+      object plus "student" and "page", for structured storage
+    - page_details: optional {page_num: "low" | "high"} vision detail per page
+      (default "high")
+    - identities: optional dict; when given, the page-1 request also reads the
+      student's ID and name, saving extract_student_info's separate request, and
+      identities[student_name] receives {"student_id", "student_name"}
+    - refresh: optional {student_name: page_nums} graded by the model again even
+      when the response cache holds an answer for the same request (re-grades)
+
+    With GRADING_PACK_WIDTH > 1 several pages share one request (see _pack_units);
+    a pack whose answer doesn't validate falls back to one request per page.
     """
+    from render import image_part
     
 
     GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
     if not GITHUB_TOKEN:
         return "API ERROR: GITHUB_TOKEN environment variable not found."
 
-    client = OpenAI(
-        base_url="https://models.inference.ai.azure.com",
-        api_key=GITHUB_TOKEN,
-        timeout=300.0, 
-    )
-
     model_id = "gpt-4o"
     max_retries = 3
 
     
-    grading_prompt = """You are a grading engine. Your only goal is 100% deterministic visual transcription and logic comparison. 
-    
-    I am providing you with exactly two images:
-    1. The official Answer Key (for this specific page).
-    2. The Student's Exam (for this specific page).
-
-    CRITICAL GRADING RULES:
+    grading_rules = """    CRITICAL GRADING RULES:
     1. ZERO HALLUCINATION (LITERAL TEXT): Read exactly what the student wrote. Do not guess or infer. If the key says 'a' and the student's 'a' looks like a 'c', transcribe it as 'c' and mark it INCORRECT.
     2. VISUAL DIAGRAM MATCHING (CIRCUITS/DRAWINGS): For questions requiring a drawn logic circuit, DO NOT just describe the image. You must visually trace the topology. The student's drawing MUST have the exact same logic gates (AND, OR, XOR), wire connections, and input/output labels as the key. If a wire goes to the wrong gate, it is INCORRECT.
     3. THE ANSWER TABLE IS THE SOURCE OF TRUTH: If the student filled out a summary "Answers Table" for multiple-choice questions, use the letters written in that table as their official answers. If the table is empty or missing, fall back to checking the circled answers next to the questions.
@@ -59,150 +688,262 @@ def grade_batch_exams(student_submissions, key_images):
     If there are no questions to grade on this page, return {"questions": []}.
     """
 
+    grading_prompt = """You are a grading engine. Your only goal is 100% deterministic visual transcription and logic comparison. 
+    
+    I am providing you with exactly two images:
+    1. The official Answer Key (for this specific page).
+    2. The Student's Exam (for this specific page).
+
+""" + grading_rules
+
+    # Student-only prompt for pages whose key was transcribed once up front (transcribe_answer_key).
+    key_text_prompt = """You are a grading engine. Your only goal is 100% deterministic visual transcription and logic comparison. 
+    
+    I am providing you with:
+    1. The official Answer Key for this specific page, already transcribed as JSON (question_id, expected_answer, points_possible). Treat it as exact: copy its expected_answer into "key_literal_transcription" and use its points_possible.
+    2. One image: the Student's Exam (for this specific page).
+
+""" + grading_rules
+
+    identity_prompt = """ALSO: this is the first page of the student's exam. Read the student's university ID number and full name from its header and add them to the same JSON object as top-level fields:
+    "student_id": "the university ID number you see",
+    "student_name": "the full name you see"
+    If you cannot find the ID or name, use null for that field."""
+
+    packed_prompt = """You are a grading engine. Your only goal is 100% deterministic visual transcription and logic comparison. 
+    
+    I am providing you with SEVERAL exam pages to grade independently:
+    - Each "--- OFFICIAL ANSWER KEY (PAGE n) ---" section is the official Answer Key for page n, either as an image or already transcribed as JSON (question_id, expected_answer, points_possible). A transcribed key is exact: copy its expected_answer into "key_literal_transcription" and use its points_possible.
+    - Each "--- <student> (PAGE n) ---" section is one student's exam page. Grade it ONLY against the answer key of the same PAGE number; never mix information between sections.
+
+""" + grading_rules + """
+    PACKED OUTPUT FORMAT (this replaces the single-page object above):
+    Return one entry per student section, using the student and page exactly as written in its header:
+    {
+        "pages": [
+            {"student": "<student>", "page": 1, "questions": [ ...same question objects as above... ]}
+        ]
+    }
+    A page with no questions to grade still gets an entry with "questions": [].
+    """
+
+    packed_identity_prompt = """ALSO: the next section ({student}, PAGE 1) is the first page of that student's exam. Read the student's university ID number and full name from its header and add "student_id" and "student_name" to that page's entry (null for a field you cannot find)."""
+
     master_report = f"--- BATCH GRADING ENGINE: {model_id.upper()} (PAGE-BY-PAGE JSON MODE) ---\n"
 
-    for student_name, student_images in student_submissions.items():
-        student_report = f"\n\n========================================\n"
-        student_report += f" GRADING REPORT: {student_name}\n"
-        student_report += f"========================================\n\n"
-        
-        if len(student_images) != len(key_images):
-            student_report += f"WARNING: {student_name} has {len(student_images)} pages, but the Answer Key has {len(key_images)}. Grading matched pages only to avoid misalignment.\n\n"
-
-        student_raw_earned = 0.0
-        student_raw_possible = 0.0
-        student_total_questions = 0
-
-        for page_idx, (key_page, student_page) in enumerate(zip(key_images, student_images)):
-            page_num = page_idx + 1
-            student_report += f"--- PAGE {page_num} ---\n"
-            
-            content = [{"type": "text", "text": grading_prompt}]
-            
-            content.append({"type": "text", "text": f"--- OFFICIAL ANSWER KEY (PAGE {page_num}) ---"})
-            content.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{key_page}"}
-            })
-                
-            content.append({"type": "text", "text": f"--- {student_name} (PAGE {page_num}) ---"})
-            content.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{student_page}"}
-            })
-
-            for attempt in range(max_retries):
-                try:
-                    print(f"Grading {student_name} - Page {page_num} (Attempt {attempt + 1})...")
-                    
-                    response = client.chat.completions.create(
-                        model=model_id, 
-                        response_format={ "type": "json_object" },
-                        temperature=0.0, 
-                        messages=[{"role": "user", "content": content}]
+    # Every page of every student is independent, so they are all queued up front and
+    # graded in parallel under the shared rate limiter. Results are collected per
+    # student in page order so the report reads exactly as the sequential one did.
+    with ThreadPoolExecutor(max_workers=GRADING_CONCURRENCY) as executor:
+        student_pages = []
+        packable = []
+        for student_name, student_images in student_submissions.items():
+            page_futures = []
+            student_pregraded = (pregraded or {}).get(student_name, {})
+            for page_idx, (key_page, student_page) in enumerate(zip(key_images, student_images)):
+                page_num = page_idx + 1
+
+                if page_num in student_pregraded:
+                    future = executor.submit(_format_page, student_pregraded[page_num])
+                    if on_page:
+                        future.add_done_callback(
+                            lambda _, name=student_name, num=page_num: on_page(name, num)
+                        )
+                    page_futures.append(future)
+                    continue
+
+                detail = (page_details or {}).get(page_num, "high")
+                key_entry = None
+                if key_transcriptions and page_idx < len(key_transcriptions):
+                    key_entry = key_transcriptions[page_idx]
+
+                if key_entry and not key_entry.get("requires_key_image"):
+                    content = [{"type": "text", "text": key_text_prompt}]
+                    key_parts = [{
+                        "type": "text",
+                        "text": f"--- OFFICIAL ANSWER KEY (PAGE {page_num}) ---\n{json.dumps(key_entry['questions'])}"
+                    }]
+                else:
+                    content = [{"type": "text", "text": grading_prompt}]
+                    key_parts = [
+                        {"type": "text", "text": f"--- OFFICIAL ANSWER KEY (PAGE {page_num}) ---"},
+                        image_part(key_page, detail)
+                    ]
+                content.extend(key_parts)
+
+                identity = None
+                if identities is not None and page_num == 1:
+                    identity = identities.setdefault(student_name, {})
+                    content.append({"type": "text", "text": identity_prompt})
+
+                fresh = page_num in (refresh or {}).get(student_name, ())
+                student_part = image_part(student_page, detail)
+                content.append({"type": "text", "text": f"--- {student_name} (PAGE {page_num}) ---"})
+                content.append(student_part)
+
+                if GRADING_PACK_WIDTH > 1:
+                    # Sent once every student's pages are known, so packs can span students.
+                    future = Future()
+                    packable.append({"student": student_name, "page": page_num, "key_parts": key_parts,
+                                     "student_part": student_part, "identity": identity,
+                                     "content": content, "refresh": fresh, "future": future})
+                    if on_page:
+                        future.add_done_callback(
+                            lambda _, name=student_name, num=page_num: on_page(name, num)
+                        )
+                    page_futures.append(future)
+                    continue
+
+                future = executor.submit(
+                    _grade_page, model_id, content, student_name, page_num, max_retries, stats,
+                    identity, fresh
+                )
+                if on_page:
+                    future.add_done_callback(
+                        lambda _, name=student_name, num=page_num: on_page(name, num)
                     )
-                    
-                    json_text = response.choices[0].message.content
-                    
-                    try:
-                        page_data = json.loads(json_text)
-                        questions = page_data.get("questions", [])
-                        
-                        if not questions:
-                            student_report += "No gradable questions found on this page.\n\n"
-                            
-                        for q in questions:
-                            student_report += f"* Question: {q.get('question_id')}\n"
-                            student_report += f"* Key Shows: {q.get('key_literal_transcription')}\n"
-                            student_report += f"* Student Wrote: {q.get('student_literal_transcription')}\n"
-                            student_report += f"* Verdict: {q.get('verdict')}\n"
-                            student_report += f"* Points: {q.get('points_earned')} / {q.get('points_possible')}\n"
-                            student_report += f"* Reasoning: {q.get('step_by_step_analysis')}\n\n"
-                            
-                            student_raw_earned += float(q.get('points_earned', 0))
-                            student_raw_possible += float(q.get('points_possible', 0))
-                            student_total_questions += 1
-                            
-                    except json.JSONDecodeError:
-                        student_report += "ERROR: AI failed to output valid JSON for this page.\n\n"
-                        
-                    print("Page graded successfully. Sleeping 15 seconds to cool down Azure limits...")
-                    time.sleep(15)
-                    break 
-                    
-                except Exception as e:
-                    if "429" in str(e) and attempt < max_retries - 1:
-                        print(f"Rate limited on {student_name} Page {page_num}, waiting 30 seconds...")
-                        time.sleep(30) 
-                        continue 
-                    
-                    student_report += f"API ERROR DURING GRADING FOR {student_name} PAGE {page_num}:\n{str(e)}\n\n"
-                    break 
-        
-       
-        if student_raw_possible > 0:
-            final_scaled_score = (student_raw_earned / student_raw_possible) * 30
-        else:
-            final_scaled_score = 0.0
-            
-        final_scaled_score = round(final_scaled_score, 2)
-        
-        student_report += f"----------------------------------------\n"
-        student_report += f" FINAL EXAM TALLY: {student_name}\n"
-        student_report += f"----------------------------------------\n"
-        student_report += f"Total Questions Graded: {student_total_questions}\n"
-        student_report += f"Raw AI Detection: {round(student_raw_earned, 2)} / {round(student_raw_possible, 2)}\n"
-        student_report += f"FINAL SCALED SCORE: {final_scaled_score} / 30\n"
-        student_report += f"========================================\n\n"
-        
-        master_report += student_report
-        
+                page_futures.append(future)
+            student_pages.append((student_name, student_images, page_futures))
+
+        for pack in _pack_units(packable, GRADING_PACK_MODE, GRADING_PACK_WIDTH):
+            if len(pack) == 1:
+                unit = pack[0]
+                pack_future = executor.submit(_grade_page, model_id, unit["content"], unit["student"],
+                                              unit["page"], max_retries, stats, unit["identity"],
+                                              unit["refresh"])
+            else:
+                pack_future = executor.submit(_grade_pack, model_id, pack, packed_prompt,
+                                              packed_identity_prompt, max_retries, stats)
+            pack_future.add_done_callback(lambda done, pack=pack: _settle_pack(done, pack))
+
+        for student_name, student_images, page_futures in student_pages:
+            student_report = f"\n\n========================================\n"
+            student_report += f" GRADING REPORT: {student_name}\n"
+            student_report += f"========================================\n\n"
+
+            if len(student_images) != len(key_images):
+                student_report += f"WARNING: {student_name} has {len(student_images)} pages, but the Answer Key has {len(key_images)}. Grading matched pages only to avoid misalignment.\n\n"
+
+            student_raw_earned = 0.0
+            student_raw_possible = 0.0
+            student_total_questions = 0
+
+            for page_idx, future in enumerate(page_futures):
+                page_report, page_earned, page_possible, page_questions = future.result()
+                student_report += f"--- PAGE {page_idx + 1} ---\n"
+                student_report += page_report
+                student_raw_earned += page_earned
+                student_raw_possible += page_possible
+                student_total_questions += len(page_questions)
+
+                if items is not None:
+                    for q in page_questions:
+                        items.append({"student": student_name, "page": page_idx + 1, **q})
+
+            if student_raw_possible > 0:
+                final_scaled_score = (student_raw_earned / student_raw_possible) * 30
+            else:
+                final_scaled_score = 0.0
+
+            final_scaled_score = round(final_scaled_score, 2)
+
+            student_report += f"----------------------------------------\n"
+            student_report += f" FINAL EXAM TALLY: {student_name}\n"
+            student_report += f"----------------------------------------\n"
+            student_report += f"Total Questions Graded: {student_total_questions}\n"
+            student_report += f"Raw AI Detection: {round(student_raw_earned, 2)} / {round(student_raw_possible, 2)}\n"
+            student_report += f"FINAL SCALED SCORE: {final_scaled_score} / 30\n"
+            student_report += f"========================================\n\n"
+
+            master_report += student_report
+
     return master_report
 
 
-def extract_student_info(student_image_b64):
-    """Reads student ID and name from the first page of the exam."""
+def transcribe_answer_key(key_images, stats=None):
+    """
+    Reads every answer-key page once into structured JSON so students can be graded
+    against the key text instead of re-sending the key image with every page.
+    Returns one {"questions": [...], "requires_key_image": bool} per page, or None
+    for a page that could not be transcribed (that page keeps using the image).
+    """
+    from render import image_part
+
+    GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+    if not GITHUB_TOKEN:
+        print("API ERROR: GITHUB_TOKEN environment variable not found.")
+        return [None] * len(key_images)
+
+    transcription_prompt = """You are transcribing an official exam ANSWER KEY page. Do not grade anything.
+    For every question on this page, extract the question ID, the expected answer exactly as written on the key,
+    the question type and the points it is worth.
+
+    RULES:
+    1. LITERAL TEXT: Copy the expected answer exactly (e.g., "b. lw $t0, 0($s0)"). Never use newline characters.
+    2. QUESTION IDS: Format IDs cleanly (e.g., "Q1-1", "Q2-4").
+    3. POINTS: Use explicit point labels (e.g., "(15 points)" for 10 questions = 1.5 points each). If there is no label, use EXACTLY 1.0.
+    4. DIAGRAMS: If any answer on this page is a drawing (logic circuit, diagram, graph) that cannot be captured as text, set "requires_key_image" to true.
+
+    Return ONLY this JSON:
+    {
+        "requires_key_image": false,
+        "questions": [
+            {
+                "question_id": "Q1-1",
+                "question_type": "multiple_choice",
+                "expected_answer": "b. lw $t0, 0($s0)",
+                "points_possible": 1.5
+            }
+        ]
+    }
+    question_type is one of "multiple_choice", "short_answer", "circuit", "other".
+    If the page has no questions, return {"requires_key_image": false, "questions": []}.
+    """
+
+    def transcribe_page(page_num, key_page):
+        content = [
+            {"type": "text", "text": transcription_prompt},
+            {"type": "text", "text": f"--- OFFICIAL ANSWER KEY (PAGE {page_num}) ---"},
+            image_part(key_page)
+        ]
+        data, error = cached_request_json("gpt-4o", content, f"answer key Page {page_num}", 3, stats,
+                                          valid=lambda data: isinstance(data.get("questions"), list))
+        if error:
+            print(f"transcribe_answer_key error on page {page_num}: {error}")
+            return None
+        return data
+
+    with ThreadPoolExecutor(max_workers=GRADING_CONCURRENCY) as executor:
+        futures = [executor.submit(transcribe_page, idx + 1, page) for idx, page in enumerate(key_images)]
+        return [future.result() for future in futures]
+
+
+def extract_student_info(student_image_b64, stats=None):
+    """Reads student ID and name from the first page of the exam, or a crop of its header."""
+    from render import image_part
 
     GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
     if not GITHUB_TOKEN:
         print("API ERROR: GITHUB_TOKEN environment variable not found.")
         return None, None
 
-    client = OpenAI(
-        base_url="https://models.inference.ai.azure.com",
-        api_key=GITHUB_TOKEN,
-        timeout=60.0,
-    )
+    content = [
+        {
+            "type": "text",
+            "text": """Look at this exam paper and extract the student's university ID number and full name.
+            Return ONLY this JSON:
+            {
+                "student_id": "the university ID number you see",
+                "student_name": "the full name you see"
+            }
+            If you cannot find the ID or name, return null for that field."""
+        },
+        image_part(student_image_b64)
+    ]
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            response_format={"type": "json_object"},
-            temperature=0.0,
-            messages=[{
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": """Look at this exam paper and extract the student's university ID number and full name.
-                        Return ONLY this JSON:
-                        {
-                            "student_id": "the university ID number you see",
-                            "student_name": "the full name you see"
-                        }
-                        If you cannot find the ID or name, return null for that field."""
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{student_image_b64}"}
-                    }
-                ]
-            }]
-        )
-
-        data = json.loads(response.choices[0].message.content)
-        return data.get("student_id"), data.get("student_name")
-
-    except Exception as e:
-        print(f"extract_student_info error: {e}")
-        return None, None
\ No newline at end of file
+    data, error = cached_request_json("gpt-4o", content, "student info", 3, stats, timeout=60.0)
+    if error:
+        print(f"extract_student_info error: {error}")
+        return None, None
+
+    return data.get("student_id"), data.get("student_name")
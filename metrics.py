@@ -0,0 +1,134 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds; spans from a millisecond DB update to a multi-minute model call.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Registry:
+    """
+    Process-wide counters and histograms, rendered in the Prometheus text format.
+    Each gunicorn process keeps its own, so run one per scrape target or aggregate.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = help_text
+        self._types[name] = kind
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            buckets, total, count = self._histograms.get(key, ([0] * len(LATENCY_BUCKETS), 0.0, 0))
+            for idx, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    buckets[idx] += 1
+            self._histograms[key] = (buckets, total + value, count + 1)
+
+    def value(self, name, **labels):
+        """Current value of a counter (0 if never incremented); used by tests and benchmarks."""
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def sums(self, name):
+        """{labels: (sum, count)} of a histogram, labels as ((name, value), ...) pairs."""
+        with self._lock:
+            return {labels: (total, count)
+                    for (metric, labels), (_, total, count) in self._histograms.items() if metric == name}
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(b), s, c) for key, (b, s, c) in self._histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters} | {name for name, _ in histograms}):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {self._types[name]}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+            for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', _number(bound)),))} {bucket}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+registry = Registry()
+registry.describe("grading_stage_seconds", "histogram", "Time spent in each grading pipeline stage.")
+registry.describe("llm_request_seconds", "histogram", "Latency of model endpoint calls by outcome.")
+registry.describe("grading_pages_rendered_total", "counter", "PDF pages rasterized.")
+registry.describe("llm_image_bytes_total", "counter", "JPEG bytes sent to the model.")
+registry.describe("llm_tokens_total", "counter", "Tokens billed by the model endpoint, by kind.")
+registry.describe("llm_retries_total", "counter", "Model requests retried after a failure.")
+registry.describe("llm_rate_limited_total", "counter", "Model requests answered with HTTP 429.")
+registry.describe("llm_cache_total", "counter", "Response cache lookups by result.")
+registry.describe("llm_pack_fallbacks_total", "counter", "Packed requests re-sent one page at a time.")
+registry.describe("grading_tasks_total", "counter", "Grading tasks finished, by status.")
+registry.describe("grading_pages_screened_total", "counter", "Blank or question-free pages graded without the model.")
+registry.describe("grading_duplicate_pages_total", "counter", "Pages flagged as a second scan of an earlier page.")
+
+_stats_lock = threading.Lock()
+
+
+def add_stat(stats, name, amount=1):
+    """Adds to a per-job counter; stats is shared by all page threads of the job."""
+    if stats is None:
+        return
+    with _stats_lock:
+        stats[name] = stats.get(name, 0) + amount
+
+
+def count(name, amount=1, stats=None, stat=None, **labels):
+    """Adds to a process counter and, when given, to the job's stats dict under `stat`."""
+    registry.inc(name, amount, **labels)
+    if stat:
+        add_stat(stats, stat, amount)
+
+
+@contextmanager
+def timed(stage, stats=None):
+    """
+    Times a pipeline stage into grading_stage_seconds{stage=...}, and into the job's
+    stats dict as "<stage>_seconds" so the time is attributed to the job as well.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe("grading_stage_seconds", elapsed, stage=stage)
+        add_stat(stats, f"{stage}_seconds", elapsed)
@@ -0,0 +1,202 @@
+import base64
+import fitz
+import numpy as np
+
+
+# A row is read locally only when one box is clearly filled and clearly darker than
+# the rest; anything else is left for the model.
+FILL_THRESHOLD = 0.35
+FILL_MARGIN = 0.15
+BLANK_THRESHOLD = 0.08
+# Fraction of each cell trimmed on every side so the grid lines don't count as ink.
+CELL_INSET = 0.2
+# A pixel row/column is part of a ruling line when its dark run is at least this share
+# of the longest one found (the table's outer border) and of the page.
+LINE_COVERAGE = 0.6
+MIN_LINE_COVERAGE = 0.1
+
+
+def decode_page(img_b64):
+    """Decodes a rendered base64 JPEG page into a 2-D uint8 grayscale array."""
+    pix = fitz.Pixmap(base64.b64decode(img_b64))
+    if pix.n - pix.alpha != 1:
+        pix = fitz.Pixmap(fitz.csGRAY, pix)
+    gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    return gray[:, :pix.width]
+
+
+def _line_positions(dark, axis):
+    """Indices of the ruling lines along one axis of a binary image."""
+    coverage = dark.mean(axis=axis)
+    lines = np.flatnonzero(coverage >= max(coverage.max() * LINE_COVERAGE, MIN_LINE_COVERAGE))
+    if lines.size == 0:
+        return lines
+    # Collapse runs of adjacent pixels belonging to the same thick line.
+    starts = np.concatenate(([True], np.diff(lines) > 1))
+    return lines[starts]
+
+
+def find_table(gray, region=None):
+    """
+    Bounding box (y0, y1, x0, x1) in pixels of the answer-table grid.
+    With a template region ([x0, y0, x1, y1] as page fractions) the region is
+    searched; without one the whole page is. Returns None if no grid is found.
+    """
+    height, width = gray.shape
+    oy, ox = 0, 0
+    if region:
+        x0, y0, x1, y1 = region
+        oy, ox = int(y0 * height), int(x0 * width)
+        gray = gray[oy:int(y1 * height), ox:int(x1 * width)]
+
+    dark = gray < 128
+    rows = _line_positions(dark, axis=1)
+    cols = _line_positions(dark, axis=0)
+    if len(rows) < 2 or len(cols) < 2:
+        if region:
+            # A configured region is trusted even when its ruling is too faint to see.
+            return oy, oy + gray.shape[0], ox, ox + gray.shape[1]
+        return None
+    return oy + rows[0], oy + rows[-1], ox + cols[0], ox + cols[-1]
+
+
+def _cell_boxes(box, n_rows, n_cols, header_rows=0, label_cols=0):
+    """Inset pixel boxes of the answer cells as four (n_rows, n_cols) arrays."""
+    y0, y1, x0, x1 = box
+    ys = np.linspace(y0, y1, n_rows + header_rows + 1)[header_rows:]
+    xs = np.linspace(x0, x1, n_cols + label_cols + 1)[label_cols:]
+    top, bottom = ys[:-1], ys[1:]
+    left, right = xs[:-1], xs[1:]
+    dy = (bottom - top) * CELL_INSET
+    dx = (right - left) * CELL_INSET
+    top, bottom = (top + dy).astype(int), (bottom - dy).astype(int)
+    left, right = (left + dx).astype(int), (right - dx).astype(int)
+    shape = (n_rows, n_cols)
+    return (np.broadcast_to(top[:, None], shape), np.broadcast_to(bottom[:, None], shape),
+            np.broadcast_to(left[None, :], shape), np.broadcast_to(right[None, :], shape))
+
+
+def fill_ratios(pages, boxes):
+    """
+    Dark-pixel ratio of every cell on every page, as a (pages, rows, cols) array.
+    pages is a (P, H, W) stack; one summed-area table per page turns each cell
+    into four lookups, so the whole batch is read without Python loops over cells.
+    """
+    top, bottom, left, right = boxes
+    dark = (pages < 128).astype(np.int32)
+    integral = np.zeros((dark.shape[0], dark.shape[1] + 1, dark.shape[2] + 1), dtype=np.int64)
+    integral[:, 1:, 1:] = dark.cumsum(axis=1).cumsum(axis=2)
+    sums = (integral[:, bottom, right] - integral[:, top, right]
+            - integral[:, bottom, left] + integral[:, top, left])
+    area = np.maximum((bottom - top) * (right - left), 1)
+    return sums / area
+
+
+def classify(ratios, choices):
+    """
+    Turns (pages, rows, cols) fill ratios into per-row readings.
+    Returns a list per page of (answer, confidence_ok, best_ratio) tuples; answer is
+    the marked choice, "" for a confidently blank row, or None when unsure.
+    """
+    order = np.sort(ratios, axis=2)
+    best = order[..., -1]
+    second = order[..., -2] if ratios.shape[2] > 1 else np.zeros_like(best)
+    picked = ratios.argmax(axis=2)
+    marked = (best >= FILL_THRESHOLD) & (best - second >= FILL_MARGIN)
+    blank = best < BLANK_THRESHOLD
+
+    readings = []
+    for page in range(ratios.shape[0]):
+        page_readings = []
+        for row in range(ratios.shape[1]):
+            if marked[page, row]:
+                page_readings.append((choices[picked[page, row]], True, float(best[page, row])))
+            elif blank[page, row]:
+                page_readings.append(("", True, float(best[page, row])))
+            else:
+                page_readings.append((None, False, float(best[page, row])))
+        readings.append(page_readings)
+    return readings
+
+
+def read_answer_tables(gray_pages, page_template):
+    """
+    Reads the answer table on a batch of same-layout pages.
+    Returns one list of row readings per page (see classify), or None for a page
+    whose table could not be located.
+    """
+    choices = page_template["choices"]
+    n_rows = int(page_template["rows"])
+    header_rows = int(page_template.get("header_rows", 0))
+    label_cols = int(page_template.get("label_cols", 0))
+
+    results = [None] * len(gray_pages)
+    # Pages rendered from the same template share a shape and a grid position, so
+    # each shape group is stacked and read in one vectorized pass.
+    groups = {}
+    for idx, gray in enumerate(gray_pages):
+        box = find_table(gray, page_template.get("region"))
+        if box is not None:
+            groups.setdefault((gray.shape, box), []).append(idx)
+
+    for (shape, box), indices in groups.items():
+        boxes = _cell_boxes(box, n_rows, len(choices), header_rows, label_cols)
+        stack = np.stack([gray_pages[idx] for idx in indices])
+        for idx, readings in zip(indices, classify(fill_ratios(stack, boxes), choices)):
+            results[idx] = readings
+    return results
+
+
+def question_ids(page_template):
+    if page_template.get("question_ids"):
+        return list(page_template["question_ids"])
+    prefix = page_template.get("question_prefix", "Q")
+    first = int(page_template.get("first_question", 1))
+    return [f"{prefix}{first + n}" for n in range(int(page_template["rows"]))]
+
+
+def grade_marked_pages(template, key_images, student_images):
+    """
+    Grades the template's multiple-choice-only pages locally.
+    Returns {page_num: page_data} in grade_batch_exams' {"questions": [...]} schema
+    for every page where the key and all of the student's rows were read with
+    confidence. Other pages are left out so they go to the model as usual.
+    """
+    graded = {}
+    for page_key, page_template in (template or {}).get("pages", {}).items():
+        page_num = int(page_key)
+        if not page_template.get("mc_only") or page_num > min(len(key_images), len(student_images)):
+            continue
+        if student_images[page_num - 1] is None:
+            # Not rendered: a re-grade that reuses this page's stored result.
+            continue
+
+        key_reading, student_reading = read_answer_tables(
+            [decode_page(key_images[page_num - 1]), decode_page(student_images[page_num - 1])],
+            page_template
+        )
+        if key_reading is None or student_reading is None:
+            continue
+        if not all(ok and answer for answer, ok, _ in key_reading):
+            continue
+        if not all(ok for _, ok, _ in student_reading):
+            continue
+
+        points = float(page_template.get("points", 1.0))
+        questions = []
+        for qid, (key_answer, _, _), (student_answer, _, ratio) in zip(question_ids(page_template),
+                                                                        key_reading, student_reading):
+            correct = student_answer == key_answer
+            questions.append({
+                "question_id": qid,
+                "key_literal_transcription": key_answer,
+                "student_literal_transcription": student_answer,
+                "step_by_step_analysis": f"Read locally from the answer table (fill ratio {ratio:.2f}). "
+                                         f"The key requires '{key_answer}', the student marked "
+                                         f"'{student_answer or 'nothing'}'.",
+                "verdict": "CORRECT" if correct else "INCORRECT",
+                "points_possible": points,
+                "points_earned": points if correct else 0.0
+            })
+        graded[page_num] = {"questions": questions}
+    return graded
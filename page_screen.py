@@ -0,0 +1,110 @@
+import numpy as np
+
+from omr import decode_page
+
+
+# A pixel counts as ink below this level; a page with less than BLANK_INK of its area
+# inked (after trimming EDGE_MARGIN of each side, where scanners leave shadows) is blank.
+INK_LEVEL = 160
+BLANK_INK = 0.0005
+EDGE_MARGIN = 0.03
+# Difference hash of HASH_SIZE x HASH_SIZE bits; two pages whose hashes differ in at most
+# DUPLICATE_BITS bits are the same sheet scanned twice.
+HASH_SIZE = 16
+DUPLICATE_BITS = 8
+
+
+def _decode(img_b64):
+    """decode_page, or None for an image that can't be decoded (it goes to the model as is)."""
+    try:
+        return decode_page(img_b64)
+    except (RuntimeError, ValueError):
+        return None
+
+
+def _trim(gray):
+    dy, dx = int(gray.shape[0] * EDGE_MARGIN), int(gray.shape[1] * EDGE_MARGIN)
+    return gray[dy:gray.shape[0] - dy, dx:gray.shape[1] - dx]
+
+
+def ink_ratio(gray):
+    """Share of a grayscale page's pixels (margins excluded) that are ink."""
+    return float((_trim(gray) < INK_LEVEL).mean())
+
+
+def dhash(gray):
+    """
+    Perceptual difference hash of a grayscale page: the page is averaged down to
+    HASH_SIZE x (HASH_SIZE + 1) blocks and each bit says whether a block is brighter
+    than its right neighbour. Rescans of one sheet land within a few bits of each other.
+    """
+    gray = _trim(gray).astype(np.float32)
+    rows = np.linspace(0, gray.shape[0], HASH_SIZE + 1).astype(int)[:-1]
+    cols = np.linspace(0, gray.shape[1], HASH_SIZE + 2).astype(int)[:-1]
+    blocks = np.add.reduceat(np.add.reduceat(gray, rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(np.append(rows, gray.shape[0])), np.diff(np.append(cols, gray.shape[1])))
+    blocks = blocks / counts
+    return (blocks[:, 1:] > blocks[:, :-1]).ravel()
+
+
+def blank_page(key_entry):
+    """A page with no answer written, in grade_batch_exams' {"questions": [...]} schema."""
+    questions = []
+    for question in (key_entry or {}).get("questions", []):
+        points = float(question.get("points_possible") or 0)
+        questions.append({
+            "question_id": question.get("question_id"),
+            "key_literal_transcription": question.get("expected_answer"),
+            "student_literal_transcription": "",
+            "step_by_step_analysis": "Detected locally as a blank page: nothing was written.",
+            "verdict": "INCORRECT",
+            "points_possible": points,
+            "points_earned": 0.0
+        })
+    return {"questions": questions}
+
+
+def screen_pages(key_images, student_images, key_transcriptions=None):
+    """
+    Cheap local pass over a student's rendered pages before any model request.
+    Returns (pregraded, duplicates):
+    - pregraded is {page_num: page_data} for pages that need no model call: pages
+      whose transcribed key has no questions (cover and instruction pages), and blank
+      pages, recorded with zero points for every question of the transcribed key (or
+      with no questions when the key page itself is blank). Blank pages without a
+      usable transcription still go to the model, which knows the page's points.
+    - duplicates is {page_num: earlier_page_num} for non-blank pages that look like a
+      second scan of an earlier page; they are flagged, not skipped.
+    """
+    pregraded = {}
+    duplicates = {}
+    hashes = []
+    for page_idx, student_page in enumerate(student_images[:len(key_images)]):
+        page_num = page_idx + 1
+        if student_page is None:
+            continue
+        key_entry = None
+        if key_transcriptions and page_idx < len(key_transcriptions):
+            key_entry = key_transcriptions[page_idx]
+        if key_entry and not key_entry.get("requires_key_image") and not key_entry.get("questions"):
+            pregraded[page_num] = {"questions": []}
+            continue
+
+        gray = _decode(student_page)
+        if gray is None:
+            continue
+        if ink_ratio(gray) < BLANK_INK:
+            key_gray = None if key_entry else _decode(key_images[page_idx])
+            if key_entry:
+                pregraded[page_num] = blank_page(key_entry)
+            elif key_gray is not None and ink_ratio(key_gray) < BLANK_INK:
+                pregraded[page_num] = {"questions": []}
+            continue
+
+        page_hash = dhash(gray)
+        for earlier_num, earlier_hash in hashes:
+            if np.count_nonzero(page_hash != earlier_hash) <= DUPLICATE_BITS:
+                duplicates[page_num] = earlier_num
+                break
+        hashes.append((page_num, page_hash))
+    return pregraded, duplicates
@@ -0,0 +1,218 @@
+import base64
+import json
+import math
+import fitz
+import numpy as np
+
+
+# The profile used when an exam has none; it reproduces the original 200 DPI colour JPEGs.
+DEFAULT_PROFILE = {
+    "dpi": 200,
+    "grayscale": False,
+    "jpeg_quality": 95,
+    "autocrop": False,
+    "max_dimension": None,
+    # "low" or "high"; pages can override it under "pages": {"3": {"detail": "high"}}.
+    "detail": "high",
+    # Where the student's ID and name are written on page 1, as [x0, y0, x1, y1] page
+    # fractions; only this strip is sent when identity is read on its own.
+    "header_region": [0, 0, 1, 0.25]
+}
+HEADER_MAX_DIMENSION = 1024
+# A pixel is background when it is at least this bright; autocrop keeps CROP_PADDING
+# pixels of it around the content so marks at the edge aren't clipped.
+WHITE_LEVEL = 235
+CROP_PADDING = 16
+
+# Vision token accounting of the chat completions API for one image.
+LOW_DETAIL_TOKENS = 85
+TILE_TOKENS = 170
+TILE_SIZE = 512
+
+
+def load_profile(profile_json):
+    """The exam's rendering profile (a JSON object) merged over DEFAULT_PROFILE."""
+    profile = dict(DEFAULT_PROFILE)
+    if profile_json:
+        profile.update(json.loads(profile_json) if isinstance(profile_json, str) else profile_json)
+    return profile
+
+
+def validate_profile(profile):
+    """
+    Raises ValueError for a rendering profile (parsed JSON) with a field that
+    render_page, crop_region or page_detail couldn't use, so it is never saved.
+    """
+    def number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    if not isinstance(profile, dict):
+        raise ValueError("the profile must be a JSON object")
+    unknown = sorted(set(profile) - set(DEFAULT_PROFILE) - {"pages"})
+    if unknown:
+        raise ValueError(f'unknown field "{unknown[0]}"')
+    merged = dict(DEFAULT_PROFILE, **profile)
+    if not number(merged["dpi"]) or not 50 <= merged["dpi"] <= 600:
+        raise ValueError('"dpi" must be a number between 50 and 600')
+    if not number(merged["jpeg_quality"]) or not 10 <= merged["jpeg_quality"] <= 100:
+        raise ValueError('"jpeg_quality" must be a number between 10 and 100')
+    for flag in ("grayscale", "autocrop"):
+        if not isinstance(merged[flag], bool):
+            raise ValueError(f'"{flag}" must be true or false')
+    max_dimension = merged["max_dimension"]
+    if max_dimension is not None and not (number(max_dimension) and max_dimension >= 100):
+        raise ValueError('"max_dimension" must be null or at least 100 pixels')
+    region = merged["header_region"]
+    if not (isinstance(region, list) and len(region) == 4 and all(number(v) and 0 <= v <= 1 for v in region)
+            and region[0] < region[2] and region[1] < region[3]):
+        raise ValueError('"header_region" must be [x0, y0, x1, y1] page fractions with x0 < x1 and y0 < y1')
+    pages = merged.get("pages", {})
+    if not isinstance(pages, dict) or not all(key.isdigit() and isinstance(page, dict)
+                                              for key, page in pages.items()):
+        raise ValueError('"pages" must map page numbers to objects')
+    if any(detail not in ("low", "high") for detail in
+           [merged["detail"]] + [page.get("detail", "high") for page in pages.values()]):
+        raise ValueError('"detail" must be "low" or "high"')
+
+
+def page_detail(profile, page_num, omr_template=None):
+    """
+    Vision detail level for one page: an explicit per-page setting wins, then pages the
+    OMR template marks as multiple-choice only go at "low", everything else at the
+    profile's default (circuit diagrams and handwriting need "high").
+    """
+    page_profile = (profile.get("pages") or {}).get(str(page_num), {})
+    if page_profile.get("detail"):
+        return page_profile["detail"]
+    omr_page = ((omr_template or {}).get("pages") or {}).get(str(page_num), {})
+    if omr_page.get("mc_only"):
+        return "low"
+    return profile.get("detail", "high")
+
+
+def _content_box(gray):
+    """(y0, y1, x0, x1) of the non-background pixels plus padding, or None for a blank page."""
+    ink = gray < WHITE_LEVEL
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if rows.size == 0:
+        return None
+    height, width = gray.shape
+    return (max(rows[0] - CROP_PADDING, 0), min(rows[-1] + CROP_PADDING + 1, height),
+            max(cols[0] - CROP_PADDING, 0), min(cols[-1] + CROP_PADDING + 1, width))
+
+
+def _crop(pix):
+    """Trims the whitespace margins of a pixmap."""
+    samples = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    pixels = samples[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+    gray = pixels[..., 0] if pix.n == 1 else pixels[..., :3].min(axis=2)
+    box = _content_box(gray)
+    if box is None or box == (0, pix.height, 0, pix.width):
+        return pix
+    y0, y1, x0, x1 = (int(v) for v in box)
+    cropped = np.ascontiguousarray(pixels[y0:y1, x0:x1])
+    return fitz.Pixmap(pix.colorspace, x1 - x0, y1 - y0, cropped.tobytes(), False)
+
+
+def render_page(page, profile=None):
+    """Renders one fitz page to JPEG bytes according to a rendering profile."""
+    profile = profile or DEFAULT_PROFILE
+    dpi = profile["dpi"]
+    if profile.get("max_dimension"):
+        # Lower the DPI rather than resampling afterwards, so long pages stay sharp per pixel.
+        longest = max(page.rect.width, page.rect.height)
+        dpi = min(dpi, profile["max_dimension"] * 72 / longest)
+    dpi = int(dpi)
+
+    colorspace = fitz.csGRAY if profile.get("grayscale") else fitz.csRGB
+    pix = page.get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+    if profile.get("autocrop"):
+        pix = _crop(pix)
+    return pix.tobytes("jpeg", jpg_quality=int(profile.get("jpeg_quality", 95)))
+
+
+def crop_region(img_b64, region, max_dimension=HEADER_MAX_DIMENSION, jpeg_quality=85):
+    """Cuts a [x0, y0, x1, y1] page-fraction region out of a base64 JPEG and downscales it."""
+    pix = fitz.Pixmap(base64.b64decode(img_b64))
+    x0, y0, x1, y1 = region
+    samples = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    pixels = samples[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+    top, bottom = int(y0 * pix.height), max(int(y1 * pix.height), int(y0 * pix.height) + 1)
+    left, right = int(x0 * pix.width), max(int(x1 * pix.width), int(x0 * pix.width) + 1)
+    cropped = np.ascontiguousarray(pixels[top:bottom, left:right])
+    pix = fitz.Pixmap(pix.colorspace, right - left, bottom - top, cropped.tobytes(), False)
+
+    # Pixmap.shrink halves both sides per step, which is plenty for a header strip.
+    steps = 0
+    while max(pix.width, pix.height) >> steps > max_dimension:
+        steps += 1
+    if steps:
+        pix.shrink(steps)
+    return base64.b64encode(pix.tobytes("jpeg", jpg_quality=jpeg_quality)).decode('utf-8')
+
+
+def iter_rendered_pages(pdf_path, profile=None, pages=None):
+    """Yields the pages of a PDF one at a time as base64 JPEGs (None for pages not in `pages`)."""
+    doc = fitz.open(pdf_path)
+    try:
+        for page_idx, page in enumerate(doc):
+            if pages is not None and page_idx + 1 not in pages:
+                yield None
+                continue
+            yield base64.b64encode(render_page(page, profile)).decode('utf-8')
+    finally:
+        doc.close()
+
+
+def jpeg_size(img_bytes):
+    """(width, height) read from a JPEG's start-of-frame header, or None."""
+    if img_bytes[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    while pos + 9 < len(img_bytes):
+        if img_bytes[pos] != 0xFF:
+            return None
+        marker = img_bytes[pos + 1]
+        length = int.from_bytes(img_bytes[pos + 2:pos + 4], "big")
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(img_bytes[pos + 5:pos + 7], "big")
+            width = int.from_bytes(img_bytes[pos + 7:pos + 9], "big")
+            return width, height
+        pos += 2 + length
+    return None
+
+
+def image_tokens(width, height, detail="high"):
+    """Prompt tokens the model bills for one image at the given detail level."""
+    if detail == "low":
+        return LOW_DETAIL_TOKENS
+    # Fit within 2048x2048, then scale the shortest side down to 768, and count 512 px tiles.
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+    return LOW_DETAIL_TOKENS + TILE_TOKENS * tiles
+
+
+def image_part(img_b64, detail="high"):
+    """A chat-completions image content part for a base64 JPEG."""
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:image/jpeg;base64,{img_b64}", "detail": detail}
+    }
+
+
+def image_part_cost(part):
+    """(bytes, tokens) of an image content part, from its JPEG header and detail level."""
+    img_b64 = part["image_url"]["url"].split(",", 1)[1]
+    n_bytes = len(img_b64) * 3 // 4 - img_b64[-2:].count("=")
+    # The frame header sits right after the JPEG's few small leading segments.
+    try:
+        size = jpeg_size(base64.b64decode(img_b64[:8192]))
+    except ValueError:
+        size = None
+    if size is None:
+        return n_bytes, None
+    return n_bytes, image_tokens(size[0], size[1], part["image_url"].get("detail", "high"))
@@ -0,0 +1,41 @@
+import numpy as np
+
+import analytics
+
+
+def students():
+    return [
+        (30.0, {"1:Q1": (1, 1, "a"), "1:Q2": (2, 2, "b) lw")}),
+        (15.0, {"1:Q1": (1, 1, "a"), "1:Q2": (0, 2, "c")}),
+        (5.0, {"1:Q1": (0, 1, "d"), "1:Q2": (0, 2, "")}),
+        (None, {"1:Q1": (1, 1, "a")}),
+    ]
+
+
+def test_summary_matches_direct_computation():
+    """Difficulty, point-biserial and distractor counts agree with a plain NumPy computation."""
+    summary = analytics.summarize(analytics.accumulate(students()))
+
+    scores = np.array([30.0, 15.0, 5.0])
+    q2 = np.array([1.0, 0.0, 0.0])
+    assert summary["students"] == 3 and summary["mean"] == round(scores.mean(), 2)  # nosec B101
+    assert summary["std_dev"] == round(scores.std(), 2)  # nosec B101
+    assert [b["count"] for b in summary["histogram"]][0] == 0  # nosec B101
+    assert sum(b["count"] for b in summary["histogram"]) == 3  # nosec B101
+
+    first, second = summary["questions"]
+    assert first["question_id"] == "Q1" and first["difficulty"] == round(2 / 3, 3)  # nosec B101
+    assert second["discrimination"] == round(np.corrcoef(q2, scores)[0, 1], 3)  # nosec B101
+    assert second["answers"] == {"b": 1, "c": 1, "(blank)": 1}  # nosec B101
+
+
+def test_merge_adds_and_removes_batches():
+    """Removing a student's batch and adding a re-graded one equals recomputing from scratch."""
+    everyone = students()
+    stats = analytics.merge(analytics.accumulate(everyone[:2]), analytics.accumulate(everyone[2:]))
+    regraded = (25.0, {"1:Q1": (1, 1, "a"), "1:Q2": (2, 2, "b")})
+    analytics.merge(stats, analytics.accumulate([everyone[1]]), -1)
+    analytics.merge(stats, analytics.accumulate([regraded]))
+
+    expected = analytics.accumulate([everyone[0], regraded] + everyone[2:])
+    assert analytics.summarize(stats) == analytics.summarize(expected)  # nosec B101
@@ -1,8 +1,14 @@
 import io
+import os
+import subprocess  # nosec B404
+import sys
+import threading
+import time
 import pytest
 from unittest.mock import patch
-from app import app, db, User, Exam
-from datetime import datetime
+from app import app, db, User, Exam, ExamKey, Result, ResultItem, Student, GradingJob, GradingTask
+from datetime import datetime, timedelta
+import app as app_module
 
 
 @pytest.fixture
@@ -36,6 +42,79 @@ def test_homepage(client):
     assert b"Visionary Graders" in r.data  # nosec B101
 
 
+def test_init_db_command_is_idempotent(client):
+    """`flask init-db` creates the schema and one admin account, however often it runs."""
+    with app.app_context():
+        db.drop_all()
+
+    runner = app.test_cli_runner()
+    for _ in range(2):
+        outcome = runner.invoke(args=["init-db"])
+        assert outcome.exit_code == 0  # nosec B101
+
+    with app.app_context():
+        assert User.query.filter_by(Username='admin').count() == 1  # nosec B101
+
+
+def test_rasterize_submissions_renders_through_the_process_pool(tmp_path, monkeypatch):
+    """Submissions come back in upload order from the process pool; a bad PDF fails only itself."""
+    import fitz
+    from concurrent.futures import ProcessPoolExecutor
+
+    paths = []
+    for name, page_count in (("a.pdf", 2), ("c.pdf", 3)):
+        doc = fitz.open()
+        for n in range(page_count):
+            doc.new_page(width=200, height=280).insert_text((20, 40), f"{name} page {n + 1}")
+        doc.save(tmp_path / name)
+        doc.close()
+        paths.append(str(tmp_path / name))
+    (tmp_path / "b.pdf").write_bytes(b"not a pdf")
+    files = [("a.pdf", paths[0]), ("b.pdf", str(tmp_path / "b.pdf")), ("c.pdf", paths[1])]
+
+    pool = ProcessPoolExecutor(max_workers=2)
+    monkeypatch.setattr(app_module, "_raster_pool", pool)
+    try:
+        rendered = list(app_module.rasterize_submissions(files, depth=2, profile={"dpi": 50}))
+    finally:
+        pool.shutdown()
+
+    assert [name for name, _, _, _ in rendered] == ["a.pdf", "b.pdf", "c.pdf"]  # nosec B101
+    assert [len(images) if images else None for _, _, images, _ in rendered] == [2, None, 3]  # nosec B101
+    assert [error is not None for _, _, _, error in rendered] == [False, True, False]  # nosec B101
+
+
+def test_upgrade_schema_adds_columns_to_existing_tables(tmp_path):
+    """A database created before OmrTemplate, RenderProfile and KeyId existed gains the columns."""
+    from sqlalchemy import create_engine, inspect, text
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE exams (ExamId INTEGER PRIMARY KEY, CreatedBy INTEGER NOT NULL, "
+                          "Subject VARCHAR(100) NOT NULL, Title VARCHAR(200) NOT NULL, ExamDate DATE)"))
+        conn.execute(text("CREATE TABLE results (ResultId INTEGER PRIMARY KEY, ExamId INTEGER NOT NULL, "
+                          "StudentId INTEGER NOT NULL, Score FLOAT, AIFeedback TEXT, GradedAt DATETIME)"))
+        conn.execute(text("INSERT INTO exams (CreatedBy, Subject, Title) VALUES (1, 'Arch', 'Midterm')"))
+
+    for _ in range(2):
+        db.metadata.create_all(engine)
+        app_module.upgrade_schema(engine)
+
+    columns = inspect(engine)
+    assert {"OmrTemplate", "RenderProfile"} <= {c["name"] for c in columns.get_columns("exams")}  # nosec B101
+    assert "KeyId" in {c["name"] for c in columns.get_columns("results")}  # nosec B101
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT Title, OmrTemplate FROM exams")).one() == ("Midterm", None)  # nosec B101
+
+
+def test_import_does_not_load_heavy_dependencies():
+    """Web workers boot without openai, PyMuPDF or NumPy; they load with the first grading."""
+    code = "import sys, app; print(sorted({'openai', 'fitz', 'numpy'} & set(sys.modules)))"
+    env = dict(os.environ, TESTING="True")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env,  # nosec B603
+                         cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    assert out.stdout.strip().splitlines()[-1] == "[]"  # nosec B101
+
+
 def test_post_without_files(client):
     """Test submitting the form without files returns safely."""
    
@@ -85,4 +164,585 @@ def test_post_with_files(mock_pdf, mock_extract, mock_grade, client):
     r = client.post("/grading", data=data, content_type="multipart/form-data")
 
     
-    assert r.status_code == 200  # nosec B101
\ No newline at end of file
+    assert r.status_code == 200  # nosec B101
+
+
+@patch('app.grade_batch_exams')
+@patch('app.extract_student_info')
+@patch('app.pdf_to_base64_images')
+def test_later_batches_reuse_exam_key(mock_pdf, mock_extract, mock_grade, client):
+    """A second batch without a key file reuses the key rendered for the first one."""
+
+    mock_pdf.return_value = ["fake_base64_image_data"]
+    mock_extract.return_value = ("12345", "John Doe")
+    mock_grade.return_value = "FINAL SCALED SCORE: 25 / 30"
+
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+        sess['user_id'] = 1
+
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.commit()
+        exam_id = test_exam.ExamId
+
+    for batch, key in enumerate([(io.BytesIO(b"fake key pdf data"), 'key.pdf'), None]):
+        data = {
+            'student': (io.BytesIO(f"fake student pdf data {batch}".encode()), f'student{batch}.pdf'),
+            'exam_id': str(exam_id),
+            'session_id': f'test_session_{batch}'
+        }
+        if key:
+            data['key'] = key
+        r = client.post("/grading", data=data, content_type="multipart/form-data")
+        assert b"Grading Submissions" in r.data  # nosec B101
+
+    with app.app_context():
+        assert ExamKey.query.filter_by(ExamId=exam_id).count() == 1  # nosec B101
+
+
+@patch('app.pdf_to_base64_images')
+def test_duplicate_uploads_are_skipped(mock_pdf, client):
+    """Re-uploading a scan already queued for the exam, or twice in one batch, grades it once."""
+
+    mock_pdf.return_value = ["fake_base64_image_data"]
+
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+        sess['user_id'] = 1
+
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.commit()
+        exam_id = test_exam.ExamId
+
+    data = {
+        'key': (io.BytesIO(b"fake key pdf data"), 'key.pdf'),
+        'student': [(io.BytesIO(b"same scan"), 'a.pdf'), (io.BytesIO(b"same scan"), 'b.pdf')],
+        'exam_id': str(exam_id),
+        'session_id': 'dup_session_1'
+    }
+    r = client.post("/grading", data=data, content_type="multipart/form-data")
+    assert b"Grading Submissions" in r.data  # nosec B101
+
+    data = {
+        'student': (io.BytesIO(b"same scan"), 'c.pdf'),
+        'exam_id': str(exam_id),
+        'session_id': 'dup_session_2'
+    }
+    r = client.post("/grading", data=data, content_type="multipart/form-data")
+    assert b"already graded or queued" in r.data  # nosec B101
+
+    with app.app_context():
+        assert GradingTask.query.count() == 1  # nosec B101
+        assert GradingJob.query.get('dup_session_2') is None  # nosec B101
+        # Graded without a student ID (e.g. the identity request failed): uploading it again retries it.
+        GradingTask.query.update({GradingTask.Status: 'done', GradingTask.ResultId: None})
+        db.session.commit()
+
+    data['student'] = (io.BytesIO(b"same scan"), 'c.pdf')
+    data['session_id'] = 'dup_session_3'
+    r = client.post("/grading", data=data, content_type="multipart/form-data")
+    assert b"Grading Submissions" in r.data  # nosec B101
+
+
+def test_collect_uploads_expires_graded_scans(client, tmp_path, monkeypatch):
+    """Retention keeps only uploads of unfinished tasks; re-grading an expired scan asks for it again."""
+    monkeypatch.setattr(app_module, "UPLOAD_STORE", str(tmp_path))
+    paths = {}
+    for name in ("graded", "failed", "queued"):
+        _, paths[name], _ = app_module.upload_store.store_stream(io.BytesIO(name.encode()), str(tmp_path))
+        os.utime(paths[name], (0, 0))
+
+    with app.app_context():
+        exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(exam)
+        db.session.commit()
+        student = Student(FullName="John Doe", StudentCode="12345")
+        key = ExamKey(ExamId=exam.ExamId, KeyHash="k" * 64, PageCount=1)
+        db.session.add_all([student, key])
+        db.session.commit()
+        result = Result(ExamId=exam.ExamId, StudentId=student.StudentId, Score=10.0, KeyId=key.KeyId)
+        db.session.add(result)
+        db.session.add(GradingJob(JobId="old_job", ExamId=exam.ExamId, KeyId=key.KeyId, Total=3))
+        db.session.commit()
+        db.session.add(GradingTask(JobId="old_job", Position=0, Filename="a.pdf", FilePath=paths["graded"],
+                                   Status='done', ResultId=result.ResultId))
+        db.session.add(GradingTask(JobId="old_job", Position=1, Filename="b.pdf", FilePath=paths["failed"],
+                                   Status='failed'))
+        db.session.add(GradingTask(JobId="old_job", Position=2, Filename="c.pdf", FilePath=paths["queued"]))
+        db.session.commit()
+
+        assert app_module.collect_uploads(force=True) == 2  # nosec B101
+        assert app_module.enqueue_regrade_job("regrade_gone", exam.ExamId, key, ["Q1"]) == (0, ["a.pdf"])  # nosec B101
+    assert [os.path.exists(paths[name]) for name in ("graded", "failed", "queued")] == [False, False, True]  # nosec B101
+
+
+@patch('app.grade_batch_exams')
+@patch('app.extract_student_info')
+@patch('app.pdf_to_base64_images')
+def test_grading_job_runs_from_queue(mock_pdf, mock_extract, mock_grade, client, monkeypatch):
+    """Uploads become durable tasks; draining the job stores results and finishes the job."""
+
+    mock_pdf.return_value = ["fake_base64_image_data"]
+    mock_extract.return_value = ("12345", "John Doe")
+    mock_grade.return_value = "FINAL SCALED SCORE: 25 / 30"
+
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+        sess['user_id'] = 1
+
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.commit()
+        exam_id = test_exam.ExamId
+
+    data = {
+        'key': (io.BytesIO(b"fake key pdf data"), 'key.pdf'),
+        'student': [(io.BytesIO(b"student one"), 'one.pdf'), (io.BytesIO(b"student two"), 'two.pdf')],
+        'exam_id': str(exam_id),
+        'session_id': 'queued_job'
+    }
+    client.post("/grading", data=data, content_type="multipart/form-data")
+
+    with app.app_context():
+        assert GradingTask.query.filter_by(JobId='queued_job', Status='queued').count() == 2  # nosec B101
+        app_module.background_grading_task('queued_job')
+
+        assert GradingTask.query.filter_by(JobId='queued_job', Status='done').count() == 2  # nosec B101
+        assert GradingJob.query.get('queued_job').Status == 'done'  # nosec B101
+        assert Result.query.filter_by(ExamId=exam_id, Score=25.0).count() == 2  # nosec B101
+
+    r = client.get("/grading/progress/queued_job")
+    assert b'"done": true' in r.data  # nosec B101
+    assert b"id: " in r.data  # nosec B101
+
+    # Past the stream cap the loading page is refused a stream and polls instead.
+    monkeypatch.setattr(app_module, "progress_streams", threading.BoundedSemaphore(1))
+    app_module.progress_streams.acquire()
+    assert client.get("/grading/progress/queued_job").status_code == 503  # nosec B101
+    assert client.get("/grading/progress/queued_job/poll").get_json()["done"] is True  # nosec B101
+
+    # Stage timings are attributed to the job and exported process-wide.
+    job_metrics = client.get("/grading/jobs/queued_job/metrics").get_json()["metrics"]
+    assert job_metrics["pages_rendered"] == 2 and job_metrics["grading_seconds"] > 0  # nosec B101
+    exported = client.get("/metrics").data.decode()
+    assert 'grading_stage_seconds_bucket{stage="grading",le="+Inf"}' in exported  # nosec B101
+    assert 'grading_tasks_total{status="done"}' in exported  # nosec B101
+
+
+def test_stale_running_tasks_are_requeued(client):
+    """Tasks left running by a crashed worker go back to the queue once their lease lapses."""
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.flush()
+        exam_key = ExamKey(ExamId=test_exam.ExamId, KeyHash="0" * 64, PageCount=0)
+        db.session.add(exam_key)
+        db.session.flush()
+        db.session.add(GradingJob(JobId='crashed', ExamId=test_exam.ExamId, KeyId=exam_key.KeyId, Total=2))
+        lapsed = datetime.utcnow() - timedelta(seconds=app_module.GRADING_TASK_LEASE + 60)
+        db.session.add(GradingTask(JobId='crashed', Position=0, Filename='a.pdf', FilePath='a.pdf',
+                                   Status='running', Attempts=1, ClaimedAt=lapsed))
+        db.session.add(GradingTask(JobId='crashed', Position=1, Filename='b.pdf', FilePath='b.pdf',
+                                   Status='running', Attempts=1, ClaimedAt=datetime.utcnow()))
+        db.session.commit()
+
+        assert app_module.requeue_stale_tasks() == 1  # nosec B101
+        assert GradingTask.query.filter_by(Filename='a.pdf').first().Status == 'queued'  # nosec B101
+        assert GradingTask.query.filter_by(Filename='b.pdf').first().Status == 'running'  # nosec B101
+
+
+def test_progress_broker_wakes_waiting_listener():
+    """A listener blocked on a job returns as soon as a newer version is published."""
+    broker = app_module.ProgressBroker()
+    threading.Timer(0.05, broker.publish, args=("job", 2, {"current": 1})).start()
+
+    start = time.monotonic()
+    event = broker.wait("job", 1, timeout=5)
+
+    assert event == (2, {"current": 1})  # nosec B101
+    assert time.monotonic() - start < 1  # nosec B101
+    assert broker.wait("job", 2, timeout=0.05) is None  # nosec B101
+
+
+def test_progress_broker_tracks_jobs_graded_here():
+    """Streams of a job graded in this process skip the DB poll while it is graded."""
+    broker = app_module.ProgressBroker()
+    with broker.grading("job"):
+        with broker.grading("job"):
+            assert broker.graded_here("job")  # nosec B101
+        assert broker.graded_here("job")  # nosec B101
+    assert not broker.graded_here("job")  # nosec B101
+
+
+def test_persist_results_upserts_students_in_bulk(client):
+    """Known students are reused, new ones are created once, and every graded entry gets a result."""
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.add(Student(FullName="Known", StudentCode="100", Class="A"))
+        db.session.commit()
+
+        graded = [
+            {"code": "100", "name": "Known", "score": 20.0, "report": "r1"},
+            {"code": "200", "name": "New", "score": 10.0, "report": "r2"},
+            {"code": "200", "name": "New", "score": 12.0, "report": "r3"},
+            {"code": None, "name": None, "score": 0.0, "report": "r4"},
+        ]
+        result_ids = app_module.persist_results(test_exam.ExamId, graded)
+        db.session.commit()
+
+        assert result_ids[3] is None and all(result_ids[:3])  # nosec B101
+        assert Student.query.count() == 2  # nosec B101
+        assert Student.query.filter_by(StudentCode="100").first().Class == "A"  # nosec B101
+        assert Result.query.filter_by(ExamId=test_exam.ExamId).count() == 3  # nosec B101
+
+
+def test_result_items_are_stored_and_scored_in_sql(client):
+    """Per-question items are stored with the result and the score is recomputed from them."""
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.commit()
+
+        items = [
+            {"student": "Ann", "page": 1, "question_id": "Q1", "verdict": "CORRECT",
+             "points_possible": 2, "points_earned": 2, "key_literal_transcription": "4",
+             "student_literal_transcription": "4", "step_by_step_analysis": "ok"},
+            {"student": "Ann", "page": 2, "question_id": "Q2", "verdict": "INCORRECT",
+             "points_possible": 2, "points_earned": 0, "key_literal_transcription": "x=1",
+             "student_literal_transcription": "x=2", "step_by_step_analysis": "wrong"},
+        ]
+        graded = [
+            {"code": "300", "name": "Ann", "score": 0.0, "report": "report", "items": items},
+            {"code": "400", "name": "Bob", "score": 7.5, "report": "no items"},
+        ]
+        result_ids = app_module.persist_results(test_exam.ExamId, graded)
+        db.session.commit()
+
+        scored = db.session.get(Result, result_ids[0])
+        assert scored.Score == 15.0  # nosec B101
+        assert [item.QuestionId for item in scored.items] == ["Q1", "Q2"]  # nosec B101
+        assert db.session.get(Result, result_ids[1]).Score == 7.5  # nosec B101
+
+        with client.session_transaction() as sess:
+            sess['logged_in'] = True
+        response = client.get(f"/results/{result_ids[0]}")
+        assert b"x=2" in response.data and b"INCORRECT" in response.data  # nosec B101
+
+        db.session.delete(scored)
+        db.session.commit()
+        assert ResultItem.query.count() == 0  # nosec B101
+
+
+def test_results_api_pages_with_keyset_cursor(client):
+    """Pages follow (GradedAt, ResultId) newest first, honour filters and never repeat rows."""
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.commit()
+        graded = [{"code": str(500 + n), "name": f"Student {n}", "score": float(n), "report": ""}
+                  for n in range(5)]
+        app_module.persist_results(test_exam.ExamId, graded)
+        # Two results share a timestamp so the ResultId tiebreak is exercised.
+        same_time = datetime.utcnow()
+        for result in Result.query.all():
+            result.GradedAt = same_time if result.Score < 2 else same_time + timedelta(minutes=result.Score)
+        db.session.commit()
+
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+
+    seen, cursor = [], ""
+    while True:
+        page = client.get(f"/api/results?limit=2&after={cursor}").get_json()
+        seen += [item["score"] for item in page["items"]]
+        if not page["next"]:
+            break
+        cursor = page["next"]
+    assert seen == [4.0, 3.0, 2.0, 1.0, 0.0]  # nosec B101
+
+    page = client.get("/api/results?min_score=1&max_score=3&q=Student").get_json()
+    assert [item["score"] for item in page["items"]] == [3.0, 2.0, 1.0]  # nosec B101
+    # The search is a prefix match (so the indexes apply), with LIKE wildcards taken literally.
+    assert client.get("/api/results?q=tudent").get_json()["items"] == []  # nosec B101
+    assert client.get("/api/results?q=%25tudent").get_json()["items"] == []  # nosec B101
+
+    page = client.get("/api/students?limit=3").get_json()
+    assert len(page["items"]) == 3 and page["next"]  # nosec B101
+    rest = client.get(f"/api/students?limit=3&after={page['next']}").get_json()
+    assert len(rest["items"]) == 2 and rest["next"] is None  # nosec B101
+    assert client.get("/results").status_code == 200  # nosec B101
+    assert client.get("/students?q=Student").status_code == 200  # nosec B101
+
+
+def test_small_job_is_not_stuck_behind_a_large_one(client):
+    """Claims interleave waiting jobs one task at a time, with small jobs weighted ahead."""
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.flush()
+        exam_key = ExamKey(ExamId=test_exam.ExamId, KeyHash="1" * 64, PageCount=0)
+        db.session.add(exam_key)
+        db.session.flush()
+        for job_id, size, created in (("year", 30, datetime.utcnow() - timedelta(minutes=5)),
+                                      ("quiz", 3, datetime.utcnow())):
+            db.session.add(GradingJob(JobId=job_id, ExamId=test_exam.ExamId, KeyId=exam_key.KeyId,
+                                      Total=size, CreatedAt=created))
+            for position in range(size):
+                db.session.add(GradingTask(JobId=job_id, Position=position, Filename=f"{job_id}{position}.pdf",
+                                           FilePath="x.pdf"))
+        db.session.commit()
+
+        claimed = []
+        for _ in range(4):
+            tasks = app_module.claim_tasks("worker")
+            assert len(tasks) == 1  # nosec B101
+            claimed.append(tasks[0].JobId)
+        assert claimed == ["year", "quiz", "quiz", "quiz"]  # nosec B101
+
+        # With only one job left waiting, batches go back to full size.
+        assert len(app_module.claim_tasks("worker")) == app_module.GRADING_CLAIM_SIZE  # nosec B101
+        progress = app_module.job_progress("year")
+        assert progress["queue_depth"] == 29 - app_module.GRADING_CLAIM_SIZE  # nosec B101
+
+
+@patch('app.grade_batch_exams')
+@patch('app.extract_student_info')
+@patch('app.pdf_to_base64_images')
+def test_regrade_reruns_only_changed_key_pages(mock_pdf, mock_extract, mock_grade, client):
+    """A corrected key re-grades only its changed pages and updates the existing Result in place."""
+    key_pages = ["k1", "k2"]
+
+    def render(path, profile=None, pages=None):
+        with open(path, "rb") as f:
+            is_key = f.read().startswith(b"key")
+        images = list(key_pages) if is_key else ["s1", "s2"]
+        return [image if pages is None or n + 1 in pages else None for n, image in enumerate(images)]
+
+    def grade(submissions, key_images, stats=None, on_page=None, key_transcriptions=None,
+              pregraded=None, items=None, page_details=None, identities=None, refresh=None):
+        name, images = next(iter(submissions.items()))
+        reused = (pregraded or {}).get(name, {})
+        for page_num in range(1, len(images) + 1):
+            questions = reused.get(page_num, {}).get("questions") or [{
+                "question_id": f"Q{page_num}", "verdict": "CORRECT", "points_possible": 1.0,
+                "points_earned": 1.0 if key_images[page_num - 1] != "k2" else 0.0}]
+            items.extend({"student": name, "page": page_num, **q} for q in questions)
+        return "FINAL SCALED SCORE: 0 / 30"
+
+    mock_pdf.side_effect = render
+    mock_extract.return_value = ("12345", "John Doe")
+    mock_grade.side_effect = grade
+
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+        sess['user_id'] = 1
+
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.commit()
+        exam_id = test_exam.ExamId
+
+    client.post("/grading", data={
+        'key': (io.BytesIO(b"key v1"), 'key.pdf'),
+        'student': (io.BytesIO(b"student one"), 'regrade_one.pdf'),
+        'exam_id': str(exam_id),
+        'session_id': 'first_pass'
+    }, content_type="multipart/form-data")
+    with app.app_context():
+        app_module.background_grading_task('first_pass')
+        assert Result.query.one().Score == 15.0  # nosec B101
+
+    key_pages[1] = "k2-fixed"
+    r = client.post(f"/exams/{exam_id}/regrade", data={'key': (io.BytesIO(b"key v2"), 'key.pdf')},
+                    content_type="multipart/form-data")
+    assert b"Grading Submissions" in r.data  # nosec B101
+
+    with app.app_context():
+        task = GradingTask.query.filter(GradingTask.RegradeResultId.isnot(None)).one()
+        assert task.RegradePages == "2"  # nosec B101
+        app_module.background_grading_task(task.JobId)
+
+        result = Result.query.one()
+        assert result.Score == 30.0  # nosec B101
+        assert [item.PageNumber for item in result.items] == [1, 2]  # nosec B101
+        assert result.KeyId == GradingJob.query.get(task.JobId).KeyId  # nosec B101
+        submissions, _ = mock_grade.call_args[0][:2]
+        assert list(submissions.values()) == [[None, "s2"]]  # nosec B101
+        assert list(mock_grade.call_args[0][5]["regrade_one.pdf"]) == [1]  # nosec B101
+        assert mock_grade.call_args[0][9] == {"regrade_one.pdf": {2}}  # nosec B101
+
+    r = client.post(f"/exams/{exam_id}/regrade", data={'key': (io.BytesIO(b"key v2"), 'key.pdf')},
+                    content_type="multipart/form-data")
+    assert b"Nothing to re-grade" in r.data  # nosec B101
+
+
+def test_key_page_hashes_loads_only_unhashed_pages(client):
+    """Stored hashes are reused; a page without one is hashed once and the hash saved."""
+    with app.app_context():
+        exam = Exam(CreatedBy=1, Subject="Math", Title="Hashes")
+        db.session.add(exam)
+        db.session.flush()
+        exam_key = ExamKey(ExamId=exam.ExamId, KeyHash="h" * 64, PageCount=2)
+        exam_key.pages.append(app_module.ExamKeyPage(PageNumber=1, ImageData="k1", PageHash="stored"))
+        exam_key.pages.append(app_module.ExamKeyPage(PageNumber=2, ImageData="k2"))
+        db.session.add(exam_key)
+        db.session.commit()
+
+        hashes = {}
+        assert app_module.changed_key_pages(None, exam_key.KeyId, hashes) == {1, 2}  # nosec B101
+        assert hashes[exam_key.KeyId] == {1: "stored", 2: app_module.page_hash("k2")}  # nosec B101
+        assert exam_key.pages[1].PageHash == app_module.page_hash("k2")  # nosec B101
+
+
+def test_export_streams_latest_result_per_student(client):
+    """The CSV export has one row per student (their latest result) and per-question points on request."""
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.commit()
+        exam_id = test_exam.ExamId
+        item = {"page": 1, "question_id": "Q1", "verdict": "CORRECT", "points_possible": 2, "points_earned": 2}
+        app_module.persist_results(exam_id, [{"code": "700", "name": "Ann", "score": 0.0, "report": "",
+                                              "items": [dict(item, points_earned=0)]}])
+        app_module.persist_results(exam_id, [{"code": "700", "name": "Ann", "score": 0.0, "report": "",
+                                              "items": [item]},
+                                             {"code": "800", "name": "Bob", "score": 9.0, "report": ""}])
+        db.session.commit()
+
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+
+    r = client.get(f"/exams/{exam_id}/export?questions=1")
+    assert r.mimetype == "text/csv"  # nosec B101
+    lines = r.get_data(as_text=True).splitlines()
+    assert lines[0] == "Student Code,Full Name,Class,Score,Graded At,Result Id,Q1"  # nosec B101
+    assert [line.split(",")[0] for line in lines[1:]] == ["700", "800"]  # nosec B101
+    assert lines[1].startswith("700,Ann,Unknown,30.0,") and lines[1].endswith(",2,2.0")  # nosec B101
+    assert lines[2].endswith(",3,")  # nosec B101
+
+    assert len(client.get(f"/exams/{exam_id}/export?all=1").get_data(as_text=True).splitlines()) == 4  # nosec B101
+    r = client.get(f"/exams/{exam_id}/export?format=xlsx")
+    assert r.data[:2] == b"PK"  # nosec B101
+
+
+def test_exam_analytics_cache_follows_new_results(client):
+    """The cached analytics are updated as results are stored and match a rebuild from scratch."""
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Midterm", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.commit()
+        exam_id = test_exam.ExamId
+
+        def graded(code, earned):
+            return {"code": code, "name": code, "score": 0.0, "report": "", "items": [
+                {"page": 1, "question_id": "Q1", "verdict": "", "points_possible": 1, "points_earned": earned,
+                 "student_literal_transcription": "a" if earned else "b"}]}
+
+        app_module.persist_results(exam_id, [graded("900", 1), graded("901", 0)])
+        db.session.commit()
+        assert app_module.exam_analytics(exam_id)["n"] == 2  # nosec B101
+
+        # Student 901 is graded again: their newer result replaces the old one in the cache.
+        app_module.persist_results(exam_id, [graded("901", 1), graded("902", 0)])
+        db.session.commit()
+        cached = app_module.exam_analytics(exam_id)
+        app_module.ExamAnalytics.query.delete()
+        db.session.commit()
+        assert app_module.analytics.summarize(cached) == \
+            app_module.analytics.summarize(app_module.exam_analytics(exam_id))  # nosec B101
+        assert cached["n"] == 3 and cached["questions"]["1:Q1"]["answers"] == {"a": 2, "b": 1}  # nosec B101
+
+    with client.session_transaction() as sess:
+        sess['logged_in'] = True
+    assert client.get(f"/api/exams/{exam_id}/analytics").get_json()["students"] == 3  # nosec B101
+    assert b"Exam Analytics" in client.get(f"/exams/{exam_id}/analytics").data  # nosec B101
+
+
+def test_analytics_built_during_a_batch_are_dropped(client, monkeypatch):
+    """A cache a view builds while a batch is being stored, without that batch, is dropped with it."""
+    with app.app_context():
+        exam = Exam(CreatedBy=1, Subject="Math", Title="Race")
+        db.session.add(exam)
+        db.session.commit()
+        exam_id = exam.ExamId
+        rescore = app_module.rescore_results
+
+        def view_builds_cache(result_ids):
+            # Stands in for a dashboard request that built the cache after persist_results checked.
+            db.session.add(app_module.ExamAnalytics(ExamId=exam_id, Stats='{"n": 0}'))
+            db.session.flush()
+            return rescore(result_ids)
+
+        monkeypatch.setattr(app_module, "rescore_results", view_builds_cache)
+        app_module.persist_results(exam_id, [{"code": "950", "name": "Ann", "score": 3.0, "report": ""}])
+        db.session.commit()
+        assert app_module.ExamAnalytics.query.get(exam_id) is None  # nosec B101
+        assert app_module.exam_analytics(exam_id)["n"] == 1  # nosec B101
+
+
+@patch('app.grade_batch_exams')
+@patch('app.extract_student_info')
+@patch('app.pdf_to_base64_images')
+def test_grade_dir_command_resumes_from_checkpoint(mock_pdf, mock_extract, mock_grade, client, tmp_path):
+    """`flask grade-dir` grades a directory of scans and a second run skips what the checkpoint has."""
+
+    mock_pdf.return_value = ["fake_base64_image_data"]
+    mock_extract.side_effect = [("1001", "Student One"), ("1002", "Student Two"), ("1003", "Student Three")]
+    mock_grade.return_value = "FINAL SCALED SCORE: 20 / 30"
+
+    with app.app_context():
+        test_exam = Exam(CreatedBy=1, Subject="Math", Title="Final", ExamDate=datetime.utcnow().date())
+        db.session.add(test_exam)
+        db.session.commit()
+        exam_id = test_exam.ExamId
+
+    scans = tmp_path / "scans"
+    (scans / "room_b").mkdir(parents=True)
+    (scans / "one.pdf").write_bytes(b"scan one")
+    (scans / "room_b" / "two.pdf").write_bytes(b"scan two")
+    (scans / "notes.txt").write_text("not a scan")
+    key = tmp_path / "key.pdf"
+    key.write_bytes(b"cli key")
+    checkpoint = tmp_path / "progress.jsonl"
+
+    runner = app.test_cli_runner()
+    args = ["grade-dir", str(scans), "--exam-id", str(exam_id), "--key", str(key),
+            "--checkpoint", str(checkpoint), "--workers", "1"]
+    outcome = runner.invoke(args=args)
+    assert outcome.exit_code == 0, outcome.output  # nosec B101
+
+    with app.app_context():
+        assert Result.query.filter_by(ExamId=exam_id).count() == 2  # nosec B101
+        assert GradingJob.query.one().Status == 'done'  # nosec B101
+    graded, jobs = app_module.read_checkpoint(str(checkpoint))
+    assert sorted(graded) == sorted([str(scans / "one.pdf"), str(scans / "room_b" / "two.pdf")])  # nosec B101
+    assert len(jobs) == 1  # nosec B101
+
+    with app.app_context():
+        # Web workers leave grade-dir jobs to the command.
+        # A web job's id comes from the browser, so its prefix means nothing.
+        app_module.enqueue_grading_job("cli-left-alone", exam_id, app_module.get_exam_key(exam_id),
+                                       [("x.pdf", str(scans / "one.pdf"))], source='cli')
+        app_module.enqueue_grading_job("cli-from-browser", exam_id, app_module.get_exam_key(exam_id),
+                                       [("y.pdf", str(scans / "one.pdf"))])
+        assert app_module.next_fair_job() == ("cli-from-browser", 1)  # nosec B101
+        GradingTask.query.filter(GradingTask.JobId.in_(["cli-left-alone", "cli-from-browser"])).delete()
+        GradingJob.query.filter(GradingJob.JobId.in_(["cli-left-alone", "cli-from-browser"])).delete()
+        db.session.commit()
+
+    # A crash between saving a batch and checkpointing it: the task rows fill the gap.
+    checkpoint.write_text(checkpoint.read_text().splitlines()[0] + "\n")
+    (scans / "three.pdf").write_bytes(b"scan three")
+    outcome = runner.invoke(args=args[:4] + args[6:])  # the exam's key is reused
+    assert outcome.exit_code == 0, outcome.output  # nosec B101
+    assert "2 already graded, 1 to grade" in outcome.output  # nosec B101
+    with app.app_context():
+        assert Result.query.filter_by(ExamId=exam_id).count() == 3  # nosec B101
+    assert mock_grade.call_count == 3  # nosec B101
@@ -0,0 +1,25 @@
+import json
+
+import demo_ai
+from bench_grading import FakeModelServer
+
+
+def test_fake_server_speaks_chat_completions(monkeypatch):
+    """The stand-in endpoint answers through the real gateway, 429s included."""
+    monkeypatch.setattr(demo_ai, "rate_limiter", demo_ai.RateLimiter(100000, 100000000))
+    monkeypatch.setattr(demo_ai, "RATE_LIMIT_BACKOFF", 0.01)
+    monkeypatch.setenv("GITHUB_TOKEN", "bench-token")
+    server = FakeModelServer(latency=0.0, jitter=0.0, rate_429=0.5, retry_after_ms=10, seed=1).start()
+    try:
+        gateway = demo_ai.LLMGateway(server.url, 8, 5, 30, 300)
+        content = [{"type": "text", "text": "You are a grading engine."},
+                   {"type": "text", "text": "--- a.pdf (PAGE 2) ---"}]
+        text, error = gateway.request_json("gpt-4o", content, "a.pdf Page 2", max_retries=20)
+    finally:
+        server.stop()
+
+    assert error is None  # nosec B101
+    questions = json.loads(text)["questions"]
+    assert [q["question_id"] for q in questions][:2] == ["Q2-1", "Q2-2"]  # nosec B101
+    assert server.requests == server.rate_limited + 1  # nosec B101
+    assert server.prompt_tokens > 0 and server.completion_tokens > 0  # nosec B101
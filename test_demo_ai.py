@@ -0,0 +1,340 @@
+import json
+import os
+import random
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+import demo_ai
+import openai
+
+
+class FakeCompletions:
+    """Answers every page with one question whose points encode the page number."""
+
+    def __init__(self):
+        self.calls = 0
+        self.images_sent = 0
+
+    @property
+    def with_raw_response(self):
+        def create(**kwargs):
+            response = self.create(**kwargs)
+            return SimpleNamespace(headers={}, parse=lambda: response)
+        return SimpleNamespace(create=create)
+
+    def create(self, **kwargs):
+        self.calls += 1
+        content = kwargs["messages"][0]["content"]
+        self.images_sent += sum(1 for part in content if part["type"] == "image_url")
+        label = content[-2]["text"]
+        page_num = int(label.rsplit("PAGE ", 1)[1].rstrip(" -)"))
+        time.sleep(random.uniform(0, 0.02))  # nosec B311
+        body = {"questions": [{
+            "question_id": f"Q{page_num}",
+            "key_literal_transcription": "a",
+            "student_literal_transcription": "a",
+            "step_by_step_analysis": "match",
+            "verdict": "CORRECT",
+            "points_possible": 1.0,
+            "points_earned": 1.0 if page_num % 2 else 0.0,
+        }]}
+        if any("student_id" in part.get("text", "") for part in content):
+            body.update(student_id="777", student_name="Ann")
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(body)))],
+            usage=SimpleNamespace(total_tokens=100),
+        )
+
+
+def fake_openai(completions):
+    return lambda **kwargs: SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+
+def new_gateway(**overrides):
+    """A gateway with its own client and breaker, so tests don't share state."""
+    settings = dict(max_in_flight=8, failure_threshold=5, reset_timeout=30, max_wait=300)
+    settings.update(overrides)
+    return demo_ai.LLMGateway("https://example.invalid", **settings)
+
+
+@pytest.fixture
+def endpoint(monkeypatch, tmp_path):
+    """A token, a roomy rate limiter, an empty response cache and a fresh gateway."""
+    monkeypatch.setenv("GITHUB_TOKEN", "test-token")
+    monkeypatch.setattr(demo_ai, "rate_limiter", demo_ai.RateLimiter(rpm=6000, tpm=10_000_000))
+    monkeypatch.setattr(demo_ai, "response_cache", demo_ai.ResponseCache(str(tmp_path), 10_000_000))
+    monkeypatch.setattr(demo_ai, "llm_gateway", new_gateway())
+
+
+def test_grade_batch_exams_keeps_page_order(endpoint):
+    """Pages graded in parallel are reassembled in page order with the same final score."""
+    completions = FakeCompletions()
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        report = demo_ai.grade_batch_exams(
+            {"a.pdf": ["s1", "s2", "s3", "s4"], "b.pdf": ["s1", "s2", "s3", "s4"]},
+            ["k1", "k2", "k3", "k4"],
+        )
+
+    assert completions.calls == 8  # nosec B101
+    a_report = report.split("GRADING REPORT: b.pdf")[0]
+    pages = [a_report.index(f"--- PAGE {n} ---") for n in range(1, 5)]
+    assert pages == sorted(pages)  # nosec B101
+    assert report.count("FINAL SCALED SCORE: 15.0 / 30") == 2  # nosec B101
+
+
+def test_response_cache_replays_graded_pages(endpoint):
+    """Re-grading the same scans is served from the cache without any model calls."""
+    completions = FakeCompletions()
+    submissions = {"a.pdf": ["s1", "s2"]}
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        first = demo_ai.grade_batch_exams(submissions, ["k1", "k2"])
+        stats = {}
+        second = demo_ai.grade_batch_exams(submissions, ["k1", "k2"], stats)
+
+    assert completions.calls == 2  # nosec B101
+    assert stats == {"cache_hits": 2}  # nosec B101
+    assert first == second  # nosec B101
+
+
+def test_refreshed_pages_bypass_the_response_cache(endpoint):
+    """A re-graded page asks the model again and its fresh answer replaces the cached one."""
+    completions = FakeCompletions()
+    submissions = {"a.pdf": ["s1", "s2"]}
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        demo_ai.grade_batch_exams(submissions, ["k1", "k2"])
+        stats = {}
+        demo_ai.grade_batch_exams(submissions, ["k1", "k2"], stats, refresh={"a.pdf": {2}})
+
+    assert completions.calls == 3  # nosec B101
+    assert (stats["cache_hits"], stats["cache_misses"]) == (1, 1)  # nosec B101
+
+
+def test_transcribed_key_pages_are_sent_as_text(endpoint):
+    """Pages with a key transcription send only the student image; diagram pages keep the key image."""
+    completions = FakeCompletions()
+    key_transcriptions = [
+        {"requires_key_image": False, "questions": [{"question_id": "Q1", "expected_answer": "a"}]},
+        {"requires_key_image": True, "questions": []},
+        None,
+    ]
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        report = demo_ai.grade_batch_exams(
+            {"a.pdf": ["s1", "s2", "s3"]}, ["k1", "k2", "k3"], key_transcriptions=key_transcriptions
+        )
+
+    assert completions.calls == 3  # nosec B101
+    assert completions.images_sent == 5  # nosec B101
+    assert "FINAL SCALED SCORE: 20.0 / 30" in report  # nosec B101
+
+
+class NullPointsCompletions(FakeCompletions):
+    """Answers with "points_earned": null until `bad` responses have been sent."""
+
+    def __init__(self, bad):
+        super().__init__()
+        self.bad = bad
+
+    def create(self, **kwargs):
+        response = super().create(**kwargs)
+        if self.bad:
+            self.bad -= 1
+            body = json.loads(response.choices[0].message.content)
+            body["questions"][0]["points_earned"] = None
+            response.choices[0].message.content = json.dumps(body)
+        return response
+
+
+def test_unusable_page_is_reported_and_not_cached(endpoint):
+    """A page without usable points fails alone, and grading it again asks the model again."""
+    completions = NullPointsCompletions(bad=1)
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        first = demo_ai.grade_batch_exams({"a.pdf": ["s1"]}, ["k1"])
+        second = demo_ai.grade_batch_exams({"a.pdf": ["s1"]}, ["k1"])
+
+    assert "ERROR: AI returned questions without usable points" in first  # nosec B101
+    assert completions.calls == 2  # nosec B101
+    assert "FINAL SCALED SCORE: 30.0 / 30" in second  # nosec B101
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    """Entries past the size bound are evicted oldest-access first."""
+    cache = demo_ai.ResponseCache(str(tmp_path), 350)
+    for n in range(3):
+        cache.put(f"{n:02d}key", "x" * 100)
+        os.utime(cache._path(f"{n:02d}key"), (n, n))
+    cache.get("00key")
+    cache.put("03key", "x" * 100)
+
+    assert cache.get("00key") is not None  # nosec B101
+    assert cache.get("01key") is None  # nosec B101
+
+
+def test_rate_limiter_waits_for_refill():
+    """Once the request budget is spent, acquire blocks until the bucket refills."""
+    limiter = demo_ai.RateLimiter(rpm=600, tpm=1_000_000)
+    limiter._requests = 0.0
+    start = time.monotonic()
+    limiter.acquire(10)
+    assert time.monotonic() - start >= 0.05  # nosec B101
+
+
+def test_rate_limiter_share_below_one_request_still_admits_one():
+    """A process's share of a small budget (0.5 rpm) still lets one request through at once."""
+    limiter = demo_ai.RateLimiter(rpm=0.5, tpm=1_000_000)
+    start = time.monotonic()
+    limiter.acquire(10)
+    assert time.monotonic() - start < 1  # nosec B101
+
+
+def test_identity_is_read_in_the_first_page_request(endpoint):
+    """Fused identity extraction rides on page 1's grading call instead of costing a request."""
+    completions = FakeCompletions()
+    identities = {}
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        demo_ai.grade_batch_exams({"a.pdf": ["s1", "s2"]}, ["k1", "k2"], identities=identities)
+
+    assert completions.calls == 2  # nosec B101
+    assert identities == {"a.pdf": {"student_id": "777", "student_name": "Ann"}}  # nosec B101
+
+
+class PackedCompletions(FakeCompletions):
+    """Answers packed requests in the {"pages": [...]} schema, optionally leaving one page out."""
+
+    def __init__(self, drop_last=False):
+        super().__init__()
+        self.drop_last = drop_last
+        self.packed_calls = 0
+
+    def create(self, **kwargs):
+        content = kwargs["messages"][0]["content"]
+        if "PACKED OUTPUT FORMAT" not in content[0]["text"]:
+            return super().create(**kwargs)
+        self.calls += 1
+        self.packed_calls += 1
+        pages = []
+        for part in content:
+            text = part.get("text", "")
+            if text.startswith("--- ") and "ANSWER KEY" not in text:
+                student, page_num = text[4:].rstrip(" -)").rsplit(" (PAGE ", 1)
+                page = {"student": student, "page": int(page_num), "questions": [{
+                    "question_id": f"Q{page_num}", "verdict": "CORRECT",
+                    "points_possible": 1.0, "points_earned": 1.0 if int(page_num) % 2 else 0.0,
+                }]}
+                if int(page_num) == 1:
+                    page.update(student_id="777", student_name="Ann")
+                pages.append(page)
+        if self.drop_last:
+            pages.pop()
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps({"pages": pages})))],
+            usage=SimpleNamespace(total_tokens=100),
+        )
+
+
+def test_packed_requests_split_back_per_page(endpoint, monkeypatch):
+    """Several pages share one request and are scored and reported exactly as if sent one by one."""
+    monkeypatch.setattr(demo_ai, "GRADING_PACK_WIDTH", 3)
+    completions = PackedCompletions()
+    identities = {}
+    pages_done = []
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        report = demo_ai.grade_batch_exams(
+            {"a.pdf": ["s1", "s2", "s3", "s4"], "b.pdf": ["s1", "s2", "s3", "s4"]},
+            ["k1", "k2", "k3", "k4"], identities=identities,
+            on_page=lambda name, num: pages_done.append((name, num)),
+        )
+
+    # Pages 1-3 of each student are packed, page 4 goes alone.
+    assert completions.packed_calls == 2 and completions.calls == 4  # nosec B101
+    assert report.count("FINAL SCALED SCORE: 15.0 / 30") == 2  # nosec B101
+    assert identities["a.pdf"] == {"student_id": "777", "student_name": "Ann"}  # nosec B101
+    assert len(pages_done) == 8  # nosec B101
+
+
+def test_invalid_pack_falls_back_to_single_pages(endpoint, monkeypatch):
+    """A packed answer that leaves a page out is discarded and the pack's pages are re-sent singly."""
+    monkeypatch.setattr(demo_ai, "GRADING_PACK_WIDTH", 2)
+    monkeypatch.setattr(demo_ai, "GRADING_PACK_MODE", "students")
+    completions = PackedCompletions(drop_last=True)
+    stats = {}
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        report = demo_ai.grade_batch_exams({"a.pdf": ["s1", "s2"], "b.pdf": ["s1", "s2"]},
+                                           ["k1", "k2"], stats)
+
+    assert completions.packed_calls == 2 and completions.calls == 6  # nosec B101
+    assert stats["pack_fallbacks"] == 2  # nosec B101
+    assert report.count("FINAL SCALED SCORE: 15.0 / 30") == 2  # nosec B101
+
+
+class FlakyCompletions:
+    """Fails with the queued exceptions first, then answers like FakeCompletions."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.fake = FakeCompletions()
+        self.attempts = 0
+
+    @property
+    def with_raw_response(self):
+        def create(**kwargs):
+            self.attempts += 1
+            if self.errors:
+                raise self.errors.pop(0)
+            return self.fake.with_raw_response.create(**kwargs)
+        return SimpleNamespace(create=create)
+
+
+def http_error(error_class, status, headers=None):
+    response = SimpleNamespace(status_code=status, headers=headers or {}, request=None)
+    return error_class("endpoint error", response=response, body=None)
+
+
+def test_gateway_honours_retry_after(monkeypatch):
+    """A 429 pauses the shared limiter for the endpoint's Retry-After, then the request goes through."""
+    monkeypatch.setenv("GITHUB_TOKEN", "test-token")
+    limiter = demo_ai.RateLimiter(rpm=6000, tpm=10_000_000)
+    monkeypatch.setattr(demo_ai, "rate_limiter", limiter)
+    completions = FlakyCompletions([http_error(openai.RateLimitError, 429, {"retry-after-ms": "120"})])
+    content = [{"type": "text", "text": "grade"}, {"type": "text", "text": "--- a.pdf (PAGE 1) ---"},
+               {"type": "text", "text": "s1"}]
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        start = time.monotonic()
+        text, error = new_gateway().request_json("gpt-4o", content, "a.pdf Page 1", 3)
+
+    assert error is None and json.loads(text)["questions"]  # nosec B101
+    assert completions.attempts == 2  # nosec B101
+    assert time.monotonic() - start >= 0.1  # nosec B101
+
+
+def test_gateway_circuit_opens_and_probes(monkeypatch):
+    """Consecutive server errors open the circuit; callers wait, and one probe closes it again."""
+    monkeypatch.setenv("GITHUB_TOKEN", "test-token")
+    monkeypatch.setattr(demo_ai, "rate_limiter", demo_ai.RateLimiter(rpm=6000, tpm=10_000_000))
+    monkeypatch.setattr(demo_ai, "RATE_LIMIT_BACKOFF", 0.001)
+    gateway = new_gateway(failure_threshold=2, reset_timeout=0.2, max_wait=0.1)
+    completions = FlakyCompletions([http_error(openai.InternalServerError, 503)] * 2)
+    content = [{"type": "text", "text": "--- a.pdf (PAGE 1) ---"}, {"type": "text", "text": "s1"}]
+
+    with patch("openai.OpenAI", fake_openai(completions)):
+        text, error = gateway.request_json("gpt-4o", content, "a.pdf Page 1", 2)
+        assert text is None and error  # nosec B101
+        with pytest.raises(demo_ai.EndpointUnavailable):
+            gateway.request_json("gpt-4o", content, "a.pdf Page 1", 2)
+
+        gateway.max_wait = 1.0
+        text, error = gateway.request_json("gpt-4o", content, "a.pdf Page 1", 2)
+
+    assert error is None  # nosec B101
+    assert completions.attempts == 3  # nosec B101
@@ -0,0 +1,31 @@
+import metrics
+
+
+def test_registry_renders_prometheus_text():
+    """Counters carry their labels and histograms expose cumulative buckets, sum and count."""
+    registry = metrics.Registry()
+    registry.describe("llm_request_seconds", "histogram", "Latency.")
+    registry.inc("llm_tokens_total", 120, kind="prompt")
+    registry.inc("llm_tokens_total", 30, kind="prompt")
+    registry.observe("llm_request_seconds", 0.2, outcome="ok")
+    registry.observe("llm_request_seconds", 7, outcome="ok")
+
+    text = registry.render()
+
+    assert 'llm_tokens_total{kind="prompt"} 150' in text  # nosec B101
+    assert "# TYPE llm_request_seconds histogram" in text  # nosec B101
+    assert 'llm_request_seconds_bucket{outcome="ok",le="0.25"} 1' in text  # nosec B101
+    assert 'llm_request_seconds_bucket{outcome="ok",le="10"} 2' in text  # nosec B101
+    assert 'llm_request_seconds_bucket{outcome="ok",le="+Inf"} 2' in text  # nosec B101
+    assert 'llm_request_seconds_sum{outcome="ok"} 7.2' in text  # nosec B101
+
+
+def test_timed_attributes_stage_to_job_stats():
+    """A timed span lands in the stage histogram and in the job's "<stage>_seconds" stat."""
+    stats = {}
+    with metrics.timed("render_wait", stats):
+        pass
+    metrics.count("llm_retries_total", stats=stats, stat="retries")
+
+    assert stats["render_wait_seconds"] >= 0 and stats["retries"] == 1  # nosec B101
+    assert 'grading_stage_seconds_count{stage="render_wait"}' in metrics.registry.render()  # nosec B101
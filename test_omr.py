@@ -0,0 +1,55 @@
+import base64
+
+import fitz
+
+import omr
+
+
+TEMPLATE = {"pages": {"1": {"rows": 5, "choices": "ABCD", "points": 2.0, "mc_only": True}}}
+
+
+def render_answer_table(marks):
+    """Renders a one-page exam with a 5x4 answer grid; marks maps row -> filled column."""
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 60), "Answers Table")
+    x0, y0, cell_w, cell_h = 100, 100, 60, 30
+    shape = page.new_shape()
+    for row in range(6):
+        shape.draw_line((x0, y0 + row * cell_h), (x0 + 4 * cell_w, y0 + row * cell_h))
+    for col in range(5):
+        shape.draw_line((x0 + col * cell_w, y0), (x0 + col * cell_w, y0 + 5 * cell_h))
+    shape.finish(color=(0, 0, 0), width=2)
+    for row, col in marks.items():
+        if col is None:
+            continue
+        shape.draw_rect(fitz.Rect(x0 + col * cell_w + 8, y0 + row * cell_h + 6,
+                                  x0 + (col + 1) * cell_w - 8, y0 + (row + 1) * cell_h - 6))
+    shape.finish(color=(0, 0, 0), fill=(0, 0, 0))
+    shape.commit()
+    img = base64.b64encode(page.get_pixmap(dpi=200).tobytes("jpeg")).decode('utf-8')
+    doc.close()
+    return img
+
+
+def test_marked_page_is_graded_locally():
+    """A cleanly filled table is graded against the key without the model."""
+    key = render_answer_table({0: 0, 1: 1, 2: 2, 3: 3, 4: 0})
+    student = render_answer_table({0: 0, 1: 1, 2: 0, 3: 3, 4: None})
+
+    graded = omr.grade_marked_pages(TEMPLATE, [key], [student])
+
+    questions = graded[1]["questions"]
+    assert [q["student_literal_transcription"] for q in questions] == ["A", "B", "A", "D", ""]  # nosec B101
+    assert [q["verdict"] for q in questions] == ["CORRECT", "CORRECT", "INCORRECT", "CORRECT", "INCORRECT"]  # nosec B101
+    assert sum(q["points_earned"] for q in questions) == 6.0  # nosec B101
+
+
+def test_unreadable_page_is_left_for_the_model():
+    """A page with no detectable grid is not pre-graded."""
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "Free response")
+    blank = base64.b64encode(doc[0].get_pixmap(dpi=200).tobytes("jpeg")).decode('utf-8')
+    key = render_answer_table({0: 0, 1: 1, 2: 2, 3: 3, 4: 0})
+
+    assert omr.grade_marked_pages(TEMPLATE, [key], [blank]) == {}  # nosec B101
@@ -0,0 +1,72 @@
+import base64
+
+import fitz
+
+import page_screen
+
+
+def render(lines=(), blank=False):
+    """Renders a one-page exam; lines are (y, text) pairs, blank gives an empty sheet."""
+    doc = fitz.open()
+    page = doc.new_page()
+    if not blank:
+        page.insert_text((72, 60), "Midterm exam", fontsize=20)
+        for y, text in lines:
+            page.insert_text((72, y), text, fontsize=14)
+    img = base64.b64encode(page.get_pixmap(dpi=100).tobytes("jpeg")).decode('utf-8')
+    doc.close()
+    return img
+
+
+KEY_PAGES = [
+    {"requires_key_image": False, "questions": []},
+    {"requires_key_image": False, "questions": [
+        {"question_id": "Q1", "expected_answer": "b", "points_possible": 2.0},
+        {"question_id": "Q2", "expected_answer": "d", "points_possible": 1.0}]},
+    {"requires_key_image": False, "questions": [
+        {"question_id": "Q3", "expected_answer": "a", "points_possible": 1.0}]},
+    {"requires_key_image": False, "questions": [
+        {"question_id": "Q4", "expected_answer": "c", "points_possible": 1.0}]}
+]
+
+
+def test_blank_and_cover_pages_skip_the_model():
+    """Cover pages and blank answer pages are graded locally; answered pages are left alone."""
+    key = [render([(200, f"Answer {n}")]) for n in range(4)]
+    student = [render([(300, "Name: Alice")]), render(blank=True),
+               render([(200, "Q3: a"), (400, "working")]), render([(500, "Q4: " + "c " * 20)])]
+
+    pregraded, duplicates = page_screen.screen_pages(key, student, KEY_PAGES)
+
+    assert sorted(pregraded) == [1, 2]  # nosec B101
+    assert pregraded[1] == {"questions": []}  # nosec B101
+    assert [(q["question_id"], q["points_possible"], q["points_earned"])  # nosec B101
+            for q in pregraded[2]["questions"]] == [("Q1", 2.0, 0.0), ("Q2", 1.0, 0.0)]
+    assert duplicates == {}  # nosec B101
+
+
+def test_blank_page_without_transcription_needs_a_blank_key():
+    """Without a transcribed key a blank page is only settled locally when its key page is blank too."""
+    student = [render(blank=True), render(blank=True)]
+    key = [render([(200, "Answer")]), render(blank=True)]
+
+    pregraded, _ = page_screen.screen_pages(key, student)
+
+    assert pregraded == {2: {"questions": []}}  # nosec B101
+
+
+def test_rescanned_page_is_flagged():
+    """A sheet fed through the scanner twice is flagged as a duplicate of the earlier page."""
+    first = render([(200, "Q1: b"), (260, "Q2: d"), (600, "long answer " * 4)])
+    other = render([(400, "Q3: a"), (700, "something else entirely")])
+    student = [first, first, other]
+
+    _, duplicates = page_screen.screen_pages([render([(200, "key")])] * 3, student)
+
+    assert duplicates == {2: 1}  # nosec B101
+
+
+def test_undecodable_pages_are_left_for_the_model():
+    pregraded, duplicates = page_screen.screen_pages(["not an image"], ["not an image"])
+
+    assert (pregraded, duplicates) == ({}, {})  # nosec B101
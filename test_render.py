@@ -0,0 +1,75 @@
+import base64
+
+import fitz
+import pytest
+
+import render
+
+
+def write_pdf(tmp_path):
+    """A one-page A4 PDF with a little text near the top-left corner."""
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_text((100, 100), "Q1: x = 2", fontsize=20)
+    path = tmp_path / "exam.pdf"
+    doc.save(path)
+    doc.close()
+    return str(path)
+
+
+def test_default_profile_matches_the_original_rendering(tmp_path):
+    """Without a profile pages come out as 200 DPI JPEGs, and their size is read from the header."""
+    path = write_pdf(tmp_path)
+    (img,) = render.iter_rendered_pages(path)
+
+    assert render.jpeg_size(base64.b64decode(img)) == (1653, 2339)  # nosec B101
+    n_bytes, tokens = render.image_part_cost(render.image_part(img))
+    assert n_bytes == len(base64.b64decode(img))  # nosec B101
+    assert tokens == 85 + 170 * 6  # nosec B101
+    assert render.image_part_cost(render.image_part(img, "low"))[1] == 85  # nosec B101
+
+
+def test_profile_crops_shrinks_and_picks_detail(tmp_path):
+    """Grayscale, autocrop and a max dimension cut the payload; MC-only OMR pages go at low detail."""
+    path = write_pdf(tmp_path)
+    (full,) = render.iter_rendered_pages(path)
+    profile = render.load_profile('{"grayscale": true, "autocrop": true, "max_dimension": 1200, '
+                                  '"jpeg_quality": 70, "pages": {"2": {"detail": "high"}}}')
+    (small,) = render.iter_rendered_pages(path, profile)
+
+    width, height = render.jpeg_size(base64.b64decode(small))
+    assert width < 400 and height < 100  # nosec B101
+    assert len(small) < len(full) / 10  # nosec B101
+
+    omr_template = {"pages": {"1": {"mc_only": True}, "2": {"mc_only": True}}}
+    assert render.page_detail(profile, 1, omr_template) == "low"  # nosec B101
+    assert render.page_detail(profile, 2, omr_template) == "high"  # nosec B101
+    assert render.page_detail(profile, 3, omr_template) == "high"  # nosec B101
+
+
+@pytest.mark.parametrize("profile", [
+    [], {"dpi": "high"}, {"dpi": 20}, {"jpeg_quality": None}, {"grayscale": "yes"},
+    {"max_dimension": "1200"}, {"max_dimension": 0}, {"header_region": [0, 0, 1]},
+    {"header_region": [0, 0.5, 1, "x"]}, {"header_region": [0, 0.5, 1, 0.25]},
+    {"pages": {"2": "high"}}, {"pages": {"two": {}}}, {"pages": {"2": {"detail": "max"}}}, {"dpy": 200}
+])
+def test_invalid_profiles_are_rejected(profile):
+    """Every field is type-checked before saving, not when the first page is rendered."""
+    with pytest.raises(ValueError):
+        render.validate_profile(profile)
+
+
+def test_valid_profile_passes():
+    render.validate_profile({"dpi": 150, "grayscale": True, "autocrop": False, "max_dimension": None,
+                             "jpeg_quality": 80, "detail": "low", "header_region": [0, 0, 1, 0.2],
+                             "pages": {"3": {"detail": "high"}}})
+
+
+def test_header_crop_is_small(tmp_path):
+    """The identity fallback sends only the downscaled top strip of page 1."""
+    (page,) = render.iter_rendered_pages(write_pdf(tmp_path))
+    header = render.crop_region(page, render.DEFAULT_PROFILE["header_region"])
+
+    width, height = render.jpeg_size(base64.b64decode(header))
+    assert width <= render.HEADER_MAX_DIMENSION and height < width  # nosec B101
+    assert len(header) < len(page) / 4  # nosec B101
@@ -0,0 +1,61 @@
+import io
+import os
+import time
+import zipfile
+import fitz
+import upload_store
+
+
+def make_pdf(pages, label=""):
+    doc = fitz.open()
+    for number in range(pages):
+        doc.new_page().insert_text((72, 72), f"{label} page {number + 1}")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_store_dedupes_by_content(tmp_path):
+    store = str(tmp_path / "store")
+    sha, path, is_new = upload_store.store_stream(io.BytesIO(b"scan"), store)
+    again_sha, again_path, again_new = upload_store.store_stream(io.BytesIO(b"scan"), store)
+
+    assert is_new and not again_new  # nosec B101
+    assert (sha, path) == (again_sha, again_path)  # nosec B101
+    assert os.path.basename(path) == f"{sha}.pdf"  # nosec B101
+    assert [name for name in os.listdir(store) if name.endswith(".part")] == []  # nosec B101
+
+
+def test_ingest_unpacks_zip_and_splits_long_pdfs(tmp_path):
+    store = str(tmp_path / "store")
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("batch/alice.pdf", make_pdf(2, "alice"))
+        zf.writestr("batch/notes.txt", "not a submission")
+        zf.writestr("__MACOSX/._alice.pdf", "resource fork")
+    archive.seek(0)
+
+    stored = list(upload_store.ingest([("batch.zip", archive), ("class.pdf", io.BytesIO(make_pdf(6, "class")))],
+                                      store, pages_per_file=2))
+
+    assert [name for name, _, _ in stored] == [  # nosec B101
+        "alice.pdf", "class_part001.pdf", "class_part002.pdf", "class_part003.pdf"]
+    for _, _, path in stored[1:]:
+        with fitz.open(path) as doc:
+            assert doc.page_count == 2  # nosec B101
+    # The whole scan itself isn't kept once it has been split.
+    assert len({path for _, _, path in stored}) == sum(len(files) for _, _, files in os.walk(store))  # nosec B101
+
+
+def test_collect_removes_only_expired_unused_files(tmp_path):
+    store = str(tmp_path / "store")
+    _, old, _ = upload_store.store_stream(io.BytesIO(b"old"), store)
+    _, in_use, _ = upload_store.store_stream(io.BytesIO(b"queued"), store)
+    _, fresh, _ = upload_store.store_stream(io.BytesIO(b"fresh"), store)
+    expired = time.time() - 10 * 86400
+    os.utime(old, (expired, expired))
+    os.utime(in_use, (expired, expired))
+
+    assert upload_store.collect(store, 86400, keep=[in_use]) == 1  # nosec B101
+    assert not os.path.exists(old)  # nosec B101
+    assert os.path.exists(in_use) and os.path.exists(fresh)  # nosec B101
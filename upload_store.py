@@ -0,0 +1,145 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from werkzeug.utils import secure_filename
+
+
+# Uploads are copied this many bytes at a time, so no file is ever held in memory whole.
+CHUNK_SIZE = 1024 * 1024
+# A ZIP member larger than this (uncompressed) is skipped rather than unpacked.
+MAX_MEMBER_BYTES = 512 * 1024 * 1024
+
+
+def store_path(directory, digest):
+    return os.path.join(directory, digest[:2], f"{digest}.pdf")
+
+
+def store_stream(stream, directory):
+    """
+    Copies a file-like object into the content-addressed store in CHUNK_SIZE pieces,
+    hashing as it goes. Returns (sha256, path, is_new); a file whose content is already
+    stored is not written twice, only its mtime is refreshed for the retention policy.
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+        sha = digest.hexdigest()
+        path = store_path(directory, sha)
+        if os.path.exists(path):
+            os.utime(path)
+            return sha, path, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return sha, path, True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _split_pdf(path, filename, pages_per_file, directory):
+    """Yields (filename, sha256, path) for every pages_per_file-page slice of a stored PDF."""
+    import fitz
+    stem = os.path.splitext(filename)[0]
+    src = fitz.open(path)
+    try:
+        for part, start in enumerate(range(0, src.page_count, pages_per_file), 1):
+            piece = fitz.open()
+            piece.insert_pdf(src, from_page=start, to_page=min(start + pages_per_file, src.page_count) - 1)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+            os.close(fd)
+            try:
+                piece.save(tmp_path, garbage=3, deflate=True)
+                piece.close()
+                with open(tmp_path, "rb") as f:
+                    sha, piece_path, _ = store_stream(f, directory)
+            finally:
+                os.remove(tmp_path)
+            yield f"{stem}_part{part:03d}.pdf", sha, piece_path
+    finally:
+        src.close()
+
+
+def _iter_zip(stream, directory):
+    """Yields (filename, file object) for the PDFs of a ZIP, opening one member at a time."""
+    # zipfile needs to seek, so the archive itself is spooled to a temporary file first.
+    with tempfile.TemporaryFile(dir=directory) as spool:
+        shutil.copyfileobj(stream, spool, CHUNK_SIZE)
+        spool.seek(0)
+        with zipfile.ZipFile(spool) as archive:
+            for member in archive.infolist():
+                name = os.path.basename(member.filename)
+                if member.is_dir() or not name.lower().endswith(".pdf") or name.startswith("."):
+                    continue
+                if member.file_size > MAX_MEMBER_BYTES:
+                    print(f"Skipping {member.filename}: {member.file_size} bytes uncompressed is too large.")
+                    continue
+                with archive.open(member) as member_stream:
+                    yield name, member_stream
+
+
+def ingest(files, directory, pages_per_file=None):
+    """
+    Lazily turns uploaded files into stored PDFs, yielding (filename, sha256, path) one
+    at a time. files are (filename, stream) pairs; a .zip contributes each PDF inside it,
+    and with pages_per_file a PDF longer than that (one scanner batch of the whole class)
+    is split into consecutive pages_per_file-page submissions.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    def pdfs():
+        for filename, stream in files:
+            if filename.lower().endswith(".zip"):
+                yield from _iter_zip(stream, directory)
+            else:
+                yield filename, stream
+
+    for filename, stream in pdfs():
+        filename = secure_filename(filename) or "upload.pdf"
+        sha, path, is_new = store_stream(stream, directory)
+        if pages_per_file:
+            import fitz
+            try:
+                with fitz.open(path) as doc:
+                    page_count = doc.page_count
+            except (RuntimeError, ValueError):
+                page_count = 0
+            if page_count > pages_per_file:
+                yield from _split_pdf(path, filename, pages_per_file, directory)
+                if is_new:
+                    # Only the slices are graded; the whole scan needn't wait for retention.
+                    os.remove(path)
+                continue
+        yield filename, sha, path
+
+
+def collect(directory, max_age, keep=()):
+    """
+    Retention policy: removes stored files not modified (or re-uploaded) for max_age
+    seconds, except the paths in keep, plus abandoned partial writes. Returns the
+    number of files removed.
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    cutoff = time.time() - max_age
+    removed = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) >= cutoff or os.path.abspath(path) in keep:
+                    continue
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue
+    return removed